@@ -3,6 +3,9 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import numpy as np
+import time
+from CTOptimizerLib.resampling import integerFactors, reconstructionError
+from CTOptimizerLib import batch, cache, cropping, decoding, memory, nifti, packing, parallel, phases, pipeline, pyramid, quantization, store, temporal
 
 class CTOptimizer(ScriptedLoadableModule):
   def __init__(self, parent):
@@ -17,6 +20,8 @@ class CTOptimizer(ScriptedLoadableModule):
 class CTOptimizerWidget(ScriptedLoadableModuleWidget):
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
+    # Ritaglio e frame delle fasi dell'ultimo piano completo, riusati dalla stima dal vivo
+    self._sequenceScan = None
     
     # Usa il layout esistente invece di crearne uno nuovo
     
@@ -27,7 +32,7 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     
     # Input
     self.inputSelector = slicer.qMRMLNodeComboBox()
-    self.inputSelector.nodeTypes = ["vtkMRMLSequenceNode"]
+    self.inputSelector.nodeTypes = ["vtkMRMLSequenceNode", "vtkMRMLMultiVolumeNode"]
     self.inputSelector.setMRMLScene(slicer.mrmlScene)
     self.inputSelector.setToolTip("Seleziona sequenza da ottimizzare")
     inputLayout.addRow("Input:", self.inputSelector)
@@ -43,6 +48,38 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     paramFrame.setFrameStyle(qt.QFrame.StyledPanel | qt.QFrame.Plain)
     paramLayout = qt.QFormLayout(paramFrame)
     
+    # Ritaglio del cuore
+    self.cropCheckBox = qt.QCheckBox()
+    self.cropCheckBox.checked = False
+    self.cropCheckBox.setToolTip("Ritaglia tutte le fasi su un unico box attorno al cuore prima del ricampionamento")
+    paramLayout.addRow("Ritaglio cuore:", self.cropCheckBox)
+    
+    self.cropSegmentationSelector = slicer.qMRMLNodeComboBox()
+    self.cropSegmentationSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
+    self.cropSegmentationSelector.selectNodeUponCreation = False
+    self.cropSegmentationSelector.addEnabled = False
+    self.cropSegmentationSelector.removeEnabled = False
+    self.cropSegmentationSelector.noneEnabled = True
+    self.cropSegmentationSelector.setMRMLScene(slicer.mrmlScene)
+    self.cropSegmentationSelector.setToolTip("Segmentazione che definisce il box (opzionale: senza, il cuore è stimato "
+                                             "dal pool ematico con soglia HU e componente connessa più grande)")
+    paramLayout.addRow("Segmentazione ritaglio:", self.cropSegmentationSelector)
+    
+    self.cropMarginSlider = ctk.ctkSliderWidget()
+    self.cropMarginSlider.minimum = 0.0
+    self.cropMarginSlider.maximum = 50.0
+    self.cropMarginSlider.singleStep = 1.0
+    self.cropMarginSlider.value = cropping.DEFAULT_MARGIN_MM
+    self.cropMarginSlider.setToolTip("Margine attorno al cuore in mm")
+    paramLayout.addRow("Margine ritaglio (mm):", self.cropMarginSlider)
+    
+    # Modalità di ricampionamento
+    self.resampleModeCombo = qt.QComboBox()
+    self.resampleModeCombo.addItem("Fattore di scala", "scale")
+    self.resampleModeCombo.addItem("Spacing target per asse", "spacing")
+    self.resampleModeCombo.setToolTip("Riduzione uniforme con un fattore di scala o spacing di output indicato per ogni asse")
+    paramLayout.addRow("Ricampionamento:", self.resampleModeCombo)
+    
     # Fattore scala
     self.scaleSlider = ctk.ctkSliderWidget()
     self.scaleSlider.minimum = 0.1
@@ -52,6 +89,38 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     self.scaleSlider.setToolTip("Fattore di ridimensionamento (1.0 = dimensione originale)")
     paramLayout.addRow("Fattore scala:", self.scaleSlider)
     
+    # Spacing target
+    self.targetSpacingWidget = ctk.ctkCoordinatesWidget()
+    self.targetSpacingWidget.dimension = 3
+    self.targetSpacingWidget.decimals = 3
+    self.targetSpacingWidget.minimum = 0.01
+    self.targetSpacingWidget.coordinates = "1.0,1.0,1.0"
+    self.targetSpacingWidget.setToolTip("Spacing di output in mm per gli assi I, J, K")
+    paramLayout.addRow("Spacing target (mm):", self.targetSpacingWidget)
+    
+    # Riduzione a blocchi
+    self.reductionCombo = qt.QComboBox()
+    self.reductionCombo.addItem("Media a blocchi", "mean")
+    self.reductionCombo.addItem("Massimo a blocchi", "max")
+    self.reductionCombo.addItem("Solo interpolazione", "")
+    self.reductionCombo.setToolTip("Per fattori di riduzione interi usa la riduzione a blocchi (anti-aliasing e più veloce); "
+                                   "l'interpolazione resta per i fattori non interi")
+    paramLayout.addRow("Fattori interi:", self.reductionCombo)
+    
+    # Interpolazione
+    self.interpolationCombo = qt.QComboBox()
+    self.interpolationCombo.addItem("Lineare", "linear")
+    self.interpolationCombo.addItem("Cubica", "cubic")
+    self.interpolationCombo.addItem("Nearest neighbor", "nearest")
+    self.interpolationCombo.setToolTip("Interpolazione usata dal ricampionamento in memoria")
+    paramLayout.addRow("Interpolazione:", self.interpolationCombo)
+    
+    # Ricampionamento in memoria
+    self.inMemoryCheckBox = qt.QCheckBox()
+    self.inMemoryCheckBox.checked = True
+    self.inMemoryCheckBox.setToolTip("Ricampiona tutti i frame in memoria con NumPy (il CLI ResampleScalarVolume resta come fallback)")
+    paramLayout.addRow("Ricampionamento in memoria:", self.inMemoryCheckBox)
+    
     # Bit depth
     self.bitDepthCombo = qt.QComboBox()
     self.bitDepthCombo.addItem("8-bit", 8)
@@ -60,13 +129,109 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     self.bitDepthCombo.currentIndex = 1  # Default 12-bit
     paramLayout.addRow("Profondità bit:", self.bitDepthCombo)
     
+    # Finestra clinica fissa
+    self.fixedWindowCheckBox = qt.QCheckBox()
+    self.fixedWindowCheckBox.checked = False
+    self.fixedWindowCheckBox.setToolTip("Quantizza tutti i frame sulla finestra fissa [%d, %d] HU senza calcolare min/max "
+                                        "per frame: stessa codifica in tutti i frame, senza perdita a 12 bit dentro la finestra"
+                                        % quantization.CLINICAL_WINDOW_HU)
+    paramLayout.addRow("Finestra HU fissa:", self.fixedWindowCheckBox)
+    
+    # 12 bit impacchettati
+    self.packed12CheckBox = qt.QCheckBox()
+    self.packed12CheckBox.checked = False
+    self.packed12CheckBox.setToolTip("Salva i frame a 12 bit impacchettati (2 voxel in 3 byte), decodificati solo quando selezionati nel browser")
+    paramLayout.addRow("12 bit impacchettati:", self.packed12CheckBox)
+    
+    # Codifica temporale
+    self.temporalCheckBox = qt.QCheckBox()
+    self.temporalCheckBox.checked = False
+    self.temporalCheckBox.setToolTip("Salva il primo frame come riferimento e gli altri come residui sparsi rispetto ad esso "
+                                     "(stessa quantizzazione per tutti i frame, decodifica solo del frame selezionato)")
+    paramLayout.addRow("Codifica temporale:", self.temporalCheckBox)
+    
+    # Tolleranza residui
+    self.residualToleranceSpinBox = qt.QSpinBox()
+    self.residualToleranceSpinBox.minimum = 0
+    self.residualToleranceSpinBox.maximum = 64
+    self.residualToleranceSpinBox.value = 0
+    self.residualToleranceSpinBox.setToolTip("Residui con modulo fino a questo valore (in codici) vengono azzerati (0 = senza perdita)")
+    paramLayout.addRow("Tolleranza residui:", self.residualToleranceSpinBox)
+    
+    # Piramide di anteprima
+    self.pyramidCheckBox = qt.QCheckBox()
+    self.pyramidCheckBox.checked = False
+    self.pyramidCheckBox.setToolTip("Salva per ogni frame versioni ridotte 2x e 4x (medie a blocchi): il browser di anteprima "
+                                    "riproduce il livello ridotto e mostra la risoluzione piena quando la riproduzione si ferma")
+    paramLayout.addRow("Piramide anteprima (2x/4x):", self.pyramidCheckBox)
+    
+    # Selezione delle fasi cardiache
+    self.phaseSelectionCombo = qt.QComboBox()
+    self.phaseSelectionCombo.addItem("Tutti i frame", "")
+    self.phaseSelectionCombo.addItem("ED, ES e una fase ogni k", phases.SELECTION_STEP)
+    self.phaseSelectionCombo.addItem("ED, ES e N fasi per volume", phases.SELECTION_VOLUME)
+    self.phaseSelectionCombo.setToolTip("Conserva solo alcune fasi, scelte dalla curva del volume del pool ematico "
+                                        "stimata su frame sottocampionati")
+    paramLayout.addRow("Fasi:", self.phaseSelectionCombo)
+    
+    self.phaseStepSpinBox = qt.QSpinBox()
+    self.phaseStepSpinBox.minimum = 1
+    self.phaseStepSpinBox.maximum = 50
+    self.phaseStepSpinBox.value = 2
+    self.phaseStepSpinBox.setToolTip("Conserva una fase ogni k a partire dalla telediastole")
+    paramLayout.addRow("Passo fasi (k):", self.phaseStepSpinBox)
+    
+    self.phaseCountSpinBox = qt.QSpinBox()
+    self.phaseCountSpinBox.minimum = 1
+    self.phaseCountSpinBox.maximum = 100
+    self.phaseCountSpinBox.value = 5
+    self.phaseCountSpinBox.setToolTip("Numero di fasi distribuite uniformemente lungo la variazione di volume del ciclo")
+    paramLayout.addRow("Numero fasi (N):", self.phaseCountSpinBox)
+    
+    # Worker paralleli
+    self.workersSpinBox = qt.QSpinBox()
+    self.workersSpinBox.minimum = 1
+    self.workersSpinBox.maximum = max(1, os.cpu_count() or 1)
+    self.workersSpinBox.value = parallel.defaultWorkerCount()
+    self.workersSpinBox.setToolTip("Numero di processi worker per l'elaborazione dei frame (1 = seriale)")
+    paramLayout.addRow("Worker:", self.workersSpinBox)
+    
+    # Streaming
+    self.streamingCheckBox = qt.QCheckBox()
+    self.streamingCheckBox.checked = True
+    self.streamingCheckBox.setToolTip("Elabora un frame alla volta rilasciando subito i temporanei (memoria ≈ un frame di input + uno di output)")
+    paramLayout.addRow("Streaming (memoria limitata):", self.streamingCheckBox)
+    
+    # Cache dei frame su disco
+    self.frameCacheCheckBox = qt.QCheckBox()
+    self.frameCacheCheckBox.checked = False
+    self.frameCacheCheckBox.setToolTip("Riusa i frame già ottimizzati con gli stessi voxel e parametri (cache su disco, "
+                                       "solo elaborazione in memoria)")
+    self.clearFrameCacheButton = qt.QPushButton("Svuota")
+    self.clearFrameCacheButton.setToolTip("Elimina tutti i frame salvati nella cache")
+    frameCacheLayout = qt.QHBoxLayout()
+    frameCacheLayout.addWidget(self.frameCacheCheckBox)
+    frameCacheLayout.addWidget(self.clearFrameCacheButton)
+    frameCacheLayout.addStretch(1)
+    paramLayout.addRow("Cache dei frame:", frameCacheLayout)
+    
     self.layout.addWidget(paramFrame)
     
     # Info stima dimensione
     self.sizeLabel = qt.QLabel("Dimensione stimata: --")
     self.layout.addWidget(self.sizeLabel)
     
-    # Pulsante
+    # Pulsanti
+    self.planButton = qt.QPushButton("Pianifica (dry-run)")
+    self.planButton.enabled = False
+    self.planButton.setToolTip("Stima dimensioni, picco di RAM e tempo elaborando pochi frame campione")
+    self.layout.addWidget(self.planButton)
+    
+    self.benchmarkButton = qt.QPushButton("Confronta ricampionamento")
+    self.benchmarkButton.enabled = False
+    self.benchmarkButton.setToolTip("Confronta velocità e fedeltà HU di riduzione a blocchi, interpolazione e CLI sul primo frame")
+    self.layout.addWidget(self.benchmarkButton)
+    
     self.applyButton = qt.QPushButton("Ottimizza")
     self.applyButton.enabled = False
     self.layout.addWidget(self.applyButton)
@@ -76,17 +241,87 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     self.progressBar.visible = False
     self.layout.addWidget(self.progressBar)
     
+    # Frame per archivio su disco
+    storeFrame = qt.QFrame()
+    storeFrame.setFrameStyle(qt.QFrame.StyledPanel | qt.QFrame.Plain)
+    storeLayout = qt.QFormLayout(storeFrame)
+    
+    self.storeSequenceSelector = slicer.qMRMLNodeComboBox()
+    self.storeSequenceSelector.nodeTypes = ["vtkMRMLSequenceNode"]
+    self.storeSequenceSelector.setMRMLScene(slicer.mrmlScene)
+    self.storeSequenceSelector.setToolTip("Sequenza ottimizzata da salvare su disco")
+    storeLayout.addRow("Sequenza da salvare:", self.storeSequenceSelector)
+    
+    self.storePathEdit = ctk.ctkPathLineEdit()
+    self.storePathEdit.filters = ctk.ctkPathLineEdit.Files
+    self.storePathEdit.nameFilters = ["Sequenza CT4D (*.ct4d)"]
+    self.storePathEdit.setToolTip("File .ct4d a blocchi compressi")
+    storeLayout.addRow("File archivio:", self.storePathEdit)
+    
+    self.compressionCombo = qt.QComboBox()
+    self.compressionCombo.addItem("zlib", "zlib")
+    self.compressionCombo.addItem("lzma (più lento, più compatto)", "lzma")
+    self.compressionCombo.addItem("Nessuna (memory-mapped)", "none")
+    storeLayout.addRow("Compressione:", self.compressionCombo)
+    
+    storeButtonsLayout = qt.QHBoxLayout()
+    self.saveStoreButton = qt.QPushButton("Salva su disco")
+    self.loadStoreButton = qt.QPushButton("Apri da disco")
+    storeButtonsLayout.addWidget(self.saveStoreButton)
+    storeButtonsLayout.addWidget(self.loadStoreButton)
+    storeLayout.addRow(storeButtonsLayout)
+    
+    self.niftiDirectoryEdit = ctk.ctkPathLineEdit()
+    self.niftiDirectoryEdit.filters = ctk.ctkPathLineEdit.Dirs
+    self.niftiDirectoryEdit.setToolTip("Cartella dei file .nii.gz (un file per frame) e del manifest JSON")
+    storeLayout.addRow("Cartella NIfTI:", self.niftiDirectoryEdit)
+    
+    self.niftiLevelSpinBox = qt.QSpinBox()
+    self.niftiLevelSpinBox.setRange(1, 9)
+    self.niftiLevelSpinBox.setValue(nifti.DEFAULT_GZIP_LEVEL)
+    self.niftiLevelSpinBox.setToolTip("Livello di compressione gzip (1 = più veloce, 9 = più compatto)")
+    storeLayout.addRow("Livello gzip:", self.niftiLevelSpinBox)
+    
+    self.exportNiftiButton = qt.QPushButton("Esporta NIfTI")
+    self.exportNiftiButton.setToolTip("Esporta ogni frame della sequenza in un file .nii.gz, in parallelo")
+    storeLayout.addRow(self.exportNiftiButton)
+    
+    self.layout.addWidget(storeFrame)
+    
     # Connessioni
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.applyButton.connect("clicked(bool)", self.onApply)
+    self.planButton.connect("clicked(bool)", self.onPlan)
+    self.benchmarkButton.connect("clicked(bool)", self.onBenchmark)
+    self.resampleModeCombo.connect("currentIndexChanged(int)", self.updateResampleModeState)
+    self.resampleModeCombo.connect("currentIndexChanged(int)", self.updateSizeEstimate)
+    self.targetSpacingWidget.connect("coordinatesChanged(double*)", self.updateSizeEstimate)
+    self.reductionCombo.connect("currentIndexChanged(int)", self.updateSizeEstimate)
     self.scaleSlider.connect("valueChanged(double)", self.updateSizeEstimate)
     self.bitDepthCombo.connect("currentIndexChanged(int)", self.updateSizeEstimate)
+    self.bitDepthCombo.connect("currentIndexChanged(int)", self.updatePackingState)
+    self.packed12CheckBox.connect("toggled(bool)", self.updateSizeEstimate)
+    self.pyramidCheckBox.connect("toggled(bool)", self.updateSizeEstimate)
+    self.temporalCheckBox.connect("toggled(bool)", self.updatePackingState)
+    self.cropCheckBox.connect("toggled(bool)", self.updateCropState)
+    self.phaseSelectionCombo.connect("currentIndexChanged(int)", self.updatePhaseState)
+    self.cropCheckBox.connect("toggled(bool)", self.updateSizeEstimate)
+    self.saveStoreButton.connect("clicked(bool)", self.onSaveStore)
+    self.loadStoreButton.connect("clicked(bool)", self.onLoadStore)
+    self.exportNiftiButton.connect("clicked(bool)", self.onExportNifti)
+    self.clearFrameCacheButton.connect("clicked(bool)", self.onClearFrameCache)
+    self.updatePackingState()
+    self.updateCropState()
+    self.updateResampleModeState()
+    self.updatePhaseState()
     
     # Aggiungi spazio vuoto alla fine
     self.layout.addStretch(1)
     
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector.currentNode() is not None
+    self.planButton.enabled = self.inputSelector.currentNode() is not None
+    self.benchmarkButton.enabled = self.inputSelector.currentNode() is not None
     
     # Aggiorna nome automatico
     if self.inputSelector.currentNode():
@@ -97,46 +332,157 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     # Aggiorna stima dimensione
     self.updateSizeEstimate()
     
+  def updatePackingState(self):
+    # La codifica temporale salva i residui e non usa l'impacchettamento a 12 bit
+    self.packed12CheckBox.enabled = self.bitDepthCombo.currentData == 12 and not self.temporalCheckBox.checked
+    self.fixedWindowCheckBox.enabled = self.bitDepthCombo.currentData < 16
+    self.residualToleranceSpinBox.enabled = self.temporalCheckBox.checked
+    
+  def updateCropState(self):
+    self.cropSegmentationSelector.enabled = self.cropCheckBox.checked
+    self.cropMarginSlider.enabled = self.cropCheckBox.checked
+    
+  def updatePhaseState(self):
+    mode = self.phaseSelectionCombo.currentData
+    self.phaseStepSpinBox.enabled = mode == phases.SELECTION_STEP
+    self.phaseCountSpinBox.enabled = mode == phases.SELECTION_VOLUME
+    
+  def updateResampleModeState(self):
+    spacingMode = self.resampleModeCombo.currentData == "spacing"
+    self.scaleSlider.enabled = not spacingMode
+    self.targetSpacingWidget.enabled = spacingMode
+    
+  def currentTargetSpacing(self):
+    """Spacing target (IJK) in modalità per asse, None in modalità fattore di scala"""
+    if self.resampleModeCombo.currentData != "spacing":
+      return None
+    return tuple(float(value) for value in self.targetSpacingWidget.coordinates.split(","))
+    
+  def currentParameters(self):
+    """Parametri di ottimizzazione selezionati nell'interfaccia"""
+    return {
+      "scaleFactor": self.scaleSlider.value,
+      "targetSpacing": self.currentTargetSpacing(),
+      "reduction": self.reductionCombo.currentData or None,
+      "bitDepth": self.bitDepthCombo.currentData,
+      "fixedWindow": self.fixedWindowCheckBox.checked,
+      "interpolation": self.interpolationCombo.currentData,
+      "useInMemory": self.inMemoryCheckBox.checked,
+      "workers": self.workersSpinBox.value,
+      "streaming": self.streamingCheckBox.checked,
+      "useFrameCache": self.frameCacheCheckBox.checked,
+      "packed12": self.packed12CheckBox.checked,
+      "temporalEncoding": self.temporalCheckBox.checked,
+      "residualTolerance": self.residualToleranceSpinBox.value,
+      "buildPyramid": self.pyramidCheckBox.checked,
+      "phaseSelection": self.phaseSelectionCombo.currentData or None,
+      "phaseStep": self.phaseStepSpinBox.value,
+      "phaseCount": self.phaseCountSpinBox.value,
+      "cropHeart": self.cropCheckBox.checked,
+      "cropSegmentation": self.cropSegmentationSelector.currentNode(),
+      "cropMarginMm": self.cropMarginSlider.value,
+    }
+    
+  def sequenceScanKey(self, parameters):
+    """Chiave di ritaglio e selezione delle fasi di un piano: dipendono solo dall'input e da questi parametri"""
+    segmentation = parameters["cropSegmentation"]
+    return (self.inputSelector.currentNode().GetID(), parameters["cropHeart"],
+            segmentation.GetID() if segmentation else None, parameters["cropMarginMm"],
+            parameters["phaseSelection"], parameters["phaseStep"], parameters["phaseCount"])
+    
   def updateSizeEstimate(self):
     if not self.inputSelector.currentNode():
       self.sizeLabel.text = "Dimensione stimata: --"
       return
       
     try:
-      inputNode = self.inputSelector.currentNode()
-      
-      # Conta frame e ottieni info volume
-      num_frames = inputNode.GetNumberOfDataNodes()
-      if num_frames == 0:
+      inputNode = CTOptimizerLogic().inputSequence(self.inputSelector.currentNode())
+      if inputNode.GetNumberOfDataNodes() == 0:
         self.sizeLabel.text = "Dimensione stimata: sequenza vuota"
         return
-        
-      # Ottieni dimensioni dal primo frame
-      firstVolume = inputNode.GetNthDataNode(0)
-      if not firstVolume or not firstVolume.IsA("vtkMRMLScalarVolumeNode"):
+      
+      # Dimensioni esatte da tipo scalare e griglia di output reali (senza elaborare frame).
+      # Ritaglio e selezione delle fasi scandiscono tutta la sequenza: solo dall'ultimo piano completo
+      parameters = self.currentParameters()
+      scan = {}
+      if self._sequenceScan is not None and self._sequenceScan[0] == self.sequenceScanKey(parameters):
+        scan = {"cropBox": self._sequenceScan[1], "phaseFrames": self._sequenceScan[2]}
+      plan = CTOptimizerLogic().planOptimization(inputNode, measure=False, **scan, **parameters)
+      if plan["frames"] == 0:
         self.sizeLabel.text = "Dimensione stimata: frame non valido"
         return
       
-      # Calcola dimensioni e fattori
-      dims = firstVolume.GetImageData().GetDimensions()
-      scale_factor = self.scaleSlider.value
-      bit_depth = self.bitDepthCombo.currentData
-      original_bit_depth = 16  # Assumiamo 16-bit per CT
-      
-      # Calcola voxel
-      original_voxels = dims[0] * dims[1] * dims[2] * num_frames
-      new_voxels = original_voxels * (scale_factor ** 3)
-      
-      # Calcola MB
-      original_mb = (original_voxels * original_bit_depth) / (8 * 1024 * 1024)
-      new_mb = (new_voxels * bit_depth) / (8 * 1024 * 1024)
+      original_mb = plan["inputBytes"] / (1024 * 1024)
+      new_mb = plan["outputBytes"] / (1024 * 1024)
       
       # Aggiorna label
       reduction = (1 - (new_mb / original_mb)) * 100
       self.sizeLabel.text = f"Dimensione: {original_mb:.1f} MB → {new_mb:.1f} MB (-{reduction:.1f}%)"
+      if plan["scanSkipped"]:
+        self.sizeLabel.text += " (senza ritaglio/fasi: usare Pianifica)"
       
     except Exception as e:
       self.sizeLabel.text = f"Errore stima: {str(e)}"
+  
+  def onPlan(self):
+    inputNode = self.inputSelector.currentNode()
+    if not inputNode:
+      return
+    
+    try:
+      slicer.app.setOverrideCursor(qt.Qt.WaitCursor)
+      parameters = self.currentParameters()
+      plan = CTOptimizerLogic().planOptimization(
+        inputNode, compression=self.compressionCombo.currentData, **parameters)
+    except Exception as e:
+      slicer.util.errorDisplay(f"Errore pianificazione: {str(e)}")
+      return
+    finally:
+      slicer.app.restoreOverrideCursor()
+    
+    self._sequenceScan = (self.sequenceScanKey(parameters), plan["cropBox"], plan["phaseFrames"])
+    self.updateSizeEstimate()
+    
+    mb = 1024 * 1024
+    shape = plan["outputShapes"][0] if plan["outputShapes"] else None
+    message = (f"Piano di ottimizzazione (dry-run)\n\n"
+               f"Frame: {plan['frames']}\n"
+               f"Ritaglio (IJK): {cropping.boxToString(plan['cropBox']) if plan['cropBox'] else 'nessuno'}\n"
+               f"Dimensioni output (IJK): {tuple(shape[::-1]) if shape else '--'}\n"
+               f"Input: {plan['inputBytes'] / mb:.1f} MB\n"
+               f"Output in memoria: {plan['outputBytes'] / mb:.1f} MB\n"
+               f"Output su disco ({plan['compression']}): {plan['compressedBytes'] / mb:.1f} MB "
+               f"(rapporto {plan['compressionRatio']:.2f}x)\n"
+               f"Picco RAM previsto: {plan['peakRAMBytes'] / mb:.0f} MB\n"
+               f"Tempo previsto: {plan['wallSeconds']:.1f} s "
+               f"({plan['secondsPerFrame']:.2f} s/frame su {len(plan['sampledFrames'])} frame campione)")
+    slicer.util.infoDisplay(message)
+    
+  def onBenchmark(self):
+    inputNode = self.inputSelector.currentNode()
+    if not inputNode:
+      return
+    
+    parameters = self.currentParameters()
+    try:
+      slicer.app.setOverrideCursor(qt.Qt.WaitCursor)
+      results = CTOptimizerLogic().benchmarkResampling(
+        inputNode, scaleFactor=parameters["scaleFactor"], targetSpacing=parameters["targetSpacing"],
+        interpolation=parameters["interpolation"])
+    except Exception as e:
+      slicer.util.errorDisplay(f"Errore confronto: {str(e)}")
+      return
+    finally:
+      slicer.app.restoreOverrideCursor()
+    
+    if not results:
+      slicer.util.infoDisplay("Lo spacing di output coincide con quello di input: nessun ricampionamento")
+      return
+    lines = ["Confronto ricampionamento (primo frame)\n"]
+    for result in results:
+      lines.append(f"{result['method']}: {result['seconds']:.3f} s, {result['megabytesPerSecond']:.0f} MB/s, "
+                   f"RMSE {result['rmse']:.1f} HU, bias media {result['meanBias']:+.2f} HU")
+    slicer.util.infoDisplay("\n".join(lines))
     
   def onApply(self):
     inputNode = self.inputSelector.currentNode()
@@ -146,132 +492,35 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
     self.progressBar.visible = True
     self.progressBar.setValue(0)
     
-    # Lista per tenere traccia dei nodi temporanei da pulire
-    temp_nodes = []
-    
     try:
       # Parametri
-      scale_factor = self.scaleSlider.value
-      bit_depth = self.bitDepthCombo.currentData
       output_name = self.nameEdit.text
       
-      # Crea nodo output
-      outputNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
-      outputNode.SetName(output_name)
-      outputNode.SetIndexType(inputNode.GetIndexType())
-      outputNode.SetIndexName(inputNode.GetIndexName())
-      outputNode.SetIndexUnit(inputNode.GetIndexUnit())
-      
-      # Metadati
-      outputNode.SetAttribute("CTOptimizer_ScaleFactor", str(scale_factor))
-      outputNode.SetAttribute("CTOptimizer_BitDepth", str(bit_depth))
+      logic = CTOptimizerLogic()
+      logic.progressCallback = self.updateProgress
       
-      # Conta frame
-      num_frames = inputNode.GetNumberOfDataNodes()
-      successful_frames = 0
-      
-      # Processa ogni frame
-      for frame_idx in range(num_frames):
-        # Aggiorna progresso
-        progress = frame_idx / num_frames
-        self.progressBar.setValue(int(progress * 100))
-        slicer.app.processEvents()
-        
-        try:
-          # Ottieni frame e indice
-          input_volume = inputNode.GetNthDataNode(frame_idx)
-          if not input_volume or not input_volume.IsA("vtkMRMLScalarVolumeNode"):
-            continue
-              
-          index_value = inputNode.GetNthIndexValue(frame_idx)
-          
-          # Crea volume temporaneo
-          temp_volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-          temp_volume.SetName(f"Temp_{frame_idx}")
-          temp_volume.Copy(input_volume)
-          temp_nodes.append(temp_volume)
-          
-          # PASSO 1: Ridimensionamento se richiesto
-          if scale_factor < 1.0:
-            try:
-              # Usa ResampleScalarVolume CLI
-              resampled_volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-              resampled_volume.SetName(f"Resampled_{frame_idx}")
-              temp_nodes.append(resampled_volume)
-              
-              # Calcola nuovo spacing
-              old_spacing = input_volume.GetSpacing()
-              new_spacing = [s/scale_factor for s in old_spacing]
-              
-              # Parametri CLI
-              params = {}
-              params["inputVolume"] = temp_volume.GetID()
-              params["outputVolume"] = resampled_volume.GetID()
-              params["spacing"] = new_spacing
-              params["interpolationType"] = "linear"
-              
-              # Esegui ricampionamento
-              cliNode = slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, params)
-              temp_nodes.append(cliNode)
-              
-              # Verifica risultato e aggiorna
-              if cliNode.GetStatus() == cliNode.Completed:
-                temp_volume.Copy(resampled_volume)
-            except Exception as e:
-              print(f"Errore ridimensionamento frame {frame_idx}: {str(e)}")
-          
-          # PASSO 2: Riduzione bit depth
-          if bit_depth < 16:
-            try:
-              # Ottieni array
-              array = slicer.util.array(temp_volume.GetID())
-              if array is not None:
-                # Memorizza i valori originali min/max per metadati
-                min_val = np.min(array)
-                max_val = np.max(array)
-                
-                # Converti al nuovo bit depth
-                if bit_depth == 8:
-                  array_norm = ((array - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-                else:  # 12 bit
-                  array_norm = ((array - min_val) / (max_val - min_val) * 4095).astype(np.uint16)
-                
-                # Aggiorna array
-                array[:] = array_norm
-                temp_volume.Modified()
-                
-                # Salva metadati
-                temp_volume.SetAttribute("CTOptimizer_OriginalMin", str(min_val))
-                temp_volume.SetAttribute("CTOptimizer_OriginalMax", str(max_val))
-                temp_volume.SetAttribute("CTOptimizer_BitDepth", str(bit_depth))
-            except Exception as e:
-              print(f"Errore riduzione bit frame {frame_idx}: {str(e)}")
-          
-          # PASSO 3: Aggiungi a sequenza
-          new_volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-          new_volume.Copy(temp_volume)
-          temp_nodes.append(new_volume)
-          
-          outputNode.SetDataNodeAtValue(new_volume, index_value)
-          
-          # Incrementa contatore
-          successful_frames += 1
-          
-        except Exception as e:
-          print(f"Errore elaborazione frame {frame_idx}: {str(e)}")
+      outputNode, successful_frames, num_frames = logic.run(inputNode, output_name, **self.currentParameters())
       
       # Progresso completo
       self.progressBar.setValue(100)
       
       # Crea browser
       try:
-        browser = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
-        browser.SetName(output_name + "_Browser")
-        slicer.modules.sequences.logic().AddSynchronizedNode(outputNode, None, browser)
-        
-        # Attiva browser
-        slicer.modules.sequences.logic().UpdateProxyNodesFromSequences(browser)
-        slicer.modules.sequences.logic().UpdateAllProxyNodes()
+        if logic.pyramidSequences(outputNode):
+          # Riproduzione sul livello ridotto, risoluzione piena a riproduzione ferma
+          browser = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode", output_name + "_Browser")
+          logic.setupPreviewBrowser(outputNode, browser)
+        elif logic.isEncodedSequence(outputNode):
+          # I frame impacchettati o residui vengono decodificati solo quando selezionati
+          logic.setupPackedSequenceBrowser(outputNode, output_name + "_Browser")
+        else:
+          browser = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
+          browser.SetName(output_name + "_Browser")
+          slicer.modules.sequences.logic().AddSynchronizedNode(outputNode, None, browser)
+          
+          # Attiva browser
+          slicer.modules.sequences.logic().UpdateProxyNodesFromSequences(browser)
+          slicer.modules.sequences.logic().UpdateAllProxyNodes()
         slicer.util.selectModule("Sequences")
       except Exception as e:
         print(f"Errore creazione browser: {str(e)}")
@@ -282,20 +531,1603 @@ class CTOptimizerWidget(ScriptedLoadableModuleWidget):
       else:
         message = f"Ottimizzazione parziale!\n\nSequenza: {output_name}\nFrame elaborati: {successful_frames}/{num_frames}"
       
+      stats = logic.lastRunStats
+      message += f"\nTempo: {stats['elapsedSeconds']:.1f} s"
+      if stats.get("peakRSS"):
+        message += f"\nPicco memoria (RSS): {stats['peakRSS'] / (1024 * 1024):.0f} MB"
+      
       slicer.util.infoDisplay(message)
       
     except Exception as e:
       slicer.util.errorDisplay(f"Errore generale: {str(e)}")
     finally:
-      # Pulizia: rimuove tutti i nodi temporanei
+      self.progressBar.visible = False
+  
+  def updateProgress(self, progress):
+    self.progressBar.setValue(int(progress))
+    slicer.app.processEvents()
+  
+  def onSaveStore(self):
+    sequenceNode = self.storeSequenceSelector.currentNode()
+    path = self.storePathEdit.currentPath
+    if not sequenceNode or not path:
+      slicer.util.errorDisplay("Seleziona una sequenza e un file di destinazione")
+      return
+    if not path.lower().endswith(".ct4d"):
+      path += ".ct4d"
+    
+    self.progressBar.visible = True
+    try:
+      logic = CTOptimizerLogic()
+      logic.progressCallback = self.updateProgress
+      logic.saveOptimizedSequence(sequenceNode, path, compression=self.compressionCombo.currentData)
+      self.storePathEdit.addCurrentPathToHistory()
+      slicer.util.infoDisplay(f"Sequenza salvata in {path}\n\nDimensione: {os.path.getsize(path) / (1024 * 1024):.1f} MB")
+    except Exception as e:
+      slicer.util.errorDisplay(f"Errore salvataggio: {str(e)}")
+    finally:
+      self.progressBar.visible = False
+  
+  def onLoadStore(self):
+    path = self.storePathEdit.currentPath
+    if not path or not os.path.isfile(path):
+      slicer.util.errorDisplay("Seleziona un file .ct4d esistente")
+      return
+    
+    try:
+      logic = CTOptimizerLogic()
+      logic.loadOptimizedSequence(path)
+      self.storePathEdit.addCurrentPathToHistory()
+      slicer.util.selectModule("Sequences")
+    except Exception as e:
+      slicer.util.errorDisplay(f"Errore apertura: {str(e)}")
+  
+  def onClearFrameCache(self):
+    frameCache = CTOptimizerLogic().createFrameCache()
+    freedBytes = frameCache.totalBytes
+    frameCache.clear()
+    slicer.util.infoDisplay(f"Cache dei frame svuotata ({freedBytes / (1024 * 1024):.0f} MB liberati)")
+  
+  def onExportNifti(self):
+    sequenceNode = self.storeSequenceSelector.currentNode()
+    directory = self.niftiDirectoryEdit.currentPath
+    if not sequenceNode or not directory:
+      slicer.util.errorDisplay("Seleziona una sequenza e una cartella di destinazione")
+      return
+    
+    self.progressBar.visible = True
+    try:
+      logic = CTOptimizerLogic()
+      logic.progressCallback = self.updateProgress
+      manifest = logic.exportNifti(sequenceNode, directory, level=self.niftiLevelSpinBox.value)
+      self.niftiDirectoryEdit.addCurrentPathToHistory()
+      totalBytes = sum(entry["bytes"] for entry in manifest["frames"])
+      slicer.util.infoDisplay(f"Esportati {len(manifest['frames'])} frame in {directory}\n\n"
+                              f"Dimensione: {totalBytes / (1024 * 1024):.1f} MB")
+    except Exception as e:
+      slicer.util.errorDisplay(f"Errore esportazione NIfTI: {str(e)}")
+    finally:
+      self.progressBar.visible = False
+
+class CTOptimizerLogic(ScriptedLoadableModuleLogic):
+  """Logica di ottimizzazione dei frame delle sequenze 4D"""
+  
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.progressCallback = None
+    self.lastRunStats = {}
+    self.lazyViewers = []
+    self._memoryTracker = None
+    self._temporalEncoder = None
+    self._frameSelection = None
+    self._frameCache = None
+  
+  def updateProgress(self, progress):
+    """Aggiorna la barra di progresso (0-100)"""
+    if self.progressCallback:
+      self.progressCallback(progress)
+  
+  def run(self, inputNode, outputName, scaleFactor=0.5, bitDepth=12, interpolation="linear",
+          useInMemory=True, workers=1, streaming=True, packed12=False, targetSpacing=None, reduction=None,
+          temporalEncoding=False, residualTolerance=0, fixedWindow=False,
+          phaseSelection=None, phaseStep=2, phaseCount=5, buildPyramid=False,
+          cropHeart=False, cropSegmentation=None, cropMarginMm=cropping.DEFAULT_MARGIN_MM,
+          useFrameCache=False, frameCacheDirectory=None, frameCacheMaxBytes=cache.DEFAULT_MAX_BYTES):
+    """
+    Ottimizza tutti i frame della sequenza di input in una nuova sequenza.
+    Con packed12 e 12 bit i frame sono salvati impacchettati (vedi setupPackedSequenceBrowser).
+    Con temporalEncoding tutti i frame sono quantizzati sullo stesso intervallo e salvati
+    come residui rispetto al primo frame (residui <= residualTolerance azzerati);
+    richiede l'elaborazione in memoria.
+    Con fixedWindow i frame sono quantizzati sulla finestra clinica fissa
+    (quantization.CLINICAL_WINDOW_HU) senza calcolare min/max: la codifica è la stessa in
+    tutti i frame e a 12 bit è senza perdita dentro la finestra.
+    Con targetSpacing (IJK, mm) lo spacing di output è indicato per asse invece che con
+    scaleFactor; con reduction ("mean" o "max") gli assi con fattore di riduzione intero
+    sono ridotti a blocchi e l'interpolazione è usata solo per i fattori non interi.
+    Con cropHeart tutti i frame sono ritagliati prima del ricampionamento su un unico box
+    attorno al cuore (vedi computeCropBox), allargato di cropMarginMm.
+    Con phaseSelection ("step" o "volume") sono elaborati solo telediastole, telesistole e
+    una fase ogni phaseStep oppure phaseCount fasi distribuite per volume (vedi selectPhaseFrames);
+    frame scelti e curva dei volumi sono salvati negli attributi della sequenza.
+    Con buildPyramid ogni frame è salvato anche ridotto 2x e 4x (medie a blocchi) in sequenze
+    collegate, per l'anteprima cine (vedi setupPreviewBrowser).
+    Con workers > 1 i frame vengono elaborati in un pool di processi; in caso di errore
+    del pool si ricade sull'elaborazione seriale (streaming se richiesto).
+    Con useFrameCache i frame elaborati in memoria (streaming o worker) sono salvati in una
+    cache su disco indirizzata per contenuto (vedi createFrameCache): i frame con gli stessi
+    voxel e le stesse opzioni di un'esecuzione precedente non vengono ricalcolati.
+    La sequenza è costruita con la scena in BatchProcessState e le modifiche della
+    sequenza raggruppate (StartModify/EndModify): nodi ed eventi della scena non
+    crescono con il numero di frame (contatori in lastRunStats).
+    Tempo e picco di memoria dell'esecuzione sono salvati in lastRunStats.
+    inputNode può essere anche un MultiVolume (vedi inputSequence).
+    Restituisce (sequenza output, frame elaborati, frame da elaborare).
+    """
+    startTime = time.time()
+    inputNode = self.inputSequence(inputNode)
+    self._memoryTracker = memory.PeakMemoryTracker()
+    
+    cropBox = None
+    if cropHeart:
+      cropBox = self.computeCropBox(inputNode, cropSegmentation, cropMarginMm)
+      if cropBox is None:
+        logging.warning("Regione cardiaca non trovata: i frame non vengono ritagliati")
+    
+    valueRange = None
+    window = quantization.CLINICAL_WINDOW_HU if fixedWindow and bitDepth < 16 else None
+    self._temporalEncoder = None
+    if temporalEncoding:
+      if not useInMemory:
+        logging.warning("La codifica temporale richiede il ricampionamento in memoria: il CLI non viene usato")
+        useInMemory = True
+      packed12 = False
+      # Stessa codifica in tutti i frame: i residui sono differenze di codici confrontabili
+      # (con la finestra fissa è già garantita, senza una lettura preliminare della sequenza)
+      if bitDepth < 16 and window is None:
+        valueRange = self.sequenceValueRange(inputNode, cropBox)
+      self._temporalEncoder = temporal.SequenceEncoder(bitDepth, residualTolerance)
+    
+    phaseInfo = None
+    self._frameSelection = None
+    if phaseSelection:
+      self._frameSelection, phaseInfo = self.selectPhaseFrames(inputNode, phaseSelection, phaseStep, phaseCount, cropBox)
+    
+    options = pipeline.frameOptions(scaleFactor, bitDepth, interpolation, packed12 and bitDepth == 12, valueRange, cropBox,
+                                    targetSpacing, reduction, window, pyramid.DEFAULT_LEVELS if buildPyramid else None)
+    num_frames = len(self.framesToProcess(inputNode))
+    successful_frames = None
+    self._frameCache = self.createFrameCache(frameCacheDirectory, frameCacheMaxBytes) if useFrameCache else None
+    
+    sceneEvents = SceneEventCounter(slicer.mrmlScene)
+    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      outputNode = self.createOutputSequence(inputNode, outputName, options)
+      if temporalEncoding:
+        outputNode.SetAttribute("CTOptimizer_Temporal", temporal.FRAME_DELTA)
+      for name, value in (phaseInfo or {}).items():
+        outputNode.SetAttribute(name, value)
+      
+      # Un solo ModifiedEvent della sequenza al termine invece di uno per frame
+      modifiedSequences = [outputNode] + list(self.pyramidSequences(outputNode).values())
+      wasModified = [sequence.StartModify() for sequence in modifiedSequences]
+      try:
+        if workers > 1 and useInMemory and num_frames > 1:
+          try:
+            successful_frames = self.processFramesParallel(inputNode, outputNode, options, workers)
+          except Exception as e:
+            logging.warning(f"Elaborazione parallela non riuscita, uso la modalità seriale: {str(e)}")
+            for sequence in modifiedSequences:
+              sequence.RemoveAllDataNodes()
+            if temporalEncoding:
+              self._temporalEncoder = temporal.SequenceEncoder(bitDepth, residualTolerance)
+        
+        if successful_frames is None:
+          if (streaming or temporalEncoding) and useInMemory:
+            successful_frames = self.processFramesStreaming(inputNode, outputNode, options)
+          else:
+            successful_frames = self.processFramesSerial(inputNode, outputNode, options, useInMemory)
+      finally:
+        for sequence, modified in zip(modifiedSequences, wasModified):
+          sequence.EndModify(modified)
+    finally:
+      slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+      sceneEvents.stop()
+      self._temporalEncoder = None
+      self._frameSelection = None
+      frameCache, self._frameCache = self._frameCache, None
+    
+    self.lastRunStats = {
+      "elapsedSeconds": time.time() - startTime,
+      "peakRSS": self._memoryTracker.peak(),
+    }
+    self.lastRunStats.update(sceneEvents.stats())
+    if frameCache is not None:
+      self.lastRunStats.update(frameCache.stats())
+      logging.info(f"CTOptimizer: {frameCache.hits} frame letti dalla cache, {frameCache.stores} salvati")
+    logging.info(f"CTOptimizer: {successful_frames}/{num_frames} frame in {self.lastRunStats['elapsedSeconds']:.1f} s, "
+                 f"picco RSS {self.lastRunStats['peakRSS']} byte, {self.lastRunStats['sceneNodesAdded']} nodi aggiunti "
+                 f"alla scena, {self.lastRunStats['sceneEvents']} eventi della scena")
+    return outputNode, successful_frames, num_frames
+  
+  def planOptimization(self, inputNode, scaleFactor=0.5, bitDepth=12, interpolation="linear",
+                       useInMemory=True, workers=1, streaming=True, packed12=False, targetSpacing=None, reduction=None,
+                       temporalEncoding=False, residualTolerance=0, fixedWindow=False,
+                       phaseSelection=None, phaseStep=2, phaseCount=5, buildPyramid=False,
+                       cropHeart=False, cropSegmentation=None, cropMarginMm=cropping.DEFAULT_MARGIN_MM,
+                       useFrameCache=False, compression="zlib", level=6, sampleFrames=2, measure=True,
+                       cropBox=None, phaseFrames=None):
+    """
+    Pianifica l'ottimizzazione senza modificare la scena (dry-run).
+    Legge tipo scalare e dimensioni reali di ogni frame e calcola la griglia di output esatta.
+    Con la codifica temporale le dimensioni in memoria sono quelle senza residui (limite superiore).
+    Con measure=True elabora sampleFrames frame campione per misurare tempo per frame e
+    rapporto di compressione, e stima picco di RAM e tempo totale.
+    La stima non considera la cache dei frame (useFrameCache): è quella di un'esecuzione completa.
+    Ritaglio e selezione delle fasi richiedono una scansione di tutta la sequenza: con
+    measure=False (stima dal vivo) sono presi da cropBox e phaseFrames di un piano
+    precedente se forniti, altrimenti sono ignorati e plan["scanSkipped"] è True.
+    """
+    inputNode = self.inputSequence(inputNode)
+    packed12 = packed12 and not temporalEncoding
+    scanSkipped = False
+    if not cropHeart:
+      cropBox = None
+    elif cropBox is None:
+      if measure:
+        cropBox = self.computeCropBox(inputNode, cropSegmentation, cropMarginMm)
+      else:
+        scanSkipped = True
+    window = quantization.CLINICAL_WINDOW_HU if fixedWindow and bitDepth < 16 else None
+    options = pipeline.frameOptions(scaleFactor, bitDepth, interpolation, packed12 and bitDepth == 12, cropBox=cropBox,
+                                    targetSpacing=targetSpacing, reduction=reduction, window=window,
+                                    pyramidLevels=pyramid.DEFAULT_LEVELS if buildPyramid else None)
+    selectedFrames = phaseFrames if phaseSelection else None
+    if phaseSelection and selectedFrames is None:
+      if measure:
+        selectedFrames, _ = self.selectPhaseFrames(inputNode, phaseSelection, phaseStep, phaseCount, cropBox)
+      else:
+        scanSkipped = True
+    
+    frames = []
+    for frame_idx in selectedFrames if selectedFrames is not None else range(inputNode.GetNumberOfDataNodes()):
+      volume = inputNode.GetNthDataNode(frame_idx)
+      if not volume or not volume.IsA("vtkMRMLScalarVolumeNode") or not volume.GetImageData():
+        continue
+      frameArray = self.inputFrameArray(inputNode, frame_idx, volume)
+      itemsize = frameArray.itemsize
+      inputShape = frameArray.shape
+      croppedShape = inputShape
+      frameBox = cropping.clipBox(cropBox, inputShape) if cropBox is not None else None
+      if frameBox is not None:
+        croppedShape = cropping.boxShape(frameBox)
+      
+      outputShape = croppedShape
+      resampler = pipeline.frameResampler(croppedShape, volume.GetSpacing(), options)
+      if resampler is not None:
+        outputShape = resampler.outputShape
+      
+      frames.append({
+        "index": frame_idx,
+        "inputShape": inputShape,
+        "inputBytes": int(np.prod(inputShape)) * itemsize,
+        "outputShape": outputShape,
+        "outputBytes": pipeline.outputFrameBytes(outputShape, itemsize, options),
+        "workingBytes": resampler.peakWorkingBytes(itemsize) if resampler else 0,
+      })
+    
+    plan = {
+      "frames": len(frames),
+      "outputShapes": [frame["outputShape"] for frame in frames],
+      "inputBytes": sum(frame["inputBytes"] for frame in frames),
+      "outputBytes": sum(frame["outputBytes"] for frame in frames),
+      "compression": compression,
+      "cropBox": cropBox,
+      "phaseFrames": selectedFrames,
+      "scanSkipped": scanSkipped,
+    }
+    if not measure or not frames:
+      return plan
+    
+    # Frame campione distribuiti sulla sequenza
+    count = max(1, min(sampleFrames, len(frames)))
+    sampled = sorted(set(int(round(i)) for i in np.linspace(0, len(frames) - 1, count)))
+    
+    seconds = []
+    rawBytes = 0
+    packedBytes = 0
+    for position in sampled:
+      frame_idx = frames[position]["index"]
+      volume = inputNode.GetNthDataNode(frame_idx)
+      startTime = time.perf_counter()
+      _, array, _, _, _ = pipeline.processFrame(frame_idx, self.inputFrameArray(inputNode, frame_idx, volume),
+                                                volume.GetSpacing(), options)
+      # Inserimento in sequenza: una copia del frame di output
+      array.copy()
+      seconds.append(time.perf_counter() - startTime)
+      rawBytes += array.nbytes
+      packedBytes += store.compressedSize(array, compression, level)
+    
+    secondsPerFrame = float(np.mean(seconds))
+    compressionRatio = rawBytes / packedBytes if packedBytes else 1.0
+    
+    # Memoria di lavoro per frame secondo la modalità di esecuzione
+    maxInput = max(frame["inputBytes"] for frame in frames)
+    maxOutput = max(frame["outputBytes"] for frame in frames)
+    maxWorking = max(frame["workingBytes"] for frame in frames) + quantization.DEFAULT_CHUNK_VOXELS * 4
+    parallelRun = workers > 1 and useInMemory and len(frames) > 1
+    if parallelRun:
+      activeWorkers = min(workers, len(frames))
+      # frame in volo nel processo principale + copia di lavoro in ogni worker
+      frameWorkingBytes = 2 * activeWorkers * (maxInput + maxOutput) + activeWorkers * (maxInput + maxWorking + maxOutput)
+    elif streaming and useInMemory:
+      activeWorkers = 1
+      frameWorkingBytes = maxWorking + 2 * maxOutput
+    else:
+      activeWorkers = 1
+      # copia temporanea, ricampionato, copia finale e copia nella sequenza
+      frameWorkingBytes = 2 * maxInput + maxWorking + 2 * maxOutput
+    
+    plan.update({
+      "sampledFrames": [frames[position]["index"] for position in sampled],
+      "secondsPerFrame": secondsPerFrame,
+      "wallSeconds": secondsPerFrame * len(frames) / activeWorkers,
+      "compressionRatio": compressionRatio,
+      "compressedBytes": int(plan["outputBytes"] / compressionRatio),
+      "peakRAMBytes": (memory.currentRSS() or 0) + plan["outputBytes"] + frameWorkingBytes,
+    })
+    return plan
+  
+  def benchmarkResampling(self, inputNode, frameIndex=0, scaleFactor=0.5, targetSpacing=None,
+                          interpolation="linear", repeats=3, includeCLI=True):
+    """
+    Confronta i percorsi di ricampionamento su un frame: media e massimo a blocchi
+    (se almeno un fattore è intero), interpolazione NumPy e CLI ResampleScalarVolume.
+    Per ognuno restituisce tempo migliore su repeats esecuzioni, throughput (MB/s di input)
+    e fedeltà HU rispetto al frame originale (vedi resampling.reconstructionError).
+    """
+    inputNode = self.inputSequence(inputNode)
+    volume = inputNode.GetNthDataNode(frameIndex)
+    array = self.inputFrameArray(inputNode, frameIndex, volume)
+    spacing = volume.GetSpacing()
+    inputMegabytes = array.nbytes / (1024 * 1024)
+    
+    methods = [(f"NumPy {interpolation}", None)]
+    baseOptions = pipeline.frameOptions(scaleFactor, 16, interpolation, targetSpacing=targetSpacing)
+    if not pipeline.needsResampling(spacing, baseOptions):
+      return []
+    outputSpacing = pipeline.outputSpacing(spacing, baseOptions)
+    if any(factor is not None and factor > 1 for factor in integerFactors(spacing, outputSpacing)):
+      methods = [("Media a blocchi", "mean"), ("Massimo a blocchi", "max")] + methods
+    
+    results = []
+    for name, reduction in methods:
+      options = dict(baseOptions, reduction=reduction)
+      resampler = pipeline.frameResampler(array.shape, spacing, options)
+      seconds = []
+      for _ in range(repeats):
+        startTime = time.perf_counter()
+        output = resampler.resample(array)
+        seconds.append(time.perf_counter() - startTime)
+      result = {"method": name, "seconds": min(seconds), "outputShape": output.shape}
+      result.update(reconstructionError(array, output, spacing, resampler.outputSpacing, resampler.voxelOffset))
+      results.append(result)
+    
+    if includeCLI:
+      temp_nodes = []
+      try:
+        input_volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        temp_nodes.append(input_volume)
+        self.copyInputFrame(inputNode, frameIndex, volume, input_volume)
+        output_volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        temp_nodes.append(output_volume)
+        
+        startTime = time.perf_counter()
+        self.resampleVolumeWithCLI(input_volume, output_volume, scaleFactor, interpolation, targetSpacing)
+        elapsed = time.perf_counter() - startTime
+        output = slicer.util.arrayFromVolume(output_volume)
+        result = {"method": "CLI ResampleScalarVolume", "seconds": elapsed, "outputShape": output.shape}
+        result.update(reconstructionError(array, output, spacing, output_volume.GetSpacing()))
+        results.append(result)
+      finally:
+        for node in temp_nodes:
+          slicer.mrmlScene.RemoveNode(node)
+    
+    for result in results:
+      result["megabytesPerSecond"] = inputMegabytes / result["seconds"] if result["seconds"] > 0 else float("inf")
+    return results
+  
+  def inputSequence(self, inputNode):
+    """
+    Frame da ottimizzare con l'interfaccia di una sequenza: la sequenza stessa oppure, per un
+    vtkMRMLMultiVolumeNode, un MultiVolumeFrames i cui frame sono viste delle componenti
+    dell'unica immagine (nessun nodo ExtractFrame, nessuna copia).
+    """
+    if inputNode is None or isinstance(inputNode, MultiVolumeFrames):
+      return inputNode
+    if inputNode.IsA("vtkMRMLMultiVolumeNode"):
+      return MultiVolumeFrames(inputNode)
+    return inputNode
+  
+  def inputFrameArray(self, inputNode, frame_idx, volume):
+    """Voxel (KJI) di un frame di input senza copie: array del volume o vista della componente del MultiVolume"""
+    if isinstance(inputNode, MultiVolumeFrames):
+      return inputNode.frameArray(frame_idx)
+    return slicer.util.arrayFromVolume(volume)
+  
+  def copyInputFrame(self, inputNode, frame_idx, volume, targetVolume):
+    """Copia un frame di input (geometria e voxel) in un volume di lavoro"""
+    if isinstance(inputNode, MultiVolumeFrames):
+      targetVolume.CopyOrientation(volume)
+      slicer.util.updateVolumeFromArray(targetVolume, inputNode.frameArray(frame_idx))
+    else:
+      targetVolume.Copy(volume)
+  
+  def sampleMemory(self):
+    """Campiona la memoria residente per la stima del picco dell'esecuzione corrente"""
+    if self._memoryTracker:
+      self._memoryTracker.sample()
+  
+  def sequenceValueRange(self, inputNode, cropBox=None):
+    """
+    Minimo e massimo (float) dei voxel su tutti i frame della sequenza, nel box se indicato
+    (lettura senza copie); None se la sequenza non contiene volumi
+    """
+    minVal = None
+    maxVal = None
+    inputNode = self.inputSequence(inputNode)
+    for frame_idx in range(inputNode.GetNumberOfDataNodes()):
+      volume = inputNode.GetNthDataNode(frame_idx)
+      if not volume or not volume.IsA("vtkMRMLScalarVolumeNode") or not volume.GetImageData():
+        continue
+      array = self.inputFrameArray(inputNode, frame_idx, volume)
+      frameBox = cropping.clipBox(cropBox, array.shape) if cropBox is not None else None
+      if frameBox is not None:
+        array = cropping.cropArray(array, frameBox)
+      frameMin = array.min()
+      frameMax = array.max()
+      minVal = frameMin if minVal is None else min(minVal, frameMin)
+      maxVal = frameMax if maxVal is None else max(maxVal, frameMax)
+    if minVal is None:
+      return None
+    # Scalari Python: il range finisce nelle opzioni (serializzate in JSON per la cache)
+    return float(minVal), float(maxVal)
+  
+  def bloodPoolCurve(self, inputNode, box=None, downsample=phases.DEFAULT_DOWNSAMPLE):
+    """
+    Volume approssimato del pool ematico (mL) di ogni frame, su viste sottocampionate
+    dei frame nel box del cuore. Restituisce (indici dei frame, valori di indice, volumi).
+    """
+    frameIndices = []
+    indexValues = []
+    volumes = []
+    inputNode = self.inputSequence(inputNode)
+    for frame_idx in range(inputNode.GetNumberOfDataNodes()):
+      volume = inputNode.GetNthDataNode(frame_idx)
+      if not volume or not volume.IsA("vtkMRMLScalarVolumeNode") or not volume.GetImageData():
+        continue
+      frameIndices.append(frame_idx)
+      indexValues.append(inputNode.GetNthIndexValue(frame_idx))
+      volumes.append(phases.bloodPoolVolume(self.inputFrameArray(inputNode, frame_idx, volume), volume.GetSpacing(),
+                                            box, downsample))
+    return frameIndices, indexValues, volumes
+  
+  def selectPhaseFrames(self, inputNode, mode, step=2, phaseCount=5, cropBox=None):
+    """
+    Frame da conservare secondo la curva del volume del pool ematico (vedi phases.selectPhases).
+    La curva è calcolata nel box di ritaglio se indicato, altrimenti nel box del cuore stimato.
+    Restituisce (indici dei frame scelti, attributi della sequenza con scelta e curva).
+    """
+    box = cropBox if cropBox is not None else self.computeCropBox(inputNode)
+    frameIndices, indexValues, volumes = self.bloodPoolCurve(inputNode, box)
+    selected = phases.selectPhases(volumes, mode, step, phaseCount)
+    logging.info(f"CTOptimizer: fasi conservate {[indexValues[position] for position in selected]} "
+                 f"su {len(frameIndices)} frame")
+    return [frameIndices[position] for position in selected], phases.phaseAttributes(
+      mode, frameIndices, indexValues, volumes, selected)
+  
+  def framesToProcess(self, inputNode):
+    """Indici dei frame da elaborare: tutti o solo le fasi scelte nell'esecuzione corrente"""
+    if self._frameSelection is not None:
+      return list(self._frameSelection)
+    return list(range(inputNode.GetNumberOfDataNodes()))
+  
+  def computeCropBox(self, inputNode, segmentationNode=None, marginMm=cropping.DEFAULT_MARGIN_MM,
+                     downsample=cropping.DEFAULT_DOWNSAMPLE):
+    """
+    Box di ritaglio (KJI, griglia del primo frame) comune a tutte le fasi.
+    Con una segmentazione si usano i suoi limiti RAS; altrimenti si uniscono i box del
+    cuore stimati su ogni fase sottocampionata. Restituisce None se il cuore non è trovato.
+    """
+    inputNode = self.inputSequence(inputNode)
+    volumes = []
+    for frame_idx in range(inputNode.GetNumberOfDataNodes()):
+      volume = inputNode.GetNthDataNode(frame_idx)
+      if volume and volume.IsA("vtkMRMLScalarVolumeNode") and volume.GetImageData():
+        volumes.append((frame_idx, volume))
+    if not volumes:
+      return None
+    
+    referenceVolume = volumes[0][1]
+    shape = tuple(referenceVolume.GetImageData().GetDimensions()[::-1])
+    if segmentationNode is not None:
+      box = self.segmentationCropBox(segmentationNode, referenceVolume)
+    else:
+      box = cropping.unionBoxes(
+        cropping.heartBoundingBox(self.inputFrameArray(inputNode, frame_idx, volume), downsample)
+        for frame_idx, volume in volumes)
+    if box is None:
+      return None
+    return cropping.expandBox(box, marginMm, referenceVolume.GetSpacing(), shape)
+  
+  def segmentationCropBox(self, segmentationNode, referenceVolume):
+    """Box (KJI) che contiene i limiti RAS della segmentazione nella griglia del volume"""
+    bounds = [0.0] * 6
+    segmentationNode.GetRASBounds(bounds)
+    if bounds[0] > bounds[1]:
+      return None
+    
+    rasToIjk = vtk.vtkMatrix4x4()
+    referenceVolume.GetRASToIJKMatrix(rasToIjk)
+    corners = np.array([[r, a, s, 1.0] for r in bounds[0:2] for a in bounds[2:4] for s in bounds[4:6]])
+    ijk = corners @ slicer.util.arrayFromVTKMatrix(rasToIjk).T
+    low = np.floor(ijk[:, :3].min(axis=0)).astype(int)
+    high = np.ceil(ijk[:, :3].max(axis=0)).astype(int) + 1
+    box = tuple((int(low[axis]), int(high[axis])) for axis in (2, 1, 0))
+    return cropping.clipBox(box, tuple(referenceVolume.GetImageData().GetDimensions()[::-1]))
+  
+  def voxelOrigin(self, volume, ijk):
+    """Posizione RAS del punto IJK (anche non intero) nella griglia del volume"""
+    ijkToRas = vtk.vtkMatrix4x4()
+    volume.GetIJKToRASMatrix(ijkToRas)
+    return ijkToRas.MultiplyPoint([float(ijk[0]), float(ijk[1]), float(ijk[2]), 1.0])[:3]
+  
+  def outputOrigin(self, volume, options):
+    """
+    Origine RAS del frame di output elaborato da volume: primo voxel del box di ritaglio,
+    spostato al centro del primo blocco in caso di riduzione a blocchi.
+    """
+    shape = tuple(volume.GetImageData().GetDimensions()[::-1])
+    start = [0, 0, 0]
+    frameBox = cropping.clipBox(options["cropBox"], shape) if options["cropBox"] is not None else None
+    if frameBox is not None:
+      shape = cropping.boxShape(frameBox)
+      start = [axis[0] for axis in frameBox[::-1]]
+    offset = pipeline.outputVoxelOffset(shape, volume.GetSpacing(), options)
+    return self.voxelOrigin(volume, [s + o for s, o in zip(start, offset)])
+  
+  def createOutputSequence(self, inputNode, outputName, options):
+    """Crea la sequenza di output con gli stessi indici dell'input"""
+    scaleFactor = options["scaleFactor"]
+    bitDepth = options["bitDepth"]
+    outputNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    outputNode.SetName(outputName)
+    outputNode.SetIndexType(inputNode.GetIndexType())
+    outputNode.SetIndexName(inputNode.GetIndexName())
+    outputNode.SetIndexUnit(inputNode.GetIndexUnit())
+    
+    # Metadati
+    outputNode.SetAttribute("CTOptimizer_ScaleFactor", str(scaleFactor))
+    outputNode.SetAttribute("CTOptimizer_BitDepth", str(bitDepth))
+    if bitDepth < 16:
+      outputNode.SetAttribute("CTOptimizer_StorageType", quantization.storageDtype(bitDepth).name)
+      if options["window"] is not None:
+        outputNode.SetAttribute("CTOptimizer_Quantization", quantization.MODE_WINDOW)
+        outputNode.SetAttribute("CTOptimizer_Window", ",".join(str(value) for value in options["window"]))
+      else:
+        outputNode.SetAttribute("CTOptimizer_Quantization", quantization.MODE_RANGE)
+    if options["packed12"]:
+      outputNode.SetAttribute("CTOptimizer_Packing", packing.PACKING_12BIT)
+    if options["cropBox"] is not None:
+      outputNode.SetAttribute("CTOptimizer_CropBox", cropping.boxToString(options["cropBox"]))
+    if options["targetSpacing"] is not None:
+      outputNode.SetAttribute("CTOptimizer_TargetSpacing", ",".join(str(s) for s in options["targetSpacing"]))
+    if options["reduction"]:
+      outputNode.SetAttribute("CTOptimizer_Reduction", options["reduction"])
+    if options["pyramidLevels"]:
+      self.createPyramidSequences(outputNode, options["pyramidLevels"])
+    return outputNode
+  
+  def processFramesSerial(self, inputNode, outputNode, options, useInMemory=True):
+    """
+    Elabora i frame uno alla volta nel processo principale tramite volumi temporanei
+    fuori dalla scena: solo il fallback CLI aggiunge temporaneamente nodi alla scena.
+    """
+    scaleFactor = options["scaleFactor"]
+    bitDepth = options["bitDepth"]
+    interpolation = options["interpolation"]
+    cropBox = options["cropBox"]
+    frame_indices = self.framesToProcess(inputNode)
+    successful_frames = 0
+    
+    for position, frame_idx in enumerate(frame_indices):
+      self.updateProgress(position / len(frame_indices) * 100)
+      
+      try:
+        # Ottieni frame e indice
+        input_volume = inputNode.GetNthDataNode(frame_idx)
+        if not input_volume or not input_volume.IsA("vtkMRMLScalarVolumeNode"):
+          continue
+            
+        index_value = inputNode.GetNthIndexValue(frame_idx)
+        
+        # Crea volume temporaneo (non registrato nella scena)
+        temp_volume = slicer.vtkMRMLScalarVolumeNode()
+        self.copyInputFrame(inputNode, frame_idx, input_volume, temp_volume)
+        temp_volume.SetName(f"Temp_{frame_idx}")
+        
+        # PASSO 0: Ritaglio del cuore
+        if cropBox is not None:
+          frameBox = cropping.clipBox(cropBox, slicer.util.arrayFromVolume(temp_volume).shape)
+          if frameBox is not None:
+            origin = self.voxelOrigin(temp_volume, [axis[0] for axis in frameBox[::-1]])
+            slicer.util.updateVolumeFromArray(
+              temp_volume, cropping.cropArray(slicer.util.arrayFromVolume(temp_volume), frameBox).copy())
+            temp_volume.SetOrigin(origin)
+        
+        # PASSO 1: Ridimensionamento se richiesto
+        if pipeline.needsResampling(temp_volume.GetSpacing(), options):
+          resampled = False
+          if useInMemory:
+            try:
+              self.resampleVolumeInMemory(temp_volume, temp_volume, scaleFactor, interpolation,
+                                          options["targetSpacing"], options["reduction"])
+              resampled = True
+            except Exception as e:
+              print(f"Errore ricampionamento in memoria frame {frame_idx}, uso il CLI: {str(e)}")
+          
+          if not resampled:
+            try:
+              self.resampleVolumeWithCLI(temp_volume, temp_volume, scaleFactor, interpolation, options["targetSpacing"])
+            except Exception as e:
+              print(f"Errore ridimensionamento frame {frame_idx}: {str(e)}")
+        
+        # PASSO 2: Riduzione bit depth
+        levels = None
+        if bitDepth < 16:
+          try:
+            array = slicer.util.arrayFromVolume(temp_volume)
+            if array is not None:
+              # Codici in un volume uint8/uint16 reale
+              codes, parameters = pipeline.quantizeFrame(array, options)
+              del array
+              
+              # Salva metadati (inclusi scala/offset per ricostruire gli HU)
+              attributes = quantization.frameAttributes(parameters)
+              levels = pipeline.framePyramid(codes, options)
+              if options["packed12"]:
+                attributes.update(pipeline.packedAttributes(codes.shape))
+                codes = packing.pack12(codes).reshape(1, 1, -1)
+              
+              slicer.util.updateVolumeFromArray(temp_volume, codes)
+              for name, value in attributes.items():
+                temp_volume.SetAttribute(name, value)
+          except Exception as e:
+            print(f"Errore riduzione bit frame {frame_idx}: {str(e)}")
+        
+        if levels is None:
+          levels = pipeline.framePyramid(slicer.util.arrayFromVolume(temp_volume), options)
+        
+        # PASSO 3: Aggiungi a sequenza (la sequenza salva una propria copia)
+        sequence_volume = outputNode.SetDataNodeAtValue(temp_volume, index_value)
+        self.addPyramidFrames(outputNode, sequence_volume, index_value, levels)
+        del temp_volume, levels
+        successful_frames += 1
+        self.sampleMemory()
+        
+      except Exception as e:
+        print(f"Errore elaborazione frame {frame_idx}: {str(e)}")
+    
+    return successful_frames
+  
+  def processFramesStreaming(self, inputNode, outputNode, options):
+    """
+    Elabora i frame in streaming: in memoria restano solo il frame di input corrente,
+    letto senza copie dalla sequenza, e il frame di output, rilasciato appena inserito.
+    """
+    frame_indices = self.framesToProcess(inputNode)
+    successful_frames = 0
+    
+    for position, frame_idx in enumerate(frame_indices):
+      self.updateProgress(position / len(frame_indices) * 100)
+      
+      try:
+        input_volume = inputNode.GetNthDataNode(frame_idx)
+        if not input_volume or not input_volume.IsA("vtkMRMLScalarVolumeNode"):
+          continue
+        
+        index_value = inputNode.GetNthIndexValue(frame_idx)
+        input_array = self.inputFrameArray(inputNode, frame_idx, input_volume)
+        _, array, spacing, attributes, levels = self.processFrameCached(
+          frame_idx, input_array, input_volume.GetSpacing(), options)
+        
+        self.addFrameToSequence(outputNode, input_volume, index_value, array, spacing, attributes,
+                                self.outputOrigin(input_volume, options), levels)
+        self.sampleMemory()
+        del input_array, array, levels
+        successful_frames += 1
+        
+      except Exception as e:
+        print(f"Errore elaborazione frame {frame_idx}: {str(e)}")
+    
+    return successful_frames
+  
+  def processFramesParallel(self, inputNode, outputNode, options, workers=None):
+    """
+    Elabora i frame in un pool di processi worker.
+    I risultati vengono inseriti nella sequenza di output in ordine di indice.
+    """
+    workers = workers or parallel.defaultWorkerCount()
+    frame_indices = self.framesToProcess(inputNode)
+    
+    # Frame validi con i relativi valori di indice
+    frames = []
+    for frame_idx in frame_indices:
+      input_volume = inputNode.GetNthDataNode(frame_idx)
+      if input_volume and input_volume.IsA("vtkMRMLScalarVolumeNode"):
+        frames.append((frame_idx, input_volume, inputNode.GetNthIndexValue(frame_idx)))
+    
+    # Il ritaglio avviene prima dell'invio: ai worker arriva solo la regione del cuore
+    cropBox = options["cropBox"]
+    taskOptions = dict(options, cropBox=None)
+    
+    # Chiavi della cache calcolate sul frame intero, come nell'elaborazione in streaming
+    keys = {}
+    if self._frameCache is not None:
+      for frame_idx, input_volume, index_value in frames:
+        keys[frame_idx] = cache.frameKey(self.inputFrameArray(inputNode, frame_idx, input_volume),
+                                         input_volume.GetSpacing(), options)
+    cachedFrames = {frame_idx for frame_idx, key in keys.items() if key in self._frameCache}
+    
+    def tasks():
+      for frame_idx, input_volume, index_value in frames:
+        if frame_idx in cachedFrames:
+          continue
+        array = self.inputFrameArray(inputNode, frame_idx, input_volume)
+        frameBox = cropping.clipBox(cropBox, array.shape) if cropBox is not None else None
+        if frameBox is not None:
+          array = cropping.cropArray(array, frameBox)
+        yield (frame_idx, array, input_volume.GetSpacing(), taskOptions)
+    
+    successful_frames = 0
+    with parallel.createProcessPool(workers, parallel.workerExecutable(slicer.app.slicerHome)) as executor:
+      # Due frame in volo per worker tengono il pool occupato con memoria limitata
+      results = parallel.mapInOrder(executor, pipeline.processFrame, tasks(), 2 * workers)
+      for frame_idx, input_volume, index_value in frames:
+        if frame_idx in cachedFrames:
+          result = self.processFrameCached(frame_idx, self.inputFrameArray(inputNode, frame_idx, input_volume),
+                                           input_volume.GetSpacing(), options, keys[frame_idx])
+        else:
+          result = next(results)
+          if self._frameCache is not None:
+            self._frameCache.put(keys[frame_idx], *result[1:])
+        _, array, spacing, attributes, levels = result
+        self.addFrameToSequence(outputNode, input_volume, index_value, array, spacing, attributes,
+                                self.outputOrigin(input_volume, options), levels)
+        self.sampleMemory()
+        successful_frames += 1
+        self.updateProgress(successful_frames / len(frame_indices) * 100)
+    
+    return successful_frames
+  
+  def createFrameCache(self, directory=None, maxBytes=cache.DEFAULT_MAX_BYTES):
+    """Cache dei frame ottimizzati (predefinita: nella cartella di cache di Slicer)"""
+    return cache.FrameCache(directory or os.path.join(slicer.app.cachePath, "CTOptimizer", "frames"), maxBytes)
+  
+  def processFrameCached(self, frame_idx, array, spacing, options, key=None):
+    """
+    pipeline.processFrame con la cache dei frame attiva durante run: un frame con gli stessi
+    voxel e le stesse opzioni di un'esecuzione precedente è letto dal disco invece che ricalcolato.
+    """
+    if self._frameCache is None:
+      return pipeline.processFrame(frame_idx, array, spacing, options)
+    key = key or cache.frameKey(array, spacing, options)
+    cached = self._frameCache.get(key)
+    if cached is not None:
+      return (frame_idx,) + cached
+    result = pipeline.processFrame(frame_idx, array, spacing, options)
+    self._frameCache.put(key, *result[1:])
+    return result
+  
+  def addFrameToSequence(self, outputNode, referenceVolume, indexValue, array, spacing, attributes, origin=None,
+                         levels=None):
+    """
+    Inserisce un frame elaborato nella sequenza con la geometria del volume di riferimento
+    (e l'origine indicata se il frame è ritagliato o ridotto a blocchi, vedi outputOrigin).
+    La sequenza salva una propria copia del nodo: si inserisce un nodo senza immagine e
+    l'array viene scritto direttamente nella copia interna, senza duplicare il frame.
+    Durante una codifica temporale il frame viene salvato come residuo del riferimento.
+    levels sono i livelli della piramide (vedi pipeline.processFrame), salvati nelle
+    sequenze collegate di pyramidSequences.
+    """
+    if self._temporalEncoder is not None:
+      array, temporalAttributes = self._temporalEncoder.encode(array, indexValue)
+      attributes = dict(attributes, **temporalAttributes)
+    
+    new_volume = slicer.vtkMRMLScalarVolumeNode()
+    new_volume.SetName(referenceVolume.GetName())
+    new_volume.CopyOrientation(referenceVolume)
+    new_volume.SetSpacing(spacing)
+    if origin is not None:
+      new_volume.SetOrigin(origin)
+    for name, value in attributes.items():
+      new_volume.SetAttribute(name, value)
+    
+    sequence_volume = outputNode.SetDataNodeAtValue(new_volume, indexValue)
+    slicer.util.updateVolumeFromArray(sequence_volume, array)
+    if levels:
+      self.addPyramidFrames(outputNode, sequence_volume, indexValue, levels)
+    return sequence_volume
+  
+  def pyramidSequences(self, sequenceNode):
+    """Sequenze dei livelli della piramide collegate alla sequenza (fattore -> sequenza)"""
+    levels = sequenceNode.GetAttribute("CTOptimizer_PyramidLevels")
+    if not levels:
+      return {}
+    result = {}
+    for factor in pyramid.levelsFromString(levels):
+      levelNode = sequenceNode.GetNodeReference(f"CTOptimizerPyramid{factor}")
+      if levelNode:
+        result[factor] = levelNode
+    return result
+  
+  def createPyramidSequences(self, sequenceNode, levels):
+    """Crea le sequenze dei livelli della piramide e le collega alla sequenza"""
+    sequenceNode.SetAttribute("CTOptimizer_PyramidLevels", pyramid.levelsToString(levels))
+    for factor in levels:
+      levelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", f"{sequenceNode.GetName()}_{factor}x")
+      levelNode.SetIndexType(sequenceNode.GetIndexType())
+      levelNode.SetIndexName(sequenceNode.GetIndexName())
+      levelNode.SetIndexUnit(sequenceNode.GetIndexUnit())
+      levelNode.SetAttribute("CTOptimizer_PyramidFactor", str(factor))
+      sequenceNode.SetNodeReferenceID(f"CTOptimizerPyramid{factor}", levelNode.GetID())
+    return self.pyramidSequences(sequenceNode)
+  
+  def addPyramidFrames(self, sequenceNode, frameVolume, indexValue, levels):
+    """
+    Inserisce i livelli ridotti di un frame nelle sequenze della piramide.
+    Ogni livello ha spacing moltiplicato per il fattore e origine al centro del primo blocco;
+    conserva gli attributi di decodifica del frame (i livelli non sono mai impacchettati
+    né residui).
+    """
+    levelSequences = self.pyramidSequences(sequenceNode)
+    spacing = frameVolume.GetSpacing()
+    levelFactors = pyramid.pyramidFactors(self.decodedFrameShape(frameVolume), [factor for factor, _ in levels])
+    for factor, array in levels:
+      levelNode = levelSequences.get(factor)
+      if levelNode is None:
+        continue
+      factors = levelFactors[factor]
+      volume = slicer.vtkMRMLScalarVolumeNode()
+      volume.SetName(frameVolume.GetName())
+      volume.CopyOrientation(frameVolume)
+      volume.SetSpacing([s * f for s, f in zip(spacing, factors)])
+      volume.SetOrigin(self.voxelOrigin(frameVolume, [(f - 1) / 2.0 for f in factors]))
+      for name in ["CTOptimizer_BitDepth", "CTOptimizer_DecodeScale", "CTOptimizer_DecodeOffset",
+                   "CTOptimizer_OriginalMin", "CTOptimizer_OriginalMax", "CTOptimizer_Quantization"]:
+        if frameVolume.GetAttribute(name) is not None:
+          volume.SetAttribute(name, frameVolume.GetAttribute(name))
+      volume.SetAttribute("CTOptimizer_PyramidFactor", str(factor))
+      level_volume = levelNode.SetDataNodeAtValue(volume, indexValue)
+      slicer.util.updateVolumeFromArray(level_volume, array)
+  
+  def decodedFrameShape(self, frameVolume):
+    """Forma KJI dei voxel di un frame della sequenza, anche se impacchettato o residuo"""
+    residual = temporal.parseResidualAttributes(self.nodeAttributes(frameVolume))
+    if residual is not None:
+      return residual[1]
+    packedShape = self.packedFrameShape(frameVolume)
+    if packedShape is not None:
+      return packedShape
+    return slicer.util.arrayFromVolume(frameVolume).shape
+  
+  def isPackedSequence(self, sequenceNode):
+    """Verifica se la sequenza contiene frame a 12 bit impacchettati"""
+    return sequenceNode.GetAttribute("CTOptimizer_Packing") == packing.PACKING_12BIT
+  
+  def isTemporalSequence(self, sequenceNode):
+    """Verifica se la sequenza contiene frame salvati come residui temporali"""
+    return sequenceNode.GetAttribute("CTOptimizer_Temporal") == temporal.FRAME_DELTA
+  
+  def requiresFrameAttributes(self, sequenceNode):
+    """
+    Verifica se la sequenza dipende da attributi dei frame (parametri di decodifica HU, codifica,
+    piramide) che il salvataggio .seq.nrrd non conserva
+    """
+    if self.isEncodedSequence(sequenceNode) or sequenceNode.GetAttribute("CTOptimizer_PyramidLevels"):
+      return True
+    for item in range(sequenceNode.GetNumberOfDataNodes()):
+      frameNode = sequenceNode.GetNthDataNode(item)
+      if frameNode and decoding.decodeParametersFromAttributes(self.nodeAttributes(frameNode)) is not None:
+        return True
+    return False
+  
+  def isEncodedSequence(self, sequenceNode):
+    """Verifica se i frame della sequenza vanno decodificati prima della visualizzazione"""
+    return self.isPackedSequence(sequenceNode) or self.isTemporalSequence(sequenceNode)
+  
+  def packedFrameShape(self, volumeNode):
+    """Forma reale (KJI) di un frame impacchettato, None se il frame non è impacchettato"""
+    if volumeNode.GetAttribute("CTOptimizer_Packing") != packing.PACKING_12BIT:
+      return None
+    return tuple(int(n) for n in volumeNode.GetAttribute("CTOptimizer_PackedShape").split(","))
+  
+  def decodePackedFrame(self, volumeNode, out=None):
+    """Decodifica un frame impacchettato nei codici uint16 a 12 bit"""
+    shape = self.packedFrameShape(volumeNode)
+    if shape is None:
+      raise ValueError(f"Il volume {volumeNode.GetName()} non contiene un frame impacchettato")
+    return packing.unpack12(slicer.util.arrayFromVolume(volumeNode), shape, out=out)
+  
+  def readerFrameAccess(self, reader):
+    """
+    Funzioni (readRaw, rawFormat) di createFrameDecoder che leggono i frame da un
+    file .ct4d aperto con store.StoreReader; (None, None) senza reader
+    """
+    if reader is None:
+      return None, None
+    
+    def readRaw(item, frameNode, out=None):
+      return reader.readFrame(item, out=out)
+    
+    def rawFormat(item, frameNode):
+      return reader.frameShape(item), reader.frameDtype(item)
+    
+    return readRaw, rawFormat
+  
+  def createFrameDecoder(self, sequenceNode, readRaw=None, rawFormat=None):
+    """
+    Crea le funzioni frameFormat e loadFrame di LazySequenceViewer per una sequenza
+    con frame impacchettati, residui temporali o non codificati.
+    readRaw(item, frameNode, out=None) restituisce l'array salvato del frame e
+    rawFormat(item, frameNode) la sua forma e dtype; di default sono letti dal nodo
+    nella sequenza. Il frame di riferimento dei residui è letto una sola volta.
+    """
+    if readRaw is None:
+      def readRaw(item, frameNode, out=None):
+        array = slicer.util.arrayFromVolume(frameNode)
+        if out is None:
+          return array
+        np.copyto(out, array)
+        return out
+    if rawFormat is None:
+      def rawFormat(item, frameNode):
+        array = slicer.util.arrayFromVolume(frameNode)
+        return array.shape, array.dtype
+    
+    referenceCache = {}
+    
+    def referenceFrame(referenceIndexValue):
+      if referenceIndexValue not in referenceCache:
+        item = sequenceNode.GetItemNumberFromIndexValue(referenceIndexValue)
+        referenceCache.clear()
+        referenceCache[referenceIndexValue] = np.array(readRaw(item, sequenceNode.GetNthDataNode(item)))
+      return referenceCache[referenceIndexValue]
+    
+    def frameFormat(item, frameNode):
+      residual = temporal.parseResidualAttributes(self.nodeAttributes(frameNode))
+      if residual is not None:
+        _, shape, dtype, _ = residual
+        return shape, dtype
+      packedShape = self.packedFrameShape(frameNode)
+      if packedShape is not None:
+        return packedShape, np.uint16
+      return rawFormat(item, frameNode)
+    
+    def loadFrame(item, frameNode, out):
+      residual = temporal.parseResidualAttributes(self.nodeAttributes(frameNode))
+      if residual is not None:
+        info, _, _, referenceIndexValue = residual
+        temporal.decodeResidual(referenceFrame(referenceIndexValue), readRaw(item, frameNode), info, out=out)
+      elif self.packedFrameShape(frameNode) is not None:
+        packing.unpack12(readRaw(item, frameNode), out.shape, out=out)
+      else:
+        readRaw(item, frameNode, out=out)
+    
+    return frameFormat, loadFrame
+  
+  def nodeAttributes(self, node):
+    return {name: node.GetAttribute(name) for name in node.GetAttributeNames()}
+  
+  def decodedVolume(self, volumeNode):
+    """
+    Vista HU pigra (decoding.DecodedFrame) di un volume quantizzato da CTOptimizer,
+    ad esempio il volume di visualizzazione di una sequenza ottimizzata.
+    None se il volume non è quantizzato o è un residuo temporale (serve la sequenza).
+    """
+    attributes = self.nodeAttributes(volumeNode)
+    if temporal.parseResidualAttributes(attributes) is not None:
+      return None
+    return decoding.DecodedFrame.fromAttributes(slicer.util.arrayFromVolume(volumeNode), attributes)
+  
+  def iterDecodedFrames(self, sequenceNode, readRaw=None, rawFormat=None):
+    """
+    Genera (valore di indice, vista HU) per i frame di una sequenza ottimizzata, uno alla volta.
+    Per ogni frame sono materializzati solo i codici (spacchettati o ricostruiti dal residuo);
+    i valori HU sono calcolati dalla vista solo per le regioni richieste, quindi la serie 4D
+    non viene mai convertita per intero in virgola mobile. I frame non quantizzati sono
+    restituiti con vista None.
+    """
+    frameFormat, loadFrame = self.createFrameDecoder(sequenceNode, readRaw, rawFormat)
+    for item in range(sequenceNode.GetNumberOfDataNodes()):
+      frameNode = sequenceNode.GetNthDataNode(item)
+      indexValue = sequenceNode.GetNthIndexValue(item)
+      parameters = decoding.decodeParametersFromAttributes(self.nodeAttributes(frameNode))
+      if parameters is None:
+        yield indexValue, None
+        continue
+      shape, dtype = frameFormat(item, frameNode)
+      codes = np.empty(shape, dtype=dtype)
+      loadFrame(item, frameNode, codes)
+      yield indexValue, decoding.DecodedFrame(codes, *parameters)
+  
+  def setupPackedSequenceBrowser(self, sequenceNode, browserName):
+    """
+    Crea un browser per una sequenza codificata (impacchettata o a residui temporali).
+    Il proxy della sequenza non viene aggiornato: il frame selezionato è decodificato
+    in un unico volume di visualizzazione.
+    """
+    browser = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
+    browser.SetName(browserName)
+    browser.SetAndObserveMasterSequenceNodeID(sequenceNode.GetID())
+    browser.SetPlayback(sequenceNode, False)
+    
+    displayVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", sequenceNode.GetName() + "_Decodificato")
+    displayVolume.CreateDefaultDisplayNodes()
+    
+    frameFormat, loadFrame = self.createFrameDecoder(sequenceNode)
+    viewer = LazySequenceViewer(browser, sequenceNode, displayVolume, frameFormat, loadFrame)
+    self.lazyViewers.append(viewer)
+    slicer.util.setSliceViewerLayers(background=displayVolume, fit=True)
+    return viewer
+  
+  def setupPreviewBrowser(self, sequenceNode, browser, reader=None, previewFactor=None):
+    """
+    Collega al browser un visualizzatore di anteprima per una sequenza con piramide
+    (vedi PyramidPreviewViewer). La riproduzione usa il livello previewFactor (predefinito:
+    il più ridotto); con reader (store.StoreReader) i frame a risoluzione piena sono letti
+    dal file .ct4d.
+    """
+    levelSequences = self.pyramidSequences(sequenceNode)
+    if not levelSequences:
+      raise ValueError(f"La sequenza {sequenceNode.GetName()} non ha una piramide di anteprima")
+    previewSequence = levelSequences.get(previewFactor) or levelSequences[max(levelSequences)]
+    
+    browser.SetAndObserveMasterSequenceNodeID(sequenceNode.GetID())
+    browser.SetPlayback(sequenceNode, False)
+    
+    displayVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", sequenceNode.GetName() + "_Anteprima")
+    displayVolume.CreateDefaultDisplayNodes()
+    
+    frameFormat, loadFrame = self.createFrameDecoder(sequenceNode, *self.readerFrameAccess(reader))
+    viewer = PyramidPreviewViewer(browser, sequenceNode, previewSequence, displayVolume, frameFormat, loadFrame)
+    self.lazyViewers.append(viewer)
+    slicer.util.setSliceViewerLayers(background=displayVolume, fit=True)
+    return viewer
+  
+  def saveOptimizedSequence(self, sequenceNode, path, compression="zlib", level=6, chunkSlices=store.DEFAULT_CHUNK_SLICES,
+                            workers=None):
+    """
+    Salva una sequenza di volumi in un file .ct4d a blocchi compressi.
+    I blocchi di ogni frame sono compressi in parallelo su un pool di thread.
+    I livelli della piramide di anteprima sono salvati accanto, in file .ct4d con
+    suffisso _<fattore>x (vedi pyramidStorePath).
+    """
+    sequenceInfo = {
+      "name": sequenceNode.GetName(),
+      "indexName": sequenceNode.GetIndexName(),
+      "indexUnit": sequenceNode.GetIndexUnit(),
+      "indexType": sequenceNode.GetIndexType(),
+      "attributes": {name: sequenceNode.GetAttribute(name) for name in sequenceNode.GetAttributeNames()},
+    }
+    
+    num_frames = sequenceNode.GetNumberOfDataNodes()
+    with store.StoreWriter(path, compression, level, chunkSlices, workers, sequenceInfo) as writer:
+      for frame_idx in range(num_frames):
+        self.updateProgress(frame_idx / num_frames * 100)
+        volume = sequenceNode.GetNthDataNode(frame_idx)
+        if not volume or not volume.IsA("vtkMRMLScalarVolumeNode"):
+          continue
+        
+        ijkToRas = vtk.vtkMatrix4x4()
+        volume.GetIJKToRASMatrix(ijkToRas)
+        writer.addFrame(
+          slicer.util.arrayFromVolume(volume),
+          indexValue=sequenceNode.GetNthIndexValue(frame_idx),
+          name=volume.GetName(),
+          ijkToRAS=slicer.util.arrayFromVTKMatrix(ijkToRas),
+          attributes={name: volume.GetAttribute(name) for name in volume.GetAttributeNames()})
+    
+    for factor, levelNode in self.pyramidSequences(sequenceNode).items():
+      self.saveOptimizedSequence(levelNode, self.pyramidStorePath(path, factor), compression, level, chunkSlices, workers)
+    self.updateProgress(100)
+  
+  def pyramidStorePath(self, path, factor):
+    """Percorso del file .ct4d di un livello della piramide accanto a quello della sequenza"""
+    base, extension = os.path.splitext(path)
+    return f"{base}_{factor}x{extension}"
+  
+  def loadOptimizedSequence(self, path, name=None, lazy=True):
+    """
+    Apre un file .ct4d come sequenza.
+    Con lazy=True la sequenza contiene solo la geometria dei frame: i voxel vengono letti
+    dal disco (e decodificati se impacchettati) solo per il frame selezionato nel browser.
+    Se accanto al file ci sono i livelli della piramide, il browser è di anteprima
+    (vedi setupPreviewBrowser).
+    Restituisce (sequenza, browser).
+    """
+    reader = store.StoreReader(path)
+    name = name or reader.sequenceInfo.get("name") or os.path.splitext(os.path.basename(path))[0]
+    sequenceNode = self.readStoreSequence(reader, name, lazy)
+    sequenceNode.SetAttribute("CTOptimizer_StorePath", path)
+    
+    # Livelli della piramide: piccoli, letti interamente
+    levels = sequenceNode.GetAttribute("CTOptimizer_PyramidLevels")
+    for factor in pyramid.levelsFromString(levels or ""):
+      levelPath = self.pyramidStorePath(path, factor)
+      if os.path.isfile(levelPath):
+        levelNode = self.readStoreSequence(store.StoreReader(levelPath), f"{name}_{factor}x", lazy=False)
+        sequenceNode.SetNodeReferenceID(f"CTOptimizerPyramid{factor}", levelNode.GetID())
+    
+    browser = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode", name + "_Browser")
+    if self.pyramidSequences(sequenceNode):
+      self.setupPreviewBrowser(sequenceNode, browser, reader)
+    elif lazy or self.isEncodedSequence(sequenceNode):
+      self.setupLazyStoreBrowser(sequenceNode, browser, reader)
+    else:
+      slicer.modules.sequences.logic().AddSynchronizedNode(sequenceNode, None, browser)
+      slicer.modules.sequences.logic().UpdateProxyNodesFromSequences(browser)
+    return sequenceNode, browser
+  
+  def readStoreSequence(self, reader, name, lazy=True):
+    """Crea una sequenza dai frame di un file .ct4d (solo geometria e attributi se lazy)"""
+    info = reader.sequenceInfo
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", name)
+    if "indexType" in info:
+      sequenceNode.SetIndexType(info["indexType"])
+    sequenceNode.SetIndexName(info.get("indexName", "time"))
+    sequenceNode.SetIndexUnit(info.get("indexUnit", "s"))
+    for attributeName, value in info.get("attributes", {}).items():
+      sequenceNode.SetAttribute(attributeName, value)
+    
+    for frame_idx in range(reader.frameCount):
+      frameInfo = reader.frameInfo(frame_idx)
+      volume = slicer.vtkMRMLScalarVolumeNode()
+      volume.SetName(frameInfo["name"])
+      ijkToRas = slicer.util.vtkMatrixFromArray(np.array(frameInfo["ijkToRAS"]).reshape(4, 4))
+      volume.SetIJKToRASMatrix(ijkToRas)
+      for attributeName, value in frameInfo["attributes"].items():
+        volume.SetAttribute(attributeName, value)
+      
+      sequence_volume = sequenceNode.SetDataNodeAtValue(volume, frameInfo["indexValue"])
+      if not lazy:
+        array = reader.readFrame(frame_idx)
+        slicer.util.updateVolumeFromArray(sequence_volume, array)
+    return sequenceNode
+  
+  def setupLazyStoreBrowser(self, sequenceNode, browser, reader):
+    """Collega al browser un visualizzatore che legge dal file solo il frame selezionato"""
+    browser.SetAndObserveMasterSequenceNodeID(sequenceNode.GetID())
+    browser.SetPlayback(sequenceNode, False)
+    
+    displayVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", sequenceNode.GetName() + "_Frame")
+    displayVolume.CreateDefaultDisplayNodes()
+    
+    frameFormat, loadFrame = self.createFrameDecoder(sequenceNode, *self.readerFrameAccess(reader))
+    viewer = LazySequenceViewer(browser, sequenceNode, displayVolume, frameFormat, loadFrame)
+    self.lazyViewers.append(viewer)
+    slicer.util.setSliceViewerLayers(background=displayVolume, fit=True)
+    return viewer
+  
+  def exportNifti(self, sequenceNode, outputDirectory, level=nifti.DEFAULT_GZIP_LEVEL, workers=None, prefix=None):
+    """
+    Esporta ogni frame della sequenza in un file .nii.gz con la propria matrice IJK -> RAS.
+    I frame impacchettati o residui sono decodificati nei codici, salvati con scl_slope e
+    scl_inter uguali a scala e offset di decodifica (i lettori NIfTI ricostruiscono gli HU).
+    La compressione gzip gira su un pool di thread con un numero limitato di frame in memoria;
+    per una sequenza aperta in modo lazy i frame sono letti dal file .ct4d.
+    Scrive in outputDirectory il manifest JSON (valore di indice -> file) e lo restituisce.
+    """
+    prefix = prefix or sequenceNode.GetName()
+    num_frames = sequenceNode.GetNumberOfDataNodes()
+    
+    reader = None
+    storePath = sequenceNode.GetAttribute("CTOptimizer_StorePath")
+    firstFrame = sequenceNode.GetNthDataNode(0) if num_frames else None
+    if storePath and firstFrame is not None and firstFrame.GetImageData() is None:
+      reader = store.StoreReader(storePath)
+    frameFormat, loadFrame = self.createFrameDecoder(sequenceNode, *self.readerFrameAccess(reader))
+    
+    def frames():
+      for frame_idx in range(num_frames):
+        self.updateProgress(frame_idx / num_frames * 100)
+        volume = sequenceNode.GetNthDataNode(frame_idx)
+        if not volume or not volume.IsA("vtkMRMLScalarVolumeNode"):
+          continue
+        
+        shape, dtype = frameFormat(frame_idx, volume)
+        array = np.empty(shape, dtype=dtype)
+        loadFrame(frame_idx, volume, array)
+        parameters = decoding.decodeParametersFromAttributes(self.nodeAttributes(volume))
+        scale, offset = parameters[:2] if parameters is not None else (1.0, 0.0)
+        ijkToRas = vtk.vtkMatrix4x4()
+        volume.GetIJKToRASMatrix(ijkToRas)
+        indexValue = sequenceNode.GetNthIndexValue(frame_idx)
+        yield {
+          "indexValue": indexValue,
+          "file": nifti.frameFileName(prefix, frame_idx, num_frames),
+          "array": array,
+          "ijkToRAS": slicer.util.arrayFromVTKMatrix(ijkToRas),
+          "scale": scale,
+          "offset": offset,
+          "description": f"{sequenceNode.GetIndexName()}={indexValue}",
+        }
+    
+    entries = nifti.exportFrames(frames(), outputDirectory, level, workers)
+    manifest = nifti.writeManifest(os.path.join(outputDirectory, nifti.MANIFEST_NAME), entries, {
+      "sequence": sequenceNode.GetName(),
+      "indexName": sequenceNode.GetIndexName(),
+      "indexUnit": sequenceNode.GetIndexUnit(),
+      "gzipLevel": level,
+    })
+    self.updateProgress(100)
+    return manifest
+  
+  def runBatch(self, studies, outputDirectory, manifestPath=None, resume=True, outputFormat="ct4d",
+               compression="zlib", niftiLevel=None, **parameters):
+    """
+    Ottimizza in sequenza più studi 4D senza interfaccia (vedi CTOptimizerLib/batch.py).
+    studies è una cartella o una lista di file di sequenza (.seq.nrrd, .ct4d) e cartelle DICOM;
+    parameters sono gli argomenti di run. Ogni output è salvato in outputDirectory e il
+    manifest JSON, riscritto dopo ogni studio, registra stato, tempi e dimensioni.
+    Con resume gli studi già completati nel manifest vengono saltati.
+    Con niftiLevel ogni output è esportato anche in file .nii.gz, nella cartella <studio>_nifti.
+    I nodi creati per ogni studio sono rimossi dalla scena al termine dello studio.
+    Restituisce il BatchManifest.
+    """
+    if outputFormat not in batch.OUTPUT_FORMATS:
+      raise ValueError(f"Formato di output non supportato: {outputFormat}")
+    if compression not in store.COMPRESSIONS:
+      raise ValueError(f"Compressione non supportata: {compression}")
+    os.makedirs(outputDirectory, exist_ok=True)
+    studies = batch.findStudies(studies)
+    manifest = batch.BatchManifest(manifestPath or os.path.join(outputDirectory, batch.MANIFEST_NAME),
+                                   dict(parameters, outputFormat=outputFormat, compression=compression), resume)
+    
+    for study_idx, study in enumerate(studies):
+      self.updateProgress(study_idx / len(studies) * 100)
+      if resume and manifest.isDone(study):
+        logging.info(f"CTOptimizer batch: {study} già completato, saltato")
+        continue
+      
+      logging.info(f"CTOptimizer batch: studio {study_idx + 1}/{len(studies)} {study}")
+      manifest.start(study)
+      nodeIDsBefore = set(self.sceneNodeIDs())
+      viewerCount = len(self.lazyViewers)
+      timings = {}
+      try:
+        startTime = time.time()
+        inputNode = self.loadStudy(study)
+        timings["loadSeconds"] = time.time() - startTime
+        
+        startTime = time.time()
+        name = batch.studyName(study)
+        outputNode, successful_frames, num_frames = self.run(inputNode, name + "_Ottimizzato", **parameters)
+        timings["optimizeSeconds"] = time.time() - startTime
+        
+        # Attributi di decodifica dei frame e piramide sono salvati solo nel formato .ct4d
+        startTime = time.time()
+        extension = outputFormat
+        if extension != "ct4d" and self.requiresFrameAttributes(outputNode):
+          logging.warning(f"CTOptimizer batch: {name} contiene codici quantizzati, salvato in formato .ct4d")
+          extension = "ct4d"
+        outputPath = os.path.join(outputDirectory, f"{name}.{extension}")
+        if extension == "ct4d":
+          self.saveOptimizedSequence(outputNode, outputPath, compression=compression)
+        elif not slicer.util.saveNode(outputNode, outputPath):
+          raise RuntimeError(f"Salvataggio di {outputPath} non riuscito")
+        timings["saveSeconds"] = time.time() - startTime
+        
+        exportInfo = {}
+        if niftiLevel is not None:
+          startTime = time.time()
+          exportInfo["niftiDirectory"] = os.path.join(outputDirectory, f"{name}_nifti")
+          self.exportNifti(outputNode, exportInfo["niftiDirectory"], level=niftiLevel)
+          timings["niftiSeconds"] = time.time() - startTime
+        
+        manifest.finish(
+          study, output=outputPath, frames=num_frames, processedFrames=successful_frames,
+          inputBytes=self.sequenceBytes(inputNode), outputBytes=os.path.getsize(outputPath),
+          peakRSS=self.lastRunStats.get("peakRSS"), **exportInfo, **timings)
+      except Exception as e:
+        logging.error(f"CTOptimizer batch: errore nello studio {study}: {str(e)}")
+        manifest.fail(study, e, **timings)
+      finally:
+        for viewer in self.lazyViewers[viewerCount:]:
+          viewer.cleanup()
+        del self.lazyViewers[viewerCount:]
+        for nodeID in set(self.sceneNodeIDs()) - nodeIDsBefore:
+          node = slicer.mrmlScene.GetNodeByID(nodeID)
+          if node:
+            slicer.mrmlScene.RemoveNode(node)
+    
+    self.updateProgress(100)
+    logging.info(f"CTOptimizer batch completato: {manifest.summary()}")
+    return manifest
+  
+  def sceneNodeIDs(self):
+    """ID di tutti i nodi presenti nella scena"""
+    return [slicer.mrmlScene.GetNthNode(i).GetID() for i in range(slicer.mrmlScene.GetNumberOfNodes())]
+  
+  def sequenceBytes(self, sequenceNode):
+    """Byte occupati dai voxel di tutti i frame della sequenza"""
+    total = 0
+    for frame_idx in range(sequenceNode.GetNumberOfDataNodes()):
+      volume = sequenceNode.GetNthDataNode(frame_idx)
+      imageData = volume.GetImageData() if volume and volume.IsA("vtkMRMLScalarVolumeNode") else None
+      if imageData:
+        dimensions = imageData.GetDimensions()
+        total += dimensions[0] * dimensions[1] * dimensions[2] * imageData.GetScalarSize() * imageData.GetNumberOfScalarComponents()
+    return total
+  
+  def loadStudy(self, path):
+    """
+    Carica uno studio 4D come sequenza di volumi: file .ct4d, file di sequenza
+    (.seq.nrrd/.seq.nhdr) o cartella DICOM (la sequenza con più frame).
+    """
+    if path.lower().endswith(".ct4d"):
+      sequenceNode, _ = self.loadOptimizedSequence(path, lazy=False)
+      return sequenceNode
+    if not os.path.isdir(path):
+      return slicer.util.loadSequence(path)
+    
+    from DICOMLib import DICOMUtils
+    nodeIDsBefore = set(self.sceneNodeIDs())
+    with DICOMUtils.TemporaryDICOMDatabase() as db:
+      DICOMUtils.importDicom(path, db)
+      for patientUID in db.patients():
+        DICOMUtils.loadPatientByUID(patientUID)
+    sequences = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in set(self.sceneNodeIDs()) - nodeIDsBefore]
+    sequences = [node for node in sequences if node and node.IsA("vtkMRMLSequenceNode")]
+    if not sequences:
+      raise RuntimeError(f"Nessuna sequenza 4D trovata in {path}")
+    return max(sequences, key=lambda node: node.GetNumberOfDataNodes())
+  
+  def resampleVolumeInMemory(self, inputVolume, outputVolume, scaleFactor, interpolation="linear",
+                             targetSpacing=None, reduction=None):
+    """
+    Ricampiona un volume su array NumPy con la stessa griglia del CLI ResampleScalarVolume
+    (spacing diviso per il fattore di scala o pari a targetSpacing, direzioni invariate).
+    Con la riduzione a blocchi l'origine è spostata al centro del primo blocco.
+    inputVolume e outputVolume possono coincidere.
+    """
+    inputArray = slicer.util.arrayFromVolume(inputVolume)
+    options = pipeline.frameOptions(scaleFactor, interpolation=interpolation, targetSpacing=targetSpacing, reduction=reduction)
+    outputSpacing = pipeline.outputSpacing(inputVolume.GetSpacing(), options)
+    resampler = pipeline.getResampler(inputArray.shape, inputVolume.GetSpacing(), outputSpacing, interpolation, reduction)
+    outputArray = resampler.resample(inputArray)
+    origin = self.voxelOrigin(inputVolume, resampler.voxelOffset)
+    
+    if outputVolume is not inputVolume:
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix(ijkToRas)
+      outputVolume.SetIJKToRASMatrix(ijkToRas)
+    
+    slicer.util.updateVolumeFromArray(outputVolume, outputArray)
+    outputVolume.SetSpacing(resampler.outputSpacing)
+    outputVolume.SetOrigin(origin)
+    return outputVolume
+  
+  def resampleVolumeWithCLI(self, inputVolume, outputVolume, scaleFactor, interpolation="linear", targetSpacing=None):
+    """
+    Ricampiona un volume con il CLI ResampleScalarVolume (percorso di fallback).
+    Un volume di input fuori dalla scena vi viene aggiunto solo per la durata del CLI.
+    """
+    temp_nodes = []
+    try:
+      if inputVolume.GetScene() is None:
+        slicer.mrmlScene.AddNode(inputVolume)
+        temp_nodes.append(inputVolume)
+      
+      resampled_volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      temp_nodes.append(resampled_volume)
+      
+      # Calcola nuovo spacing
+      old_spacing = inputVolume.GetSpacing()
+      new_spacing = list(targetSpacing) if targetSpacing is not None else [s/scaleFactor for s in old_spacing]
+      
+      # Parametri CLI (la cubica corrisponde a bspline nel CLI)
+      params = {}
+      params["inputVolume"] = inputVolume.GetID()
+      params["outputVolume"] = resampled_volume.GetID()
+      params["spacing"] = new_spacing
+      params["interpolationType"] = {"nearest": "nearestNeighbor", "cubic": "bspline"}.get(interpolation, interpolation)
+      
+      cliNode = slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, params)
+      temp_nodes.append(cliNode)
+      
+      if cliNode.GetStatus() != cliNode.Completed:
+        raise RuntimeError(f"CLI ResampleScalarVolume terminato con stato {cliNode.GetStatusString()}")
+      
+      outputVolume.Copy(resampled_volume)
+      return outputVolume
+    finally:
       for node in temp_nodes:
         if node and slicer.mrmlScene.IsNodePresent(node):
           slicer.mrmlScene.RemoveNode(node)
-      
-      self.progressBar.visible = False
 
-class CTOptimizerLogic(ScriptedLoadableModuleLogic):
-  pass
+class MultiVolumeFrames:
+  """
+  Frame di un vtkMRMLMultiVolumeNode con l'interfaccia di sequenza usata da CTOptimizerLogic.
+  Il MultiVolume salva tutti i frame come componenti di un'unica vtkImageData: frameArray
+  restituisce la vista NumPy strided della componente (KJI), senza copie. GetNthDataNode
+  restituisce il MultiVolume stesso, usato per nome e geometria (comune a tutti i frame).
+  I valori di indice sono le etichette dei frame (MultiVolume.FrameLabels).
+  """
+  
+  def __init__(self, multiVolumeNode):
+    self.node = multiVolumeNode
+    array = slicer.util.arrayFromVolume(multiVolumeNode)
+    # Un MultiVolume con un solo frame può avere un'immagine a una componente
+    self.array = array if array.ndim == 4 else array[..., np.newaxis]
+    frameCount = self.array.shape[-1]
+    labels = (multiVolumeNode.GetAttribute("MultiVolume.FrameLabels") or "").split(",")
+    if len(labels) != frameCount:
+      labels = [str(frame_idx) for frame_idx in range(frameCount)]
+    self.indexValues = [label.strip() for label in labels]
+  
+  def frameArray(self, frame_idx):
+    return self.array[..., frame_idx]
+  
+  def GetName(self):
+    return self.node.GetName()
+  
+  def GetNumberOfDataNodes(self):
+    return self.array.shape[-1]
+  
+  def GetNthDataNode(self, frame_idx):
+    return self.node
+  
+  def GetNthIndexValue(self, frame_idx):
+    return self.indexValues[frame_idx]
+  
+  def GetIndexName(self):
+    return self.node.GetAttribute("MultiVolume.FrameIdentifyingDICOMTagName") or "frame"
+  
+  def GetIndexUnit(self):
+    return self.node.GetAttribute("MultiVolume.FrameIdentifyingDICOMTagUnits") or ""
+  
+  def GetIndexType(self):
+    try:
+      [float(value) for value in self.indexValues]
+    except ValueError:
+      return slicer.vtkMRMLSequenceNode.TextIndex
+    return slicer.vtkMRMLSequenceNode.NumericIndex
+
+class SceneEventCounter:
+  """
+  Conta nodi aggiunti e rimossi ed eventi della scena durante un'elaborazione,
+  per verificare che restino costanti al crescere del numero di frame.
+  """
+  
+  def __init__(self, scene):
+    self.scene = scene
+    self.nodesAdded = 0
+    self.nodesRemoved = 0
+    self.events = 0
+    self._tags = [
+      scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded),
+      scene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+      scene.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSceneEvent),
+    ]
+  
+  def onNodeAdded(self, caller, event):
+    self.nodesAdded += 1
+    self.events += 1
+  
+  def onNodeRemoved(self, caller, event):
+    self.nodesRemoved += 1
+    self.events += 1
+  
+  def onSceneEvent(self, caller, event):
+    self.events += 1
+  
+  def stop(self):
+    for tag in self._tags:
+      self.scene.RemoveObserver(tag)
+    self._tags = []
+  
+  def stats(self):
+    return {
+      "sceneNodesAdded": self.nodesAdded,
+      "sceneNodesRemoved": self.nodesRemoved,
+      "sceneEvents": self.events,
+    }
+
+class LazySequenceViewer:
+  """
+  Carica su richiesta il frame selezionato nel browser di sequenza in un unico volume
+  di visualizzazione. frameFormat(item, frameNode) restituisce (forma KJI, dtype) del
+  frame decodificato; loadFrame(item, frameNode, out) scrive i voxel nell'array out.
+  """
+  
+  def __init__(self, browserNode, sequenceNode, displayVolume, frameFormat, loadFrame):
+    self.browserNode = browserNode
+    self.sequenceNode = sequenceNode
+    self.displayVolume = displayVolume
+    self.frameFormat = frameFormat
+    self.loadFrame = loadFrame
+    self._selectedItem = None
+    self._observerTag = browserNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onBrowserModified)
+    self.update()
+  
+  def onBrowserModified(self, caller, event):
+    self.update()
+  
+  def update(self):
+    """Carica il frame selezionato se è cambiato dall'ultimo aggiornamento"""
+    item = self.browserNode.GetSelectedItemNumber()
+    if item < 0 or item == self._selectedItem:
+      return
+    self._selectedItem = item
+    
+    frameNode = self.sequenceNode.GetNthDataNode(item)
+    shape, dtype = self.frameFormat(item, frameNode)
+    self.showFrame(frameNode, shape, dtype, lambda target: self.loadFrame(item, frameNode, target))
+  
+  def showFrame(self, frameNode, shape, dtype, load):
+    """Scrive con load(target) i voxel del frame nel volume di visualizzazione e ne copia la geometria"""
+    # Il frame viene scritto direttamente nell'immagine del volume di visualizzazione
+    target = None
+    if self.displayVolume.GetImageData() is not None:
+      target = slicer.util.arrayFromVolume(self.displayVolume)
+    if target is None or target.shape != tuple(shape) or target.dtype != np.dtype(dtype):
+      slicer.util.updateVolumeFromArray(self.displayVolume, np.zeros(shape, dtype=dtype))
+      target = slicer.util.arrayFromVolume(self.displayVolume)
+    load(target)
+    
+    self.displayVolume.CopyOrientation(frameNode)
+    for name in ["CTOptimizer_BitDepth", "CTOptimizer_DecodeScale", "CTOptimizer_DecodeOffset"]:
+      if frameNode.GetAttribute(name) is not None:
+        self.displayVolume.SetAttribute(name, frameNode.GetAttribute(name))
+    slicer.util.arrayFromVolumeModified(self.displayVolume)
+  
+  def cleanup(self):
+    if self._observerTag is not None:
+      self.browserNode.RemoveObserver(self._observerTag)
+      self._observerTag = None
+
+class PyramidPreviewViewer(LazySequenceViewer):
+  """
+  Visualizzatore di anteprima di una sequenza con piramide: durante la riproduzione mostra
+  il frame del livello ridotto previewSequence (copia di pochi voxel), a riproduzione ferma
+  carica il frame selezionato a risoluzione piena (decodificato se necessario).
+  """
+  
+  def __init__(self, browserNode, sequenceNode, previewSequence, displayVolume, frameFormat, loadFrame):
+    self.previewSequence = previewSequence
+    LazySequenceViewer.__init__(self, browserNode, sequenceNode, displayVolume, frameFormat, loadFrame)
+  
+  def update(self):
+    """Carica il livello adatto allo stato di riproduzione se frame o stato sono cambiati"""
+    item = self.browserNode.GetSelectedItemNumber()
+    playing = bool(self.browserNode.GetPlaybackActive())
+    if item < 0 or (item, playing) == self._selectedItem:
+      return
+    self._selectedItem = (item, playing)
+    
+    if not playing:
+      frameNode = self.sequenceNode.GetNthDataNode(item)
+      shape, dtype = self.frameFormat(item, frameNode)
+      self.showFrame(frameNode, shape, dtype, lambda target: self.loadFrame(item, frameNode, target))
+      return
+    
+    previewItem = self.previewSequence.GetItemNumberFromIndexValue(self.sequenceNode.GetNthIndexValue(item))
+    previewNode = self.previewSequence.GetNthDataNode(previewItem) if previewItem >= 0 else None
+    if previewNode is None or previewNode.GetImageData() is None:
+      return
+    array = slicer.util.arrayFromVolume(previewNode)
+    self.showFrame(previewNode, array.shape, array.dtype, lambda target: np.copyto(target, array))
 
 class CTOptimizerTest(ScriptedLoadableModuleTest):
   def setUp(self):
@@ -303,4 +2135,95 @@ class CTOptimizerTest(ScriptedLoadableModuleTest):
   
   def runTest(self):
     self.setUp()
-    self.delayDisplay('Test completato!')
\ No newline at end of file
+    self.test_CTOptimizerRun()
+    self.setUp()
+    self.test_CTOptimizerRunStreamingPacked()
+    self.setUp()
+    self.test_TemporalEncodingRoundTrip()
+    self.delayDisplay('Test completato!')
+  
+  def syntheticSequence(self, frameCount=3, shape=(24, 32, 32), spacing=(0.5, 0.5, 0.6)):
+    """Sequenza sintetica (frame KJI int16) con aria, tessuti molli e pool ematico pulsante"""
+    k, j, i = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center = [n / 2.0 for n in shape]
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", "SequenzaTest")
+    for frame_idx in range(frameCount):
+      radius = 0.2 * min(shape) * (1.0 + 0.2 * np.sin(2.0 * np.pi * frame_idx / frameCount))
+      heart = (k - center[0]) ** 2 + (j - center[1]) ** 2 + (i - center[2]) ** 2 <= radius ** 2
+      array = np.full(shape, 40, dtype=np.int16)
+      array[heart] = 350
+      array[:, :2, :] = -1000
+      volume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      slicer.util.updateVolumeFromArray(volume, array)
+      volume.SetSpacing(spacing)
+      sequenceNode.SetDataNodeAtValue(volume, str(frame_idx))
+      slicer.mrmlScene.RemoveNode(volume)
+    return sequenceNode
+  
+  def test_CTOptimizerRun(self):
+    """Esecuzione in memoria: dimezzamento della griglia e quantizzazione a 12 bit"""
+    self.delayDisplay("Ottimizzazione di una sequenza sintetica")
+    inputNode = self.syntheticSequence()
+    logic = CTOptimizerLogic()
+    outputNode, processed, total = logic.run(inputNode, "SequenzaTest_Ottimizzata", scaleFactor=0.5, bitDepth=12,
+                                             useInMemory=True, workers=1, streaming=False)
+    self.assertEqual((processed, total), (3, 3))
+    self.assertEqual(outputNode.GetNumberOfDataNodes(), 3)
+    self.assertEqual(outputNode.GetAttribute("CTOptimizer_BitDepth"), "12")
+    for frame_idx in range(3):
+      volume = outputNode.GetNthDataNode(frame_idx)
+      self.assertEqual(slicer.util.arrayFromVolume(volume).shape, (12, 16, 16))
+      self.assertEqual(tuple(round(s, 3) for s in volume.GetSpacing()), (1.0, 1.0, 1.2))
+      # I valori decodificati restano nel range HU dell'input
+      values = logic.decodedVolume(volume).toArray()
+      self.assertGreaterEqual(values.min(), -1001.0)
+      self.assertLessEqual(values.max(), 351.0)
+    self.delayDisplay("Esecuzione in memoria completata")
+  
+  def test_CTOptimizerRunStreamingPacked(self):
+    """Esecuzione in streaming con frame a 12 bit impacchettati"""
+    inputNode = self.syntheticSequence(frameCount=2)
+    logic = CTOptimizerLogic()
+    outputNode, processed, total = logic.run(inputNode, "SequenzaTest_Impacchettata", scaleFactor=1.0, bitDepth=12,
+                                             useInMemory=True, workers=1, streaming=True, packed12=True)
+    self.assertEqual((processed, total), (2, 2))
+    self.assertTrue(logic.isPackedSequence(outputNode))
+    self.assertEqual(logic.packedFrameShape(outputNode.GetNthDataNode(0)), (24, 32, 32))
+    frames = list(logic.iterDecodedFrames(outputNode))
+    self.assertEqual(len(frames), 2)
+    for frame_idx, (indexValue, view) in enumerate(frames):
+      self.assertEqual(indexValue, str(frame_idx))
+      self.assertEqual(view.shape, (24, 32, 32))
+      self.assertAlmostEqual(float(view[12, 16, 16]), 350.0, delta=1.0)
+    self.delayDisplay("Esecuzione in streaming completata")
+  
+  def test_TemporalEncodingRoundTrip(self):
+    """Residui temporali a 8/12/16 bit decodificati da createFrameDecoder, mai più grandi dei codici"""
+    logic = CTOptimizerLogic()
+    referenceVolume = slicer.vtkMRMLScalarVolumeNode()
+    for bitDepth in (8, 12, 16):
+      rng = np.random.default_rng(bitDepth)
+      dtype = np.uint8 if bitDepth <= 8 else np.uint16
+      top = (1 << bitDepth) - 1
+      reference = rng.integers(0, top + 1, size=(16, 18, 20)).astype(dtype)
+      small = np.clip(reference.astype(np.int64) + rng.integers(-3, 4, reference.shape), 0, top).astype(dtype)
+      moving = reference.copy()
+      changed = rng.random(reference.shape) < 0.3
+      moving[changed] = rng.integers(0, top + 1, size=int(changed.sum())).astype(dtype)
+      frames = [reference, small, moving]
+      
+      sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", f"Temporale{bitDepth}")
+      logic._temporalEncoder = temporal.SequenceEncoder(bitDepth)
+      for frame_idx, frame in enumerate(frames):
+        logic.addFrameToSequence(sequenceNode, referenceVolume, str(frame_idx), frame, (1.0, 1.0, 1.0), {})
+      logic._temporalEncoder = None
+      
+      frameFormat, loadFrame = logic.createFrameDecoder(sequenceNode)
+      for frame_idx, frame in enumerate(frames):
+        frameNode = sequenceNode.GetNthDataNode(frame_idx)
+        self.assertLessEqual(slicer.util.arrayFromVolume(frameNode).nbytes, frame.nbytes)
+        shape, frameDtype = frameFormat(frame_idx, frameNode)
+        out = np.empty(shape, dtype=frameDtype)
+        loadFrame(frame_idx, frameNode, out)
+        np.testing.assert_array_equal(out, frame)
+    self.delayDisplay("Codifica temporale verificata")
\ No newline at end of file
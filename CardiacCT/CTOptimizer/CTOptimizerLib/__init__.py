@@ -0,0 +1,6 @@
+"""
+Kernel NumPy di supporto per il modulo CTOptimizer.
+
+I moduli di questo pacchetto non importano slicer/vtk/qt, così possono essere
+usati sia dalla logica del modulo sia da processi worker esterni.
+"""
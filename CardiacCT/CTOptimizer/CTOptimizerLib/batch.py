@@ -0,0 +1,204 @@
+"""
+Ottimizzazione batch di studi 4D con manifest JSON riprendibile.
+
+Il modulo non importa slicer al livello principale, così può essere usato come
+script (anche dai processi worker avviati con spawn):
+
+  Slicer --no-main-window --python-script CTOptimizerLib/batch.py \\
+    /dati/studi --output /dati/ottimizzati --scale 0.5 --bit-depth 12 --workers 4
+
+Il manifest (ctoptimizer_manifest.json nella cartella di output) registra per
+ogni studio stato, tempi, dimensioni ed eventuale errore; viene riscritto dopo
+ogni studio, quindi un'esecuzione interrotta riprende dagli studi non completati
+(solo con gli stessi parametri). Le sequenze quantizzate sono sempre salvate in
+formato .ct4d: il formato .seq.nrrd non conserva i parametri di decodifica HU.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from CTOptimizerLib import store
+
+MANIFEST_NAME = "ctoptimizer_manifest.json"
+MANIFEST_VERSION = 1
+
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# File di sequenza riconosciuti; le sottocartelle sono trattate come studi DICOM
+STUDY_EXTENSIONS = (".seq.nrrd", ".seq.nhdr", ".ct4d")
+OUTPUT_FORMATS = ("ct4d", "seq.nrrd")
+
+
+def studyName(path):
+  """Nome dello studio: nome del file o della cartella senza estensioni note"""
+  name = os.path.basename(os.path.normpath(path))
+  for extension in STUDY_EXTENSIONS:
+    if name.lower().endswith(extension):
+      return name[:-len(extension)]
+  return name
+
+
+def findStudies(source):
+  """
+  Elenco ordinato degli studi da una cartella o da una lista di percorsi
+
+  In una cartella sono studi i file con estensione in STUDY_EXTENSIONS e le
+  sottocartelle (DICOM); i percorsi di una lista sono usati così come sono.
+  """
+  if isinstance(source, str):
+    if not os.path.isdir(source):
+      return [os.path.abspath(source)]
+    studies = []
+    for entry in sorted(os.listdir(source)):
+      path = os.path.join(source, entry)
+      if os.path.isdir(path) or entry.lower().endswith(STUDY_EXTENSIONS):
+        studies.append(os.path.abspath(path))
+    return studies
+  return [os.path.abspath(path) for path in source]
+
+
+def jsonParameters(parameters):
+  """Parametri serializzabili in JSON (tuple come liste, altri oggetti come stringhe)"""
+  result = {}
+  for name, value in parameters.items():
+    if isinstance(value, tuple):
+      value = list(value)
+    elif value is not None and not isinstance(value, (bool, int, float, str, list, dict)):
+      value = str(value)
+    result[name] = value
+  return result
+
+
+class BatchManifest:
+  """
+  Stato di un'ottimizzazione batch, salvato in JSON dopo ogni studio
+
+  Un manifest esistente è ripreso solo se è stato creato con gli stessi
+  parametri, altrimenti il costruttore solleva ValueError: gli studi già
+  completati non sarebbero confrontabili con i nuovi.
+  """
+
+  def __init__(self, path, parameters=None, resume=True):
+    self.path = path
+    self.data = None
+    # Stessa forma dei parametri riletti dal file (tuple annidate come liste)
+    parameters = json.loads(json.dumps(jsonParameters(parameters or {})))
+    if resume and os.path.isfile(path):
+      with open(path, "r", encoding="utf-8") as f:
+        self.data = json.load(f)
+      stored = self.data.get("parameters", {})
+      if stored != parameters:
+        changed = sorted(name for name in set(stored) | set(parameters) if stored.get(name) != parameters.get(name))
+        raise ValueError(f"Il manifest {path} è stato creato con parametri diversi ({', '.join(changed)}): "
+                         f"usare un'altra cartella di output o disattivare la ripresa")
+    if self.data is None:
+      self.data = {"version": MANIFEST_VERSION, "studies": {}}
+    self.data["parameters"] = parameters
+
+  def entry(self, study):
+    return self.data["studies"].get(study)
+
+  def isDone(self, study):
+    """Studio già completato con output ancora presente su disco"""
+    entry = self.entry(study)
+    return bool(entry and entry.get("status") == STATUS_DONE and os.path.isfile(entry.get("output", "")))
+
+  def start(self, study):
+    self.data["studies"][study] = {
+      "name": studyName(study),
+      "status": STATUS_RUNNING,
+      "startedAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    self.save()
+
+  def finish(self, study, **info):
+    entry = self.data["studies"][study]
+    entry.update(info)
+    entry["status"] = STATUS_DONE
+    entry.pop("error", None)
+    self.save()
+
+  def fail(self, study, error, **info):
+    entry = self.data["studies"][study]
+    entry.update(info)
+    entry["status"] = STATUS_FAILED
+    entry["error"] = str(error)
+    self.save()
+
+  def summary(self):
+    """Numero di studi per stato"""
+    counts = {}
+    for entry in self.data["studies"].values():
+      counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    return counts
+
+  def save(self):
+    """Scrittura atomica: un'interruzione non lascia mai un manifest troncato"""
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    temporaryPath = self.path + ".tmp"
+    with open(temporaryPath, "w", encoding="utf-8") as f:
+      json.dump(self.data, f, indent=2)
+    os.replace(temporaryPath, self.path)
+
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Ottimizzazione batch di studi CT 4D")
+  parser.add_argument("studies", nargs="+", help="cartella di studi oppure elenco di file/cartelle")
+  parser.add_argument("--output", required=True, help="cartella di output")
+  parser.add_argument("--manifest", help=f"percorso del manifest (predefinito: <output>/{MANIFEST_NAME})")
+  parser.add_argument("--no-resume", action="store_true", help="rielabora anche gli studi già completati")
+  parser.add_argument("--format", choices=OUTPUT_FORMATS, default="ct4d", help="formato di output")
+  parser.add_argument("--compression", default="zlib", choices=store.COMPRESSIONS, help="compressione dei file .ct4d")
+  parser.add_argument("--nifti", action="store_true", help="esporta anche un file .nii.gz per frame")
+  parser.add_argument("--nifti-level", type=int, default=6, choices=range(1, 10), metavar="1-9",
+                      help="livello gzip dei file NIfTI")
+  parser.add_argument("--scale", type=float, default=0.5, help="fattore di scala")
+  parser.add_argument("--spacing", type=float, nargs=3, metavar=("I", "J", "K"), help="spacing target per asse (mm)")
+  parser.add_argument("--reduction", choices=("mean", "max"), help="riduzione a blocchi per fattori interi")
+  parser.add_argument("--interpolation", default="linear", choices=("nearest", "linear", "cubic"))
+  parser.add_argument("--bit-depth", type=int, default=12, choices=(8, 12, 16))
+  parser.add_argument("--window", action="store_true", help="quantizzazione sulla finestra clinica fissa")
+  parser.add_argument("--packed12", action="store_true", help="frame a 12 bit impacchettati")
+  parser.add_argument("--temporal", action="store_true", help="codifica temporale a residui")
+  parser.add_argument("--pyramid", action="store_true", help="salva la piramide di anteprima 2x/4x")
+  parser.add_argument("--phases", choices=("step", "volume"), help="conserva solo ED, ES e le fasi scelte")
+  parser.add_argument("--phase-step", type=int, default=2, help="con --phases step: una fase ogni k")
+  parser.add_argument("--phase-count", type=int, default=5, help="con --phases volume: numero di fasi")
+  parser.add_argument("--crop", action="store_true", help="ritaglio automatico del cuore")
+  parser.add_argument("--cache", action="store_true", help="riusa i frame già ottimizzati (cache su disco)")
+  parser.add_argument("--cache-dir", help="cartella della cache dei frame")
+  parser.add_argument("--cache-size-gb", type=float, default=10.0, help="dimensione massima della cache (GB)")
+  parser.add_argument("--workers", type=int, default=1, help="processi worker per studio")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  """Esegue il batch dai parametri della riga di comando; restituisce il codice di uscita"""
+  args = parseArguments(sys.argv[1:] if argv is None else argv)
+  from CTOptimizer import CTOptimizerLogic
+
+  studies = args.studies[0] if len(args.studies) == 1 else args.studies
+  manifest = CTOptimizerLogic().runBatch(
+    studies, args.output, manifestPath=args.manifest, resume=not args.no_resume,
+    outputFormat=args.format, compression=args.compression, niftiLevel=args.nifti_level if args.nifti else None,
+    scaleFactor=args.scale, targetSpacing=args.spacing, reduction=args.reduction,
+    interpolation=args.interpolation, bitDepth=args.bit_depth, fixedWindow=args.window, packed12=args.packed12,
+    temporalEncoding=args.temporal, phaseSelection=args.phases, phaseStep=args.phase_step,
+    phaseCount=args.phase_count, buildPyramid=args.pyramid, cropHeart=args.crop, workers=args.workers,
+    useFrameCache=args.cache, frameCacheDirectory=args.cache_dir, frameCacheMaxBytes=int(args.cache_size_gb * 1024 ** 3))
+  return 1 if manifest.summary().get(STATUS_FAILED) else 0
+
+
+# Protetto da __main__: con spawn i worker reimportano questo script come __mp_main__
+if __name__ == "__main__":
+  import slicer
+  exitCode = 1
+  try:
+    exitCode = main()
+  finally:
+    slicer.util.exit(exitCode)
@@ -0,0 +1,177 @@
+"""
+Cache su disco dei frame ottimizzati, indirizzata per contenuto.
+
+La chiave di un frame è l'hash dei voxel di input, di forma, dtype e spacing e
+delle opzioni di elaborazione (vedi pipeline.frameOptions: scala o spacing,
+profondità di bit, ritaglio, modalità di quantizzazione, piramide): rieseguire
+l'ottimizzazione con gli stessi parametri dopo un crash o il ricaricamento
+della scena ricalcola solo i frame nuovi o modificati. Ogni voce è un file
+.npz non compresso; le voci meno usate di recente sono eliminate quando la
+cache supera la dimensione massima.
+"""
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+ENTRY_EXTENSION = ".npz"
+
+
+def defaultDirectory():
+  """Cartella predefinita della cache (nella cache dell'utente)"""
+  return os.path.join(os.path.expanduser("~"), ".cache", "CTOptimizer", "frames")
+
+
+def _hasher():
+  # xxh3 è molto più veloce degli hash crittografici; sha1 ha spesso accelerazione hardware
+  if xxhash is not None:
+    return xxhash.xxh3_128()
+  return hashlib.sha1()
+
+
+def _updateWithArray(hasher, array):
+  """
+  Aggiunge all'hash i byte dell'array in ordine C, fetta per fetta
+
+  Le viste non contigue (ad esempio i frame di un MultiVolume) sono copiate una
+  fetta alla volta in un piccolo buffer, senza una copia contigua del frame intero.
+  """
+  if array.ndim == 0 or array.flags.c_contiguous:
+    hasher.update(np.ascontiguousarray(array).data)
+    return
+  buffer = None
+  for k in range(array.shape[0]):
+    slab = array[k]
+    if slab.flags.c_contiguous:
+      hasher.update(slab.data)
+      continue
+    if buffer is None:
+      buffer = np.empty(slab.shape, dtype=array.dtype)
+    np.copyto(buffer, slab)
+    hasher.update(buffer.data)
+
+
+def frameKey(array, spacing, options):
+  """Chiave esadecimale di un frame KJI di input con lo spacing IJK e le opzioni indicate"""
+  hasher = _hasher()
+  description = {
+    "version": CACHE_VERSION,
+    "hash": hasher.name,
+    "shape": [int(n) for n in array.shape],
+    "dtype": array.dtype.str,
+    "spacing": [round(float(s), 6) for s in spacing],
+    "options": options,
+  }
+  hasher.update(json.dumps(description, sort_keys=True).encode("utf-8"))
+  _updateWithArray(hasher, array)
+  return hasher.hexdigest()
+
+
+class FrameCache:
+  """
+  Cache LRU dei risultati di pipeline.processFrame, limitata a maxBytes su disco
+
+  L'ordine di utilizzo è la data di modifica dei file (aggiornata a ogni
+  lettura), così è condiviso tra esecuzioni e processi diversi.
+  """
+
+  def __init__(self, directory=None, maxBytes=DEFAULT_MAX_BYTES):
+    self.directory = directory or defaultDirectory()
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.stores = 0
+    os.makedirs(self.directory, exist_ok=True)
+    self._entries = collections.OrderedDict()
+    self._scan()
+
+  def _scan(self):
+    entries = []
+    for entry in os.scandir(self.directory):
+      if entry.is_file() and entry.name.endswith(ENTRY_EXTENSION):
+        stat = entry.stat()
+        entries.append((stat.st_mtime, entry.name[:-len(ENTRY_EXTENSION)], stat.st_size))
+    for _, key, size in sorted(entries):
+      self._entries[key] = size
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+  @property
+  def totalBytes(self):
+    return sum(self._entries.values())
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries and os.path.isfile(self._path(key))
+
+  def get(self, key):
+    """(array, spacing, attributi, livelli) di un frame in cache, None se assente"""
+    if key not in self._entries:
+      return None
+    path = self._path(key)
+    try:
+      with np.load(path, allow_pickle=False) as data:
+        array = data["array"]
+        spacing = tuple(float(s) for s in data["spacing"])
+        attributes = json.loads(str(data["attributes"]))
+        factors = [int(f) for f in data["levelFactors"]]
+        levels = [(factor, data[f"level{factor}"]) for factor in factors]
+      os.utime(path)
+    except (OSError, ValueError, KeyError):
+      # Voce rimossa da un altro processo o scritta in modo incompleto
+      self._remove(key)
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return array, spacing, attributes, levels
+
+  def put(self, key, array, spacing, attributes, levels=()):
+    """Salva il risultato di un frame (scrittura atomica) ed elimina le voci meno recenti"""
+    path = self._path(key)
+    temporaryPath = f"{path}.{os.getpid()}.tmp"
+    arrays = {f"level{factor}": level for factor, level in levels}
+    with open(temporaryPath, "wb") as f:
+      np.savez(f, array=array, spacing=np.asarray(spacing, dtype=np.float64),
+               attributes=np.asarray(json.dumps(attributes)),
+               levelFactors=np.asarray([factor for factor, _ in levels], dtype=np.int64), **arrays)
+    os.replace(temporaryPath, path)
+    self._entries[key] = os.path.getsize(path)
+    self._entries.move_to_end(key)
+    self.stores += 1
+    self.evict()
+
+  def evict(self, maxBytes=None):
+    """Elimina le voci meno usate di recente finché la cache non supera maxBytes"""
+    maxBytes = self.maxBytes if maxBytes is None else maxBytes
+    total = self.totalBytes
+    while total > maxBytes and self._entries:
+      key, size = self._entries.popitem(last=False)
+      total -= size
+      self._removeFile(key)
+
+  def clear(self):
+    self.evict(0)
+
+  def _remove(self, key):
+    self._entries.pop(key, None)
+    self._removeFile(key)
+
+  def _removeFile(self, key):
+    try:
+      os.remove(self._path(key))
+    except OSError:
+      pass
+
+  def stats(self):
+    return {"cacheHits": self.hits, "cacheStores": self.stores, "cacheEntries": len(self), "cacheBytes": self.totalBytes}
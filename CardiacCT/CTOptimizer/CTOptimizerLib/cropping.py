@@ -0,0 +1,151 @@
+"""
+Ritaglio della regione cardiaca nei frame CT 4D.
+
+Le regioni sono box in ordine KJI ((k0, k1), (j0, j1), (i0, i1)) con estremo
+finale escluso, come gli slice NumPy. Il box del cuore si ottiene da una soglia
+HU sul pool ematico con mezzo di contrasto e dalla componente connessa più
+grande, calcolate su una versione sottocampionata del frame.
+"""
+import numpy as np
+
+# Pool ematico con mezzo di contrasto (esclude aria, grasso, tessuti molli e corticale ossea)
+BLOOD_POOL_HU = (150.0, 600.0)
+DEFAULT_DOWNSAMPLE = 4
+DEFAULT_MARGIN_MM = 10.0
+
+
+def _neighborShifts(mask):
+  """Viste dei 6 vicini di ogni voxel interno (facce), con il nucleo corrispondente"""
+  core = tuple(slice(1, -1) for _ in range(mask.ndim))
+  for axis in range(mask.ndim):
+    for step in (-1, 1):
+      shifted = list(core)
+      shifted[axis] = slice(1 + step, mask.shape[axis] - 1 + step)
+      yield core, tuple(shifted)
+
+
+def erode(mask):
+  """Erosione binaria con connettività 6 (i voxel di bordo sono azzerati)"""
+  if min(mask.shape) < 3:
+    return np.zeros_like(mask)
+  eroded = np.zeros_like(mask)
+  core = tuple(slice(1, -1) for _ in range(mask.ndim))
+  eroded[core] = mask[core]
+  for _, shifted in _neighborShifts(mask):
+    eroded[core] &= mask[shifted]
+  return eroded
+
+
+def _labelByPropagation(mask):
+  """Etichette delle componenti connesse (connettività 6) per propagazione del massimo"""
+  labels = np.where(mask, np.arange(1, mask.size + 1, dtype=np.int32).reshape(mask.shape), 0)
+  padded = np.zeros(tuple(n + 2 for n in mask.shape), dtype=np.int32)
+  core = tuple(slice(1, -1) for _ in range(mask.ndim))
+  while True:
+    padded[core] = labels
+    propagated = labels.copy()
+    for axis in range(mask.ndim):
+      for step in (-1, 1):
+        shifted = list(core)
+        shifted[axis] = slice(1 + step, padded.shape[axis] - 1 + step)
+        np.maximum(propagated, padded[tuple(shifted)], out=propagated)
+    propagated[~mask] = 0
+    if np.array_equal(propagated, labels):
+      return labels
+    labels = propagated
+
+
+def largestComponent(mask):
+  """Maschera della componente connessa più grande (scipy.ndimage se disponibile)"""
+  if not mask.any():
+    return mask
+  try:
+    from scipy import ndimage
+    labels, count = ndimage.label(mask)
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)
+  except ImportError:
+    labels = _labelByPropagation(mask)
+    _, labels = np.unique(labels, return_inverse=True)
+    labels = labels.reshape(mask.shape)
+    sizes = np.bincount(labels.ravel())
+  sizes[0] = 0
+  return labels == np.argmax(sizes)
+
+
+def boxFromMask(mask):
+  """Box minimo che contiene tutti i voxel della maschera, None se vuota"""
+  if not mask.any():
+    return None
+  box = []
+  for axis in range(mask.ndim):
+    otherAxes = tuple(a for a in range(mask.ndim) if a != axis)
+    indices = np.flatnonzero(mask.any(axis=otherAxes))
+    box.append((int(indices[0]), int(indices[-1]) + 1))
+  return tuple(box)
+
+
+def heartBoundingBox(array, downsample=DEFAULT_DOWNSAMPLE, huRange=BLOOD_POOL_HU):
+  """
+  Box del cuore (KJI, voxel a piena risoluzione) stimato su un frame
+
+  La soglia è applicata a una vista con passo downsample (nessuna copia del
+  frame); un'erosione separa il pool ematico da strutture a contatto sottile
+  (colonna, sterno) prima di scegliere la componente più grande.
+  """
+  coarse = array[::downsample, ::downsample, ::downsample]
+  mask = (coarse >= huRange[0]) & (coarse <= huRange[1])
+  eroded = erode(mask)
+  pad = 0
+  if eroded.any():
+    # Un voxel grossolano per lato recupera lo strato rimosso dall'erosione
+    mask = eroded
+    pad = 1
+  box = boxFromMask(largestComponent(mask))
+  if box is None:
+    return None
+  # Il voxel grossolano c è il solo campione c*downsample: la regione può iniziare subito
+  # dopo l'ultimo campione esterno ((start-1)*downsample) e finire subito prima del primo
+  # campione esterno successivo (stop*downsample)
+  return tuple((max(0, (start - pad - 1) * downsample + 1), min((stop + pad) * downsample, n))
+               for (start, stop), n in zip(box, array.shape))
+
+
+def unionBoxes(boxes):
+  """Box che contiene tutti i box forniti (quelli None sono ignorati)"""
+  boxes = [box for box in boxes if box is not None]
+  if not boxes:
+    return None
+  return tuple((min(box[axis][0] for box in boxes), max(box[axis][1] for box in boxes))
+               for axis in range(len(boxes[0])))
+
+
+def expandBox(box, marginMm, spacing, shape):
+  """Allarga il box di marginMm per lato (spacing in ordine IJK) limitandolo alla forma KJI"""
+  expanded = []
+  for axis, ((start, stop), n) in enumerate(zip(box, shape)):
+    margin = int(np.ceil(marginMm / spacing[2 - axis]))
+    expanded.append((max(0, start - margin), min(n, stop + margin)))
+  return tuple(expanded)
+
+
+def clipBox(box, shape):
+  """Limita il box alla forma KJI, None se il risultato è vuoto"""
+  clipped = tuple((max(0, start), min(n, stop)) for (start, stop), n in zip(box, shape))
+  if any(stop <= start for start, stop in clipped):
+    return None
+  return clipped
+
+
+def cropArray(array, box):
+  """Vista (senza copia) della regione box dell'array KJI"""
+  return array[tuple(slice(start, stop) for start, stop in box)]
+
+
+def boxShape(box):
+  """Forma KJI della regione box"""
+  return tuple(stop - start for start, stop in box)
+
+
+def boxToString(box):
+  """Box come stringa 'i0:i1,j0:j1,k0:k1' (ordine IJK) per gli attributi MRML"""
+  return ",".join(f"{start}:{stop}" for start, stop in box[::-1])
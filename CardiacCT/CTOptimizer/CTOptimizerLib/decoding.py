@@ -0,0 +1,170 @@
+"""
+Ricostruzione pigra dei valori HU dai codici quantizzati.
+
+Un frame ottimizzato contiene codici interi; i valori HU si ottengono con
+HU = codice * scala + offset (attributi CTOptimizer_DecodeScale/DecodeOffset,
+oppure CTOptimizer_OriginalMin/OriginalMax e CTOptimizer_BitDepth).
+DecodedFrame decodifica solo la regione richiesta, a blocchi di fette, e le
+soglie HU sono convertite in soglie sui codici: una maschera non richiede mai
+la conversione del frame in virgola mobile.
+"""
+import math
+
+import numpy as np
+
+from . import packing, quantization
+
+DEFAULT_CHUNK_VOXELS = quantization.DEFAULT_CHUNK_VOXELS
+
+
+def decodeParametersFromAttributes(attributes):
+  """
+  (scala, offset, profondità di bit) dagli attributi di un frame (nome -> valore)
+
+  Restituisce None se il frame non è quantizzato da CTOptimizer.
+  """
+  bitDepth = attributes.get("CTOptimizer_BitDepth")
+  if bitDepth is None:
+    return None
+  bitDepth = int(bitDepth)
+  scale = attributes.get("CTOptimizer_DecodeScale")
+  offset = attributes.get("CTOptimizer_DecodeOffset")
+  if scale is not None and offset is not None:
+    return float(scale), float(offset), bitDepth
+  minVal = attributes.get("CTOptimizer_OriginalMin")
+  maxVal = attributes.get("CTOptimizer_OriginalMax")
+  if minVal is None or maxVal is None:
+    return None
+  scale, offset = quantization.decodeParameters(float(minVal), float(maxVal), bitDepth)
+  return scale, offset, bitDepth
+
+
+def decode(codes, scale, offset, out=None, dtype=np.float32, chunkVoxels=DEFAULT_CHUNK_VOXELS):
+  """
+  Valori HU dei codici (in out se fornito), calcolati a blocchi di fette
+
+  Non crea temporanei float64: ogni blocco è convertito direttamente nel dtype
+  di destinazione.
+  """
+  if out is None:
+    out = np.empty(codes.shape, dtype=dtype)
+  if codes.ndim == 0:
+    out[...] = codes * out.dtype.type(scale) + out.dtype.type(offset)
+    return out
+  for slab in quantization._slabs(codes.shape, chunkVoxels):
+    target = out[slab]
+    np.multiply(codes[slab], target.dtype.type(scale), out=target, dtype=target.dtype, casting="unsafe")
+    np.add(target, target.dtype.type(offset), out=target)
+  return out
+
+
+def codeRange(lowerHU, upperHU, scale, offset, bitDepth):
+  """
+  Intervallo di codici [primo, ultimo] con lowerHU <= HU <= upperHU
+
+  Se nessun codice ricade nell'intervallo restituisce primo > ultimo.
+  """
+  levels = (1 << bitDepth) - 1
+
+  def value(code):
+    return code * scale + offset
+
+  first = max(0, math.ceil((lowerHU - offset) / scale))
+  last = min(levels, math.floor((upperHU - offset) / scale))
+  # Corregge gli errori di arrotondamento della divisione
+  while first > 0 and value(first - 1) >= lowerHU:
+    first -= 1
+  while first <= levels and value(first) < lowerHU:
+    first += 1
+  while last < levels and value(last + 1) <= upperHU:
+    last += 1
+  while last >= 0 and value(last) > upperHU:
+    last -= 1
+  return first, last
+
+
+class DecodedFrame:
+  """
+  Vista HU pigra di un frame di codici quantizzati (forma KJI)
+
+  L'indicizzazione decodifica solo la regione selezionata; slabs() restituisce
+  il frame a blocchi di fette riusando un unico buffer e mask() confronta
+  direttamente i codici. Nessun metodo crea una copia float del frame intero,
+  tranne toArray() se non riceve un buffer.
+  """
+
+  def __init__(self, codes, scale, offset, bitDepth, dtype=np.float32):
+    self.codes = codes
+    self.scale = scale
+    self.offset = offset
+    self.bitDepth = bitDepth
+    self.dtype = np.dtype(dtype)
+
+  @classmethod
+  def fromAttributes(cls, array, attributes, dtype=np.float32):
+    """
+    Vista HU di un array salvato con gli attributi indicati, None se non quantizzato
+
+    Gli array impacchettati a 12 bit sono prima spacchettati nei codici uint16.
+    """
+    parameters = decodeParametersFromAttributes(attributes)
+    if parameters is None:
+      return None
+    if attributes.get("CTOptimizer_Packing") == packing.PACKING_12BIT:
+      shape = tuple(int(n) for n in attributes["CTOptimizer_PackedShape"].split(","))
+      array = packing.unpack12(array, shape)
+    return cls(array, *parameters, dtype=dtype)
+
+  @property
+  def shape(self):
+    return self.codes.shape
+
+  @property
+  def ndim(self):
+    return self.codes.ndim
+
+  @property
+  def size(self):
+    return self.codes.size
+
+  def __len__(self):
+    return len(self.codes)
+
+  def __getitem__(self, key):
+    return decode(self.codes[key], self.scale, self.offset, dtype=self.dtype)
+
+  def __array__(self, dtype=None, copy=None):
+    array = self.toArray()
+    return array if dtype is None else array.astype(dtype, copy=False)
+
+  def toArray(self, out=None, chunkVoxels=DEFAULT_CHUNK_VOXELS):
+    """Frame HU completo (in out se fornito)"""
+    return decode(self.codes, self.scale, self.offset, out=out, dtype=self.dtype, chunkVoxels=chunkVoxels)
+
+  def slabs(self, chunkVoxels=DEFAULT_CHUNK_VOXELS):
+    """
+    Blocchi (slice lungo K, valori HU) del frame
+
+    Il buffer dei valori è riusato tra un blocco e il successivo: va copiato se
+    deve sopravvivere all'iterazione.
+    """
+    sliceVoxels = int(np.prod(self.shape[1:]))
+    buffer = np.empty(min(self.size, max(chunkVoxels, sliceVoxels)), dtype=self.dtype)
+    for slab in quantization._slabs(self.shape, chunkVoxels):
+      codes = self.codes[slab]
+      yield slab, decode(codes, self.scale, self.offset, out=buffer[:codes.size].reshape(codes.shape))
+
+  def codeRange(self, lowerHU, upperHU):
+    return codeRange(lowerHU, upperHU, self.scale, self.offset, self.bitDepth)
+
+  def mask(self, lowerHU, upperHU, out=None):
+    """Maschera booleana lowerHU <= HU <= upperHU calcolata sui codici"""
+    first, last = self.codeRange(lowerHU, upperHU)
+    if out is None:
+      out = np.empty(self.shape, dtype=bool)
+    if first > last:
+      out[...] = False
+      return out
+    np.greater_equal(self.codes, first, out=out)
+    out &= self.codes <= last
+    return out
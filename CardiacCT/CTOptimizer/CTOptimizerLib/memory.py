@@ -0,0 +1,63 @@
+"""
+Misura della memoria residente (RSS) del processo.
+"""
+import os
+import sys
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+
+def currentRSS():
+  """Memoria residente attuale in byte (None se non misurabile)"""
+  if psutil is not None:
+    return psutil.Process().memory_info().rss
+  try:
+    with open("/proc/self/statm") as statm:
+      return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+
+def peakRSS():
+  """Picco di memoria residente del processo dall'avvio, in byte (None se non misurabile)"""
+  if resource is not None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+  if psutil is not None:
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss)
+  return None
+
+
+class PeakMemoryTracker:
+  """
+  Stima il picco di RSS durante un'elaborazione.
+
+  Se l'elaborazione alza il picco del processo si usa il valore esatto del
+  sistema operativo, altrimenti il massimo dei campioni presi con sample().
+  """
+
+  def __init__(self):
+    self.startPeak = peakRSS()
+    self.sampledPeak = currentRSS()
+
+  def sample(self):
+    rss = currentRSS()
+    if rss is not None and (self.sampledPeak is None or rss > self.sampledPeak):
+      self.sampledPeak = rss
+
+  def peak(self):
+    self.sample()
+    endPeak = peakRSS()
+    if endPeak is not None and self.startPeak is not None and endPeak > self.startPeak:
+      return endPeak
+    return self.sampledPeak
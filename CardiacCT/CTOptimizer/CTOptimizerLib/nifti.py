@@ -0,0 +1,210 @@
+"""
+Esportazione dei frame in file NIfTI-1 (.nii / .nii.gz) senza dipendenze esterne.
+
+L'intestazione è scritta direttamente: sform e qform descrivono la matrice
+IJK -> RAS del frame (lo spazio mondo NIfTI è RAS come in Slicer), i frame
+quantizzati sono salvati come codici con scl_slope/scl_inter uguali a
+scala/offset di decodifica, così i lettori (nibabel, ITK, TotalSegmentator)
+ricostruiscono i valori HU. Gli array KJI di NumPy hanno già l'ordine dei
+voxel NIfTI (i più veloce) e sono scritti senza trasposizioni.
+"""
+import concurrent.futures
+import gzip
+import json
+import os
+import struct
+
+import numpy as np
+
+from . import parallel
+
+MANIFEST_NAME = "nifti_manifest.json"
+DEFAULT_GZIP_LEVEL = 6
+
+HEADER = struct.Struct("<i10s18sihcB8h3fhhhh8ffffhbBffffii80s24shh3f3f4f4f4f16s4s")
+VOX_OFFSET = HEADER.size + 4
+
+# Codici datatype NIfTI-1 dei dtype supportati
+DATATYPES = {
+  np.dtype(np.uint8): 2,
+  np.dtype(np.int16): 4,
+  np.dtype(np.int32): 8,
+  np.dtype(np.float32): 16,
+  np.dtype(np.float64): 64,
+  np.dtype(np.int8): 256,
+  np.dtype(np.uint16): 512,
+  np.dtype(np.uint32): 768,
+}
+
+NIFTI_XFORM_SCANNER_ANAT = 1
+NIFTI_UNITS_MM = 2
+
+# Fette scritte per chiamata: limita le copie temporanee durante la compressione
+WRITE_SLICES = 16
+
+
+def _quaternion(rotation):
+  """(b, c, d, qfac) di una matrice di direzioni 3x3 con colonne unitarie"""
+  rotation = np.array(rotation, dtype=np.float64)
+  qfac = 1.0
+  if np.linalg.det(rotation) < 0:
+    qfac = -1.0
+    rotation[:, 2] = -rotation[:, 2]
+
+  r = rotation
+  trace = r[0, 0] + r[1, 1] + r[2, 2] + 1.0
+  if trace > 0.5:
+    a = 0.5 * np.sqrt(trace)
+    b = 0.25 * (r[2, 1] - r[1, 2]) / a
+    c = 0.25 * (r[0, 2] - r[2, 0]) / a
+    d = 0.25 * (r[1, 0] - r[0, 1]) / a
+  else:
+    xd = 1.0 + r[0, 0] - (r[1, 1] + r[2, 2])
+    yd = 1.0 + r[1, 1] - (r[0, 0] + r[2, 2])
+    zd = 1.0 + r[2, 2] - (r[0, 0] + r[1, 1])
+    if xd > 1.0:
+      b = 0.5 * np.sqrt(xd)
+      c = 0.25 * (r[0, 1] + r[1, 0]) / b
+      d = 0.25 * (r[0, 2] + r[2, 0]) / b
+      a = 0.25 * (r[2, 1] - r[1, 2]) / b
+    elif yd > 1.0:
+      c = 0.5 * np.sqrt(yd)
+      b = 0.25 * (r[0, 1] + r[1, 0]) / c
+      d = 0.25 * (r[1, 2] + r[2, 1]) / c
+      a = 0.25 * (r[0, 2] - r[2, 0]) / c
+    else:
+      d = 0.5 * np.sqrt(zd)
+      b = 0.25 * (r[0, 2] + r[2, 0]) / d
+      c = 0.25 * (r[1, 2] + r[2, 1]) / d
+      a = 0.25 * (r[1, 0] - r[0, 1]) / d
+    if a < 0:
+      b, c, d = -b, -c, -d
+  return float(b), float(c), float(d), qfac
+
+
+def niftiHeader(shape, dtype, ijkToRAS, scale=1.0, offset=0.0, description=""):
+  """
+  Intestazione NIfTI-1 (348 byte) per un array KJI con la matrice IJK -> RAS 4x4
+
+  scale e offset sono scritti in scl_slope/scl_inter (valore = codice * scale + offset).
+  """
+  dtype = np.dtype(dtype)
+  if dtype.newbyteorder("=") not in DATATYPES:
+    raise ValueError(f"Tipo di dato non supportato da NIfTI: {dtype}")
+  datatype = DATATYPES[dtype.newbyteorder("=")]
+
+  affine = np.asarray(ijkToRAS, dtype=np.float64).reshape(4, 4)
+  spacing = np.linalg.norm(affine[:3, :3], axis=0)
+  b, c, d, qfac = _quaternion(affine[:3, :3] / np.where(spacing > 0, spacing, 1.0))
+
+  dims = [3] + [int(n) for n in shape[::-1]] + [1, 1, 1, 1]
+  pixdim = [qfac] + [float(s) for s in spacing] + [0.0, 0.0, 0.0, 0.0]
+  return HEADER.pack(
+    348, b"", b"", 0, 0, b"r", 0,
+    *dims,
+    0.0, 0.0, 0.0, 0,
+    datatype, dtype.itemsize * 8, 0,
+    *pixdim,
+    float(VOX_OFFSET), float(scale), float(offset),
+    0, 0, NIFTI_UNITS_MM,
+    0.0, 0.0, 0.0, 0.0, 0, 0,
+    description.encode("utf-8")[:79], b"",
+    NIFTI_XFORM_SCANNER_ANAT, NIFTI_XFORM_SCANNER_ANAT,
+    b, c, d,
+    *(float(v) for v in affine[:3, 3]),
+    *(float(v) for v in affine[0]),
+    *(float(v) for v in affine[1]),
+    *(float(v) for v in affine[2]),
+    b"", b"n+1\0")
+
+
+def writeNifti(path, array, ijkToRAS, scale=1.0, offset=0.0, level=DEFAULT_GZIP_LEVEL, description=""):
+  """
+  Scrive un array KJI in un file .nii (o .nii.gz, compresso con il livello gzip indicato)
+
+  Restituisce la dimensione del file in byte.
+  """
+  array = np.asarray(array)
+  if array.dtype.byteorder == ">":
+    array = array.astype(array.dtype.newbyteorder("<"))
+  header = niftiHeader(array.shape, array.dtype, ijkToRAS, scale, offset, description)
+
+  if path.lower().endswith(".gz"):
+    output = gzip.open(path, "wb", compresslevel=level)
+  else:
+    output = open(path, "wb")
+  with output:
+    output.write(header)
+    output.write(b"\0\0\0\0")
+    for start in range(0, array.shape[0], WRITE_SLICES):
+      output.write(np.ascontiguousarray(array[start:start + WRITE_SLICES]).data)
+  return os.path.getsize(path)
+
+
+def readNifti(path):
+  """
+  Legge un file scritto da writeNifti
+
+  Restituisce (array KJI, matrice IJK -> RAS 4x4 da sform, scala, offset).
+  """
+  opener = gzip.open if path.lower().endswith(".gz") else open
+  with opener(path, "rb") as f:
+    data = f.read()
+  fields = HEADER.unpack_from(data)
+  dims = fields[7:15]
+  datatype = fields[19]
+  voxOffset, scale, offset = fields[30:33]
+  srow = fields[52:64]
+  dtype = {code: dtype for dtype, code in DATATYPES.items()}[datatype].newbyteorder("<")
+  shape = tuple(int(n) for n in dims[1:1 + dims[0]])[::-1]
+  array = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=int(voxOffset)).reshape(shape)
+  affine = np.eye(4)
+  affine[:3] = np.array(srow).reshape(3, 4)
+  return array, affine, scale, offset
+
+
+def frameFileName(prefix, position, count):
+  """Nome del file di un frame: prefisso e numero del frame con cifre costanti"""
+  digits = max(3, len(str(max(0, count - 1))))
+  return f"{prefix}_{position:0{digits}d}.nii.gz"
+
+
+def _exportFrame(outputDirectory, level, frame):
+  path = os.path.join(outputDirectory, frame["file"])
+  size = writeNifti(path, frame["array"], frame["ijkToRAS"], frame.get("scale", 1.0), frame.get("offset", 0.0),
+                    level, frame.get("description", ""))
+  return {
+    "indexValue": str(frame["indexValue"]),
+    "file": frame["file"],
+    "shape": [int(n) for n in frame["array"].shape[::-1]],
+    "dtype": np.dtype(frame["array"].dtype).name,
+    "scale": float(frame.get("scale", 1.0)),
+    "offset": float(frame.get("offset", 0.0)),
+    "bytes": size,
+  }
+
+
+def exportFrames(frames, outputDirectory, level=DEFAULT_GZIP_LEVEL, workers=None):
+  """
+  Scrive i frame in un pool di thread (la compressione zlib rilascia il GIL)
+
+  frames è un iterabile di dizionari con indexValue, file, array (KJI), ijkToRAS
+  e facoltativi scale, offset, description; è consumato man mano, con al più
+  due frame in volo per thread. Restituisce le voci del manifest in ordine.
+  """
+  os.makedirs(outputDirectory, exist_ok=True)
+  workers = workers or os.cpu_count() or 1
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    tasks = ((outputDirectory, level, frame) for frame in frames)
+    return list(parallel.mapInOrder(executor, _exportFrame, tasks, 2 * workers))
+
+
+def writeManifest(path, entries, sequenceInfo=None):
+  """Manifest JSON: valori di indice della sequenza -> file NIfTI (scrittura atomica)"""
+  manifest = dict(sequenceInfo or {})
+  manifest["frames"] = entries
+  temporaryPath = path + ".tmp"
+  with open(temporaryPath, "w", encoding="utf-8") as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(temporaryPath, path)
+  return manifest
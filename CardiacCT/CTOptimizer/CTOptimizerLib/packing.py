@@ -0,0 +1,53 @@
+"""
+Codec per voxel a 12 bit impacchettati (due voxel in tre byte).
+
+Per ogni coppia di codici (a, b):
+  byte0 = a & 0xFF
+  byte1 = (a >> 8) | ((b & 0x0F) << 4)
+  byte2 = b >> 4
+"""
+import numpy as np
+
+PACKING_12BIT = "12bit"
+
+
+def packedSize(voxelCount):
+  """Numero di byte necessari per voxelCount codici a 12 bit"""
+  return (voxelCount + 1) // 2 * 3
+
+
+def pack12(codes):
+  """Impacchetta codici 0-4095 (qualsiasi forma) in un array uint8 monodimensionale"""
+  flat = np.ravel(codes)
+  if flat.size % 2:
+    flat = np.append(flat, 0)
+  pairs = flat.astype(np.uint16, copy=False).reshape(-1, 2)
+  a = pairs[:, 0]
+  b = pairs[:, 1]
+
+  packed = np.empty((pairs.shape[0], 3), dtype=np.uint8)
+  packed[:, 0] = a & 0xFF
+  packed[:, 1] = (a >> 8) | ((b & 0x0F) << 4)
+  packed[:, 2] = b >> 4
+  return packed.reshape(-1)
+
+
+def unpack12(packed, shape, out=None):
+  """
+  Ricostruisce i codici uint16 con la forma indicata da un array impacchettato
+
+  out permette di riusare un buffer uint16 già allocato della forma giusta.
+  """
+  voxelCount = int(np.prod(shape))
+  triplets = np.ravel(packed)[:packedSize(voxelCount)].reshape(-1, 3).astype(np.uint16)
+
+  if out is None:
+    out = np.empty(shape, dtype=np.uint16)
+  flat = out.reshape(-1)
+
+  pairCount = voxelCount // 2
+  flat[0:2 * pairCount:2] = triplets[:pairCount, 0] | ((triplets[:pairCount, 1] & 0x0F) << 8)
+  flat[1:2 * pairCount:2] = (triplets[:pairCount, 1] >> 4) | (triplets[:pairCount, 2] << 4)
+  if voxelCount % 2:
+    flat[-1] = triplets[-1, 0] | ((triplets[-1, 1] & 0x0F) << 8)
+  return out
@@ -0,0 +1,62 @@
+"""
+Elaborazione parallela dei frame su un pool di processi worker.
+
+I worker ricevono solo array NumPy e parametri semplici: non hanno accesso
+alla scena MRML, che resta di competenza del processo principale.
+"""
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+
+
+def defaultWorkerCount():
+  """Numero di worker predefinito: tutti i core meno uno per l'interfaccia"""
+  return max(1, (os.cpu_count() or 1) - 1)
+
+
+def workerExecutable(slicerHome=None):
+  """
+  Interprete Python da usare nei processi worker: PythonSlicer accanto all'interprete
+  corrente o nella cartella bin di slicerHome, None se non disponibile
+  """
+  executableName = "PythonSlicer.exe" if os.name == "nt" else "PythonSlicer"
+  directories = [os.path.dirname(sys.executable)]
+  if slicerHome:
+    directories.append(os.path.join(slicerHome, "bin"))
+  for directory in directories:
+    candidate = os.path.join(directory, executableName)
+    if os.path.isfile(candidate):
+      return candidate
+  return None
+
+
+def createProcessPool(workers, executable=None):
+  """
+  Crea un pool di processi con contesto spawn
+
+  executable permette di indicare l'interprete da usare nei worker
+  (in Slicer deve essere PythonSlicer, non l'applicazione).
+  """
+  context = multiprocessing.get_context("spawn")
+  if executable:
+    context.set_executable(executable)
+  return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def mapInOrder(executor, function, tasks, maxPending):
+  """
+  Esegue function(*task) sul pool restituendo i risultati nell'ordine dei task
+
+  Al massimo maxPending task sono in volo contemporaneamente, così la memoria
+  resta limitata anche con sequenze lunghe.
+  """
+  pending = collections.deque()
+  for task in tasks:
+    pending.append(executor.submit(function, *task))
+    if len(pending) >= maxPending:
+      yield pending.popleft().result()
+
+  while pending:
+    yield pending.popleft().result()
@@ -0,0 +1,104 @@
+"""
+Selezione delle fasi cardiache di una sequenza 4D.
+
+Il volume del pool ematico di ogni frame è stimato contando i voxel nella
+soglia HU del sangue con contrasto dentro il box del cuore, su una vista
+sottocampionata del frame (nessuna copia). Dalla curva dei volumi si ricavano
+telediastole (ED, volume massimo) e telesistole (ES, volume minimo) e le fasi
+da conservare.
+"""
+import numpy as np
+
+from . import cropping
+
+SELECTION_STEP = "step"
+SELECTION_VOLUME = "volume"
+SELECTION_MODES = (SELECTION_STEP, SELECTION_VOLUME)
+
+DEFAULT_DOWNSAMPLE = 4
+
+
+def bloodPoolVolume(array, spacing, box=None, downsample=DEFAULT_DOWNSAMPLE, huRange=cropping.BLOOD_POOL_HU):
+  """
+  Volume approssimato (mL) del pool ematico di un frame KJI con lo spacing IJK (mm)
+
+  Conta i voxel nella soglia huRange, nel box se indicato, con passo
+  downsample su ogni asse; ogni voxel contato rappresenta downsample^3 voxel.
+  """
+  if box is not None:
+    box = cropping.clipBox(box, array.shape)
+    if box is not None:
+      array = cropping.cropArray(array, box)
+  coarse = array[::downsample, ::downsample, ::downsample]
+  count = np.count_nonzero((coarse >= huRange[0]) & (coarse <= huRange[1]))
+  voxelMl = float(np.prod(spacing)) * downsample ** 3 / 1000.0
+  return count * voxelMl
+
+
+def endPhases(volumes):
+  """Posizioni (ED, ES) nella curva dei volumi: massimo e minimo"""
+  volumes = np.asarray(volumes, dtype=np.float64)
+  return int(np.argmax(volumes)), int(np.argmin(volumes))
+
+
+def selectEveryK(volumes, step):
+  """ED, ES e una fase ogni step a partire da ED (ciclo chiuso); posizioni ordinate"""
+  count = len(volumes)
+  ed, es = endPhases(volumes)
+  step = max(1, int(step))
+  selected = {ed, es}
+  selected.update((ed + offset) % count for offset in range(0, count, step))
+  return sorted(selected)
+
+
+def selectByVolume(volumes, phaseCount):
+  """
+  ED, ES e phaseCount fasi distribuite uniformemente nello spazio dei volumi
+
+  Le fasi sono equidistanti lungo la variazione cumulativa di volume del ciclo
+  (a partire da ED), così riempimento ed eiezione sono campionati in
+  proporzione alla variazione di volume e non al tempo.
+  """
+  volumes = np.asarray(volumes, dtype=np.float64)
+  count = len(volumes)
+  ed, es = endPhases(volumes)
+  selected = {ed, es}
+
+  # Ordine del ciclo a partire da ED, con ritorno a ED
+  order = (ed + np.arange(count + 1)) % count
+  arcLength = np.concatenate([[0.0], np.cumsum(np.abs(np.diff(volumes[order])))])
+  total = arcLength[-1]
+  if total > 0 and phaseCount > 0:
+    for target in np.linspace(0.0, total, int(phaseCount), endpoint=False):
+      selected.add(int(order[np.argmin(np.abs(arcLength[:-1] - target))]))
+  return sorted(selected)
+
+
+def selectPhases(volumes, mode, step=2, phaseCount=5):
+  """Posizioni dei frame da conservare secondo la modalità (SELECTION_STEP o SELECTION_VOLUME)"""
+  if len(volumes) == 0:
+    return []
+  if mode == SELECTION_STEP:
+    return selectEveryK(volumes, step)
+  if mode == SELECTION_VOLUME:
+    return selectByVolume(volumes, phaseCount)
+  raise ValueError(f"Modalità di selezione delle fasi non supportata: {mode}")
+
+
+def phaseAttributes(mode, frameIndices, indexValues, volumes, selected):
+  """
+  Attributi MRML della sequenza con la selezione delle fasi
+
+  frameIndices e indexValues descrivono tutti i frame della curva volumes;
+  selected sono le posizioni conservate (vedi selectPhases).
+  """
+  ed, es = endPhases(volumes)
+  return {
+    "CTOptimizer_PhaseSelection": mode,
+    "CTOptimizer_PhaseFrames": ",".join(str(frameIndices[position]) for position in selected),
+    "CTOptimizer_PhaseIndexValues": ",".join(str(indexValues[position]) for position in selected),
+    "CTOptimizer_EDIndexValue": str(indexValues[ed]),
+    "CTOptimizer_ESIndexValue": str(indexValues[es]),
+    "CTOptimizer_BloodPoolIndexValues": ",".join(str(value) for value in indexValues),
+    "CTOptimizer_BloodPoolCurve": ",".join(f"{volume:.2f}" for volume in volumes),
+  }
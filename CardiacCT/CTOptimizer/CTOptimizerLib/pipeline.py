@@ -0,0 +1,157 @@
+"""
+Elaborazione di un singolo frame su array NumPy (ricampionamento + bit depth).
+
+Usata sia nel processo principale sia nei processi worker.
+"""
+import numpy as np
+
+from CTOptimizerLib.resampling import createResampler
+from CTOptimizerLib import cropping, packing, pyramid, quantization
+
+# Ricampionatore riusato fra frame con la stessa geometria: (chiave, ricampionatore)
+_cachedResampler = None
+
+
+def getResampler(inputShape, inputSpacing, outputSpacing, interpolation="linear", reduction=None):
+  """Restituisce il ricampionatore per la geometria data, riusando quello precedente se invariata"""
+  global _cachedResampler
+
+  key = (tuple(inputShape), tuple(float(s) for s in inputSpacing), tuple(float(s) for s in outputSpacing),
+         interpolation, reduction)
+  if _cachedResampler is None or _cachedResampler[0] != key:
+    _cachedResampler = (key, createResampler(inputShape, inputSpacing, outputSpacing, interpolation, reduction))
+  return _cachedResampler[1]
+
+
+def frameOptions(scaleFactor=0.5, bitDepth=12, interpolation="linear", packed12=False, valueRange=None,
+                 cropBox=None, targetSpacing=None, reduction=None, window=None, pyramidLevels=None):
+  """
+  Opzioni di elaborazione per frame (dizionario serializzabile per i worker e in JSON)
+
+  valueRange (min, max) impone la stessa quantizzazione a tutti i frame;
+  con None ogni frame usa il proprio intervallo. cropBox (KJI, vedi cropping)
+  ritaglia ogni frame prima del ricampionamento. targetSpacing (IJK, mm)
+  sostituisce scaleFactor con uno spacing per asse; reduction ("mean", "max")
+  abilita la riduzione a blocchi per i fattori interi. window (min, max HU)
+  quantizza tutti i frame su una finestra fissa (vedi quantization.quantizeWindow)
+  e ha la precedenza su valueRange. pyramidLevels (es. (2, 4)) aggiunge a
+  ogni frame i livelli ridotti per l'anteprima (vedi pyramid.buildPyramid).
+  """
+  return {
+    "scaleFactor": scaleFactor,
+    "targetSpacing": tuple(float(s) for s in targetSpacing) if targetSpacing is not None else None,
+    "reduction": reduction,
+    "bitDepth": bitDepth,
+    "interpolation": interpolation,
+    "packed12": packed12,
+    "valueRange": tuple(float(v) for v in valueRange) if valueRange is not None else None,
+    "cropBox": tuple(tuple(int(n) for n in axis) for axis in cropBox) if cropBox is not None else None,
+    "window": tuple(float(v) for v in window) if window is not None else None,
+    "pyramidLevels": tuple(pyramidLevels) if pyramidLevels else None,
+  }
+
+
+def outputSpacing(spacing, options):
+  """Spacing di output (IJK) di un frame con lo spacing indicato"""
+  if options.get("targetSpacing") is not None:
+    return options["targetSpacing"]
+  return tuple(s / options["scaleFactor"] for s in spacing)
+
+
+def needsResampling(spacing, options):
+  """Verifica se lo spacing di output differisce da quello del frame"""
+  return not np.allclose(outputSpacing(spacing, options), spacing)
+
+
+def frameResampler(shape, spacing, options):
+  """Ricampionatore per un frame di forma (KJI, già ritagliata) e spacing dati, None se non serve"""
+  if not needsResampling(spacing, options):
+    return None
+  return getResampler(shape, spacing, outputSpacing(spacing, options), options["interpolation"],
+                      options.get("reduction"))
+
+
+def outputVoxelOffset(shape, spacing, options):
+  """Posizione (IJK, in voxel di input) del primo voxel di output rispetto al primo di input"""
+  resampler = frameResampler(shape, spacing, options)
+  return resampler.voxelOffset if resampler is not None else (0.0, 0.0, 0.0)
+
+
+def outputFrameBytes(outputShape, inputItemsize, options):
+  """Byte occupati in memoria da un frame di output con la forma indicata (piramide inclusa)"""
+  voxels = 1
+  for n in outputShape:
+    voxels *= int(n)
+  bitDepth = options["bitDepth"]
+  itemsize = quantization.storageDtype(bitDepth).itemsize if bitDepth < 16 else inputItemsize
+  levelBytes = 0
+  if options.get("pyramidLevels"):
+    levelBytes = pyramid.pyramidBytes(outputShape, itemsize, options["pyramidLevels"])
+  if options["packed12"] and bitDepth == 12:
+    return packing.packedSize(voxels) + levelBytes
+  return voxels * itemsize + levelBytes
+
+
+def quantizeFrame(array, options):
+  """Quantizza un frame secondo le opzioni (finestra fissa o intervallo); restituisce (codici, parametri)"""
+  if options.get("window") is not None:
+    return quantization.quantizeWindow(array, options["bitDepth"], options["window"])
+  minVal, maxVal = options.get("valueRange") or (None, None)
+  return quantization.quantize(array, options["bitDepth"], minVal, maxVal)
+
+
+def processFrame(frameIndex, array, spacing, options):
+  """
+  Ritaglia, ricampiona e riduce la profondità di bit di un singolo frame
+
+  options è il dizionario creato da frameOptions. Con packed12 e profondità
+  12 bit i codici vengono impacchettati in un array uint8 di forma (1, 1, n);
+  la forma reale è salvata negli attributi.
+  L'array di input non viene mai modificato. Restituisce
+  (frameIndex, array, spacing, attributi del frame, livelli della piramide),
+  dove i livelli sono una lista (fattore, array) calcolata sui codici non
+  impacchettati (vuota se pyramidLevels non è indicato).
+  """
+  bitDepth = options["bitDepth"]
+
+  attributes = {}
+  outputArray = array
+  outputSpacing = tuple(spacing)
+
+  cropBox = options.get("cropBox")
+  if cropBox is not None:
+    cropBox = cropping.clipBox(cropBox, array.shape)
+    if cropBox is not None:
+      outputArray = cropping.cropArray(array, cropBox)
+
+  resampler = frameResampler(outputArray.shape, spacing, options)
+  if resampler is not None:
+    outputArray = resampler.resample(outputArray)
+    outputSpacing = resampler.outputSpacing
+
+  if bitDepth < 16:
+    outputArray, parameters = quantizeFrame(outputArray, options)
+    attributes.update(quantization.frameAttributes(parameters))
+
+  levels = framePyramid(outputArray, options)
+
+  if options["packed12"] and bitDepth == 12:
+    attributes.update(packedAttributes(outputArray.shape))
+    outputArray = packing.pack12(outputArray).reshape(1, 1, -1)
+
+  return frameIndex, outputArray, outputSpacing, attributes, levels
+
+
+def framePyramid(array, options):
+  """Livelli della piramide di un frame già quantizzato (lista vuota se non richiesti)"""
+  if not options.get("pyramidLevels"):
+    return []
+  return pyramid.buildPyramid(array, options["pyramidLevels"])
+
+
+def packedAttributes(shape):
+  """Attributi MRML di un frame impacchettato a 12 bit"""
+  return {
+    "CTOptimizer_Packing": packing.PACKING_12BIT,
+    "CTOptimizer_PackedShape": ",".join(str(n) for n in shape),
+  }
@@ -0,0 +1,82 @@
+"""
+Piramide multirisoluzione dei frame per l'anteprima cine.
+
+Ogni livello è la media a blocchi del livello precedente (vedi
+resampling.BlockReducer), nello stesso dtype del frame: i livelli di un frame
+quantizzato sono codici con la stessa scala/offset di decodifica.
+"""
+from .resampling import BlockReducer
+
+DEFAULT_LEVELS = (2, 4)
+
+
+def levelFactors(shape, factor):
+  """Fattori IJK di un livello per un array KJI (limitati alla dimensione di ogni asse)"""
+  return tuple(max(1, min(factor, n)) for n in shape[::-1])
+
+
+def _levelSteps(shape, levels):
+  """
+  Passi di costruzione della piramide: (fattore, livello di partenza, fattori IJK del
+  passo, fattori IJK complessivi rispetto al frame)
+
+  Ogni livello è calcolato dal precedente quando il rapporto dei fattori è intero.
+  """
+  steps = []
+  sourceFactor = 1
+  sourceShape = tuple(shape)
+  sourceTotal = (1, 1, 1)
+  for factor in sorted(int(level) for level in levels):
+    if factor <= 1:
+      continue
+    if factor % sourceFactor:
+      sourceFactor = 1
+      sourceShape = tuple(shape)
+      sourceTotal = (1, 1, 1)
+    stepFactors = levelFactors(sourceShape, factor // sourceFactor)
+    total = tuple(a * b for a, b in zip(sourceTotal, stepFactors))
+    steps.append((factor, sourceFactor, stepFactors, total))
+    sourceShape = tuple(max(1, n // f) for n, f in zip(sourceShape, stepFactors[::-1]))
+    sourceFactor = factor
+    sourceTotal = total
+  return steps
+
+
+def pyramidFactors(shape, levels=DEFAULT_LEVELS):
+  """Fattori IJK effettivi di ogni livello (fattore -> fattori IJK) per un frame KJI"""
+  return {factor: total for factor, _, _, total in _levelSteps(shape, levels)}
+
+
+def buildPyramid(array, levels=DEFAULT_LEVELS):
+  """
+  Livelli ridotti di un frame KJI come lista di (fattore, array)
+
+  Ogni livello è calcolato dal precedente quando possibile, così il costo
+  totale è dominato dal primo livello.
+  """
+  pyramid = []
+  computed = {1: array}
+  for factor, sourceFactor, stepFactors, _ in _levelSteps(array.shape, levels):
+    source = computed[sourceFactor]
+    computed[factor] = BlockReducer(source.shape, (1.0, 1.0, 1.0), stepFactors, "mean").resample(source)
+    pyramid.append((factor, computed[factor]))
+  return pyramid
+
+
+def pyramidBytes(shape, itemsize, levels=DEFAULT_LEVELS):
+  """Byte occupati dai livelli di un frame con la forma KJI e l'itemsize indicati"""
+  total = 0
+  for factors in pyramidFactors(shape, levels).values():
+    voxels = 1
+    for n, f in zip(shape, factors[::-1]):
+      voxels *= max(1, n // f)
+    total += voxels * itemsize
+  return total
+
+
+def levelsToString(levels):
+  return ",".join(str(int(factor)) for factor in levels)
+
+
+def levelsFromString(text):
+  return tuple(int(value) for value in text.split(",") if value)
@@ -0,0 +1,142 @@
+"""
+Riduzione della profondità di bit dei frame CT.
+
+I codici quantizzati sono salvati in un dtype senza segno reale (uint8 per
+8 bit, uint16 per 12 bit); i valori originali si ricostruiscono con
+HU = codice * scala + offset.
+
+Due modalità: "range" usa l'intervallo min/max di ogni frame (o quello
+indicato), "window" una finestra clinica fissa uguale per tutti i frame.
+"""
+import numpy as np
+
+# Voxel elaborati per blocco: limita il buffer float32 temporaneo a ~16 MB
+DEFAULT_CHUNK_VOXELS = 4 * 1024 * 1024
+
+MODE_RANGE = "range"
+MODE_WINDOW = "window"
+
+# Finestra clinica: 4096 valori HU, cioè esattamente i livelli di 12 bit
+CLINICAL_WINDOW_HU = (-1024, 3071)
+
+
+def storageDtype(bitDepth):
+  """Dtype senza segno più piccolo che contiene la profondità di bit richiesta"""
+  if bitDepth <= 8:
+    return np.dtype(np.uint8)
+  if bitDepth <= 16:
+    return np.dtype(np.uint16)
+  raise ValueError(f"Profondità di bit non supportata: {bitDepth}")
+
+
+def decodeParameters(minVal, maxVal, bitDepth):
+  """Scala e offset per ricostruire i valori originali dai codici (HU = codice * scala + offset)"""
+  levels = (1 << bitDepth) - 1
+  scale = (float(maxVal) - float(minVal)) / levels if maxVal > minVal else 1.0
+  return scale, float(minVal)
+
+
+def _slabs(shape, chunkVoxels):
+  """Fette lungo il primo asse con al più chunkVoxels voxel ciascuna (almeno una fetta)"""
+  sliceVoxels = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+  step = max(1, chunkVoxels // max(1, sliceVoxels))
+  for start in range(0, shape[0], step):
+    yield slice(start, min(start + step, shape[0]))
+
+
+def quantize(array, bitDepth, minVal=None, maxVal=None, chunkVoxels=DEFAULT_CHUNK_VOXELS):
+  """
+  Quantizza l'array sui livelli della profondità di bit in un nuovo array uint8/uint16
+
+  Il calcolo procede a blocchi riusando un unico buffer float32, senza
+  temporanei float64 a piena risoluzione. Restituisce (codici, parametri),
+  dove parametri contiene min/max originali e scala/offset di decodifica.
+  """
+  if minVal is None:
+    minVal = array.min()
+  if maxVal is None:
+    maxVal = array.max()
+
+  levels = (1 << bitDepth) - 1
+  scale, offset = decodeParameters(minVal, maxVal, bitDepth)
+  factor = np.float32(1.0 / scale)
+
+  codes = np.empty(array.shape, dtype=storageDtype(bitDepth))
+  sliceVoxels = int(np.prod(array.shape[1:])) if array.ndim > 1 else 1
+  buffer = np.empty(min(array.size, max(chunkVoxels, sliceVoxels)), dtype=np.float32)
+
+  for slab in _slabs(array.shape, chunkVoxels):
+    source = array[slab]
+    work = buffer[:source.size].reshape(source.shape)
+    np.subtract(source, np.float32(offset), out=work, dtype=np.float32)
+    np.multiply(work, factor, out=work)
+    np.rint(work, out=work)
+    np.clip(work, 0, levels, out=work)
+    np.copyto(codes[slab], work, casting="unsafe")
+
+  parameters = {
+    "bitDepth": bitDepth,
+    "min": minVal,
+    "max": maxVal,
+    "scale": scale,
+    "offset": offset,
+    "mode": MODE_RANGE,
+  }
+  return codes, parameters
+
+
+def quantizeWindow(array, bitDepth=12, window=CLINICAL_WINDOW_HU, chunkVoxels=DEFAULT_CHUNK_VOXELS):
+  """
+  Quantizza l'array su una finestra HU fissa, senza calcolare min/max del frame
+
+  Se la finestra ha esattamente un valore per livello (12 bit e
+  CLINICAL_WINDOW_HU) e l'input è intero, ogni blocco è ritagliato e spostato
+  in un solo passaggio intero (codice = HU - inizio finestra): la codifica è
+  identica in tutti i frame e reversibile senza perdita dentro la finestra.
+  Negli altri casi si usa quantize con la finestra come intervallo fisso.
+  Restituisce (codici, parametri) come quantize.
+  """
+  lower, upper = (int(value) for value in window)
+  levels = (1 << bitDepth) - 1
+  if upper - lower != levels or not np.issubdtype(array.dtype, np.integer):
+    codes, parameters = quantize(array, bitDepth, lower, upper, chunkVoxels)
+    parameters["mode"] = MODE_WINDOW
+    return codes, parameters
+
+  # Dtype di lavoro che contiene sia l'input sia la finestra (int16 per i CT tipici)
+  workDtype = np.promote_types(array.dtype, np.min_scalar_type(lower))
+  workDtype = np.promote_types(workDtype, np.min_scalar_type(upper))
+  low = workDtype.type(lower)
+  high = workDtype.type(upper)
+
+  codes = np.empty(array.shape, dtype=storageDtype(bitDepth))
+  sliceVoxels = int(np.prod(array.shape[1:])) if array.ndim > 1 else 1
+  buffer = np.empty(min(array.size, max(chunkVoxels, sliceVoxels)), dtype=workDtype)
+
+  for slab in _slabs(array.shape, chunkVoxels):
+    source = array[slab]
+    work = buffer[:source.size].reshape(source.shape)
+    np.clip(source, low, high, out=work)
+    np.subtract(work, low, out=codes[slab], casting="unsafe")
+
+  parameters = {
+    "bitDepth": bitDepth,
+    "min": lower,
+    "max": upper,
+    "scale": 1.0,
+    "offset": float(lower),
+    "mode": MODE_WINDOW,
+  }
+  return codes, parameters
+
+
+def frameAttributes(parameters):
+  """Attributi MRML che descrivono la quantizzazione di un frame"""
+  return {
+    "CTOptimizer_OriginalMin": str(parameters["min"]),
+    "CTOptimizer_OriginalMax": str(parameters["max"]),
+    "CTOptimizer_BitDepth": str(parameters["bitDepth"]),
+    "CTOptimizer_DecodeScale": repr(parameters["scale"]),
+    "CTOptimizer_DecodeOffset": repr(parameters["offset"]),
+    "CTOptimizer_Quantization": parameters.get("mode", MODE_RANGE),
+  }
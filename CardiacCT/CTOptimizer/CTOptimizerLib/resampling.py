@@ -0,0 +1,348 @@
+"""
+Ricampionamento in memoria di volumi CT con kernel separabili.
+
+Gli array sono in ordine KJI (come restituiti da slicer.util.arrayFromVolume),
+mentre dimensioni e spacing sono in ordine IJK, come nei nodi MRML.
+
+Per fattori di riduzione interi la riduzione a blocchi (media o massimo) è
+anti-aliasing e molto più veloce dell'interpolazione; il primo voxel di output
+è allora al centro del primo blocco (vedi voxelOffset).
+"""
+import numpy as np
+
+INTERPOLATION_TYPES = ("nearest", "linear", "cubic")
+BLOCK_REDUCTIONS = ("mean", "max")
+
+# Tolleranza relativa per considerare intero il rapporto fra spacing di output e di input
+INTEGER_FACTOR_TOLERANCE = 1e-3
+
+
+def computeOutputGrid(inputSize, inputSpacing, outputSpacing):
+  """Calcola dimensioni e spacing di output come il CLI ResampleScalarVolume
+
+  L'origine e le direzioni restano quelle dell'input: il primo voxel di output
+  coincide con il primo voxel di input.
+  """
+  outputSize = []
+  for size, spacing, newSpacing in zip(inputSize, inputSpacing, outputSpacing):
+    outputSize.append(max(1, int(size * spacing / newSpacing)))
+  return tuple(outputSize), tuple(float(s) for s in outputSpacing)
+
+
+def integerFactors(inputSpacing, outputSpacing, tolerance=INTEGER_FACTOR_TOLERANCE):
+  """Fattori di riduzione interi per asse (IJK), None dove il rapporto degli spacing non è intero"""
+  factors = []
+  for spacing, newSpacing in zip(inputSpacing, outputSpacing):
+    ratio = newSpacing / spacing
+    factor = int(round(ratio))
+    factors.append(factor if factor >= 1 and abs(ratio - factor) <= tolerance * ratio else None)
+  return tuple(factors)
+
+
+def _axisKernel(inputLength, outputLength, step, interpolation, start=0.0):
+  """Indici e pesi di campionamento lungo un asse (taps per campione)"""
+  positions = start + np.arange(outputLength, dtype=np.float64) * step
+
+  if interpolation == "nearest":
+    indices = np.rint(positions)[:, np.newaxis]
+    weights = np.ones((outputLength, 1))
+  elif interpolation == "linear":
+    base = np.floor(positions)
+    t = (positions - base)[:, np.newaxis]
+    indices = base[:, np.newaxis] + np.arange(2)
+    weights = np.hstack([1.0 - t, t])
+  elif interpolation == "cubic":
+    # Kernel di Keys (Catmull-Rom, a = -0.5) su 4 campioni
+    base = np.floor(positions)
+    t = (positions - base)[:, np.newaxis]
+    indices = base[:, np.newaxis] + np.arange(-1, 3)
+    t2 = t * t
+    t3 = t2 * t
+    weights = np.hstack([
+      -0.5 * t3 + t2 - 0.5 * t,
+      1.5 * t3 - 2.5 * t2 + 1.0,
+      -1.5 * t3 + 2.0 * t2 + 0.5 * t,
+      0.5 * t3 - 0.5 * t2,
+    ])
+  else:
+    raise ValueError(f"Interpolazione non supportata: {interpolation}")
+
+  # Bordi replicati (clamp) come l'interpolatore ITK ai limiti del volume
+  indices = np.clip(indices, 0, inputLength - 1).astype(np.intp)
+  return indices, weights.astype(np.float32)
+
+
+class SeparableResampler:
+  """
+  Ricampionatore separabile per una geometria fissa.
+
+  Indici e pesi vengono calcolati una sola volta nel costruttore e riusati per
+  tutti i frame di una sequenza con la stessa geometria.
+  """
+
+  def __init__(self, inputShape, inputSpacing, outputSpacing, interpolation="linear"):
+    if interpolation not in INTERPOLATION_TYPES:
+      raise ValueError(f"Interpolazione non supportata: {interpolation}")
+
+    self.inputShape = tuple(int(n) for n in inputShape)
+    self.inputSpacing = tuple(float(s) for s in inputSpacing)
+    self.interpolation = interpolation
+    self.voxelOffset = (0.0, 0.0, 0.0)
+
+    inputSize = self.inputShape[::-1]
+    outputSize, self.outputSpacing = computeOutputGrid(inputSize, self.inputSpacing, outputSpacing)
+    self.outputShape = tuple(outputSize[::-1])
+
+    # Kernel per asse dell'array (ordine KJI)
+    self._kernels = []
+    for axis in range(3):
+      ijkAxis = 2 - axis
+      step = self.outputSpacing[ijkAxis] / self.inputSpacing[ijkAxis]
+      if self.outputShape[axis] == self.inputShape[axis] and step == 1.0:
+        self._kernels.append(None)
+        continue
+      self._kernels.append(_axisKernel(self.inputShape[axis], self.outputShape[axis], step, interpolation))
+
+    # Prima gli assi che riducono di più, per lavorare su intermedi più piccoli
+    self._axisOrder = sorted(range(3), key=lambda axis: self.outputShape[axis] / self.inputShape[axis])
+
+  def matches(self, inputShape, inputSpacing, outputSpacing):
+    """Verifica se il ricampionatore può essere riusato per questa geometria"""
+    return (tuple(inputShape) == self.inputShape and
+            np.allclose(inputSpacing, self.inputSpacing) and
+            np.allclose(outputSpacing, self.outputSpacing))
+
+  def resample(self, array):
+    """Ricampiona un array KJI restituendo un nuovo array dello stesso dtype"""
+    if tuple(array.shape) != self.inputShape:
+      raise ValueError(f"Forma array {array.shape} diversa da quella attesa {self.inputShape}")
+
+    result = array
+    for axis in self._axisOrder:
+      kernel = self._kernels[axis]
+      if kernel is None:
+        continue
+      result = _applyAxisKernel(result, axis, kernel)
+
+    if result is array:
+      return array.copy()
+    return _castLike(result, array.dtype)
+
+  def peakWorkingBytes(self, inputItemsize):
+    """Stima dei byte temporanei allocati da resample() oltre all'array di input"""
+    shape = list(self.inputShape)
+    itemsize = inputItemsize
+    previous = 0
+    peak = 0
+    for axis in self._axisOrder:
+      if self._kernels[axis] is None:
+        continue
+      shape[axis] = self.outputShape[axis]
+      voxels = int(np.prod(shape))
+      # intermedio precedente + np.take + prodotto pesato + accumulatore float32
+      peak = max(peak, previous + voxels * (itemsize + 4 + 4))
+      previous = voxels * 4
+      itemsize = 4
+    # conversione finale al dtype di input
+    return max(peak, previous + int(np.prod(self.outputShape)) * inputItemsize)
+
+
+class BlockReducer:
+  """
+  Riduzione a blocchi di fattori interi per asse (media o massimo).
+
+  Ogni asse è ridotto combinando le f viste con passo f (somma float32 o
+  massimo), iniziando dall'asse con fattore maggiore per lavorare su intermedi
+  più piccoli; i voxel in eccesso sul bordo finale sono scartati.
+  La media è anti-aliasing, il massimo preserva le strutture piccole e dense
+  (calcio, stent) e i valori HU originali.
+  """
+
+  def __init__(self, inputShape, inputSpacing, factors, reduction="mean"):
+    if reduction not in BLOCK_REDUCTIONS:
+      raise ValueError(f"Riduzione non supportata: {reduction}")
+
+    self.inputShape = tuple(int(n) for n in inputShape)
+    self.inputSpacing = tuple(float(s) for s in inputSpacing)
+    self.factors = tuple(int(f) for f in factors)
+    self.reduction = reduction
+
+    self.outputShape = tuple(max(1, n // f) for n, f in zip(self.inputShape, self.factors[::-1]))
+    self.outputSpacing = tuple(s * f for s, f in zip(self.inputSpacing, self.factors))
+    # Centro del primo blocco, in voxel di input (IJK)
+    self.voxelOffset = tuple((f - 1) / 2.0 for f in self.factors)
+
+  def matches(self, inputShape, inputSpacing, outputSpacing):
+    return (tuple(inputShape) == self.inputShape and
+            np.allclose(inputSpacing, self.inputSpacing) and
+            np.allclose(outputSpacing, self.outputSpacing))
+
+  def resample(self, array):
+    """Riduce un array KJI restituendo un nuovo array dello stesso dtype"""
+    if tuple(array.shape) != self.inputShape:
+      raise ValueError(f"Forma array {array.shape} diversa da quella attesa {self.inputShape}")
+
+    factors = self.factors[::-1]
+    result = array
+    for axis in sorted(range(3), key=lambda axis: -factors[axis]):
+      factor = factors[axis]
+      if factor == 1:
+        continue
+      result = self._reduceAxis(result, axis, factor, self.outputShape[axis])
+
+    if result is array:
+      return array.copy()
+    if self.reduction == "max":
+      return result
+    result *= np.float32(1.0 / np.prod(self.factors))
+    return _castLike(result, array.dtype)
+
+  def _reduceAxis(self, array, axis, factor, outputLength):
+    """Combina le viste con passo factor lungo un asse"""
+    def phase(offset):
+      index = [slice(None)] * array.ndim
+      index[axis] = slice(offset, offset + outputLength * factor, factor)
+      return array[tuple(index)]
+
+    if self.reduction == "max":
+      output = phase(0).copy()
+      for offset in range(1, factor):
+        np.maximum(output, phase(offset), out=output)
+      return output
+
+    output = phase(0).astype(np.float32)
+    for offset in range(1, factor):
+      np.add(output, phase(offset), out=output, casting="unsafe")
+    return output
+
+  def peakWorkingBytes(self, inputItemsize):
+    """Stima dei byte temporanei allocati da resample() oltre all'array di input"""
+    factors = self.factors[::-1]
+    shape = list(self.inputShape)
+    # la media accumula in float32, il massimo resta nel dtype di input
+    itemsize = inputItemsize if self.reduction == "max" else 4
+    previous = 0
+    peak = 0
+    for axis in sorted(range(3), key=lambda axis: -factors[axis]):
+      if factors[axis] == 1:
+        continue
+      shape[axis] = self.outputShape[axis]
+      voxels = int(np.prod(shape))
+      peak = max(peak, previous + voxels * itemsize)
+      previous = voxels * itemsize
+    if self.reduction == "max":
+      return peak
+    # conversione finale al dtype di input
+    return max(peak, previous + int(np.prod(self.outputShape)) * inputItemsize)
+
+
+class ResamplerChain:
+  """Applica in sequenza più ricampionatori (es. riduzione a blocchi, poi interpolazione)"""
+
+  def __init__(self, stages):
+    self.stages = list(stages)
+    self.inputShape = self.stages[0].inputShape
+    self.inputSpacing = self.stages[0].inputSpacing
+    self.outputShape = self.stages[-1].outputShape
+    self.outputSpacing = self.stages[-1].outputSpacing
+
+    # Offset di ogni stadio espresso in voxel dell'input originale
+    offset = np.zeros(3)
+    scale = np.ones(3)
+    for stage in self.stages:
+      offset += np.asarray(stage.voxelOffset) * scale
+      scale *= np.asarray(stage.outputSpacing) / np.asarray(stage.inputSpacing)
+    self.voxelOffset = tuple(float(o) for o in offset)
+
+  def matches(self, inputShape, inputSpacing, outputSpacing):
+    return (tuple(inputShape) == self.inputShape and
+            np.allclose(inputSpacing, self.inputSpacing) and
+            np.allclose(outputSpacing, self.outputSpacing))
+
+  def resample(self, array):
+    for stage in self.stages:
+      array = stage.resample(array)
+    return array
+
+  def peakWorkingBytes(self, inputItemsize):
+    peak = 0
+    previous = 0
+    for stage in self.stages:
+      peak = max(peak, previous + stage.peakWorkingBytes(inputItemsize))
+      previous = int(np.prod(stage.outputShape)) * inputItemsize
+    return peak
+
+
+def createResampler(inputShape, inputSpacing, outputSpacing, interpolation="linear", reduction=None):
+  """
+  Ricampionatore per la geometria richiesta
+
+  Con reduction ("mean" o "max") gli assi con fattore di riduzione intero sono
+  ridotti a blocchi; l'interpolatore separabile è usato solo per gli assi
+  con fattore non intero (o per tutti se reduction è None).
+  """
+  if reduction is None:
+    return SeparableResampler(inputShape, inputSpacing, outputSpacing, interpolation)
+
+  factors = integerFactors(inputSpacing, outputSpacing)
+  blockFactors = tuple(f or 1 for f in factors)
+  if all(f == 1 for f in blockFactors):
+    return SeparableResampler(inputShape, inputSpacing, outputSpacing, interpolation)
+
+  block = BlockReducer(inputShape, inputSpacing, blockFactors, reduction)
+  if all(f is not None for f in factors):
+    return block
+  separable = SeparableResampler(block.outputShape, block.outputSpacing, outputSpacing, interpolation)
+  return ResamplerChain([block, separable])
+
+
+def reconstructionError(original, reduced, inputSpacing, outputSpacing, voxelOffset=(0.0, 0.0, 0.0)):
+  """
+  Errore (in unità del volume, es. HU) fra un volume e la sua versione ricampionata
+
+  Il volume ridotto viene riportato sulla griglia originale con interpolazione
+  lineare, tenendo conto dell'offset del suo primo voxel, e confrontato voxel
+  per voxel. Restituisce rmse, errore medio assoluto, massimo e bias della media.
+  """
+  reconstructed = reduced
+  for axis in range(3):
+    ijkAxis = 2 - axis
+    step = inputSpacing[ijkAxis] / outputSpacing[ijkAxis]
+    start = -voxelOffset[ijkAxis] * step
+    kernel = _axisKernel(reduced.shape[axis], original.shape[axis], step, "linear", start)
+    reconstructed = _applyAxisKernel(reconstructed, axis, kernel)
+
+  difference = reconstructed - original.astype(np.float32)
+  return {
+    "rmse": float(np.sqrt(np.mean(np.square(difference, dtype=np.float64)))),
+    "meanAbsError": float(np.mean(np.abs(difference), dtype=np.float64)),
+    "maxAbsError": float(np.max(np.abs(difference))),
+    "meanBias": float(np.mean(reduced, dtype=np.float64) - np.mean(original, dtype=np.float64)),
+  }
+
+
+def _applyAxisKernel(array, axis, kernel):
+  """Applica il kernel 1D lungo un asse con somma pesata di np.take"""
+  indices, weights = kernel
+  broadcastShape = [1] * array.ndim
+  broadcastShape[axis] = -1
+
+  output = None
+  for tap in range(indices.shape[1]):
+    taken = np.take(array, indices[:, tap], axis=axis)
+    tapWeights = weights[:, tap].reshape(broadcastShape)
+    if output is None:
+      output = np.multiply(taken, tapWeights, dtype=np.float32)
+    else:
+      output += np.multiply(taken, tapWeights, dtype=np.float32)
+  return output
+
+
+def _castLike(array, dtype):
+  """Riporta il risultato float32 al dtype di input, con arrotondamento e saturazione per gli interi"""
+  dtype = np.dtype(dtype)
+  if np.issubdtype(dtype, np.integer):
+    info = np.iinfo(dtype)
+    np.rint(array, out=array)
+    np.clip(array, info.min, info.max, out=array)
+  return array.astype(dtype, copy=False)
@@ -0,0 +1,207 @@
+"""
+Contenitore su disco a blocchi per sequenze 4D ottimizzate (.ct4d).
+
+Struttura del file:
+  - blocchi dei frame (fette lungo K), compressi con zlib/lzma o grezzi
+  - indice JSON con geometria, attributi e posizione di ogni blocco
+  - trailer di 24 byte: MAGIC (8 byte), offset e lunghezza dell'indice (uint64)
+
+L'indice in coda permette di scrivere i blocchi in streaming; la lettura di un
+frame legge solo i blocchi che lo compongono. I blocchi non compressi sono
+accessibili tramite np.memmap senza copie.
+"""
+import concurrent.futures
+import json
+import lzma
+import os
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"CT4DSTR1"
+FORMAT_VERSION = 1
+TRAILER = struct.Struct("<8sQQ")
+COMPRESSIONS = ("none", "zlib", "lzma")
+
+# Fette per blocco: blocchi di qualche MB per frame 512x512
+DEFAULT_CHUNK_SLICES = 16
+
+
+def _compress(data, compression, level):
+  if compression == "zlib":
+    return zlib.compress(data, level)
+  if compression == "lzma":
+    return lzma.compress(data, preset=level)
+  return data
+
+
+def _decompress(data, compression):
+  if compression == "zlib":
+    return zlib.decompress(data)
+  if compression == "lzma":
+    return lzma.decompress(data)
+  return data
+
+
+def compressedSize(array, compression="zlib", level=6, chunkSlices=DEFAULT_CHUNK_SLICES):
+  """Byte occupati da un array una volta compresso a blocchi come in StoreWriter"""
+  array = np.ascontiguousarray(array)
+  total = 0
+  for start in range(0, array.shape[0], chunkSlices):
+    total += len(_compress(array[start:start + chunkSlices].tobytes(), compression, level))
+  return total
+
+
+class StoreWriter:
+  """
+  Scrittura di un file .ct4d frame per frame.
+
+  La compressione dei blocchi avviene in un pool di thread (zlib e lzma
+  rilasciano il GIL); i blocchi sono scritti su disco nell'ordine di arrivo.
+  """
+
+  def __init__(self, path, compression="zlib", level=6, chunkSlices=DEFAULT_CHUNK_SLICES,
+               workers=None, sequenceInfo=None):
+    if compression not in COMPRESSIONS:
+      raise ValueError(f"Compressione non supportata: {compression}")
+    self.path = path
+    self.compression = compression
+    self.level = level
+    self.chunkSlices = max(1, int(chunkSlices))
+    self.frames = []
+    self.sequenceInfo = sequenceInfo or {}
+    self._file = open(path, "wb")
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+  def addFrame(self, array, indexValue="", name="", ijkToRAS=None, attributes=None):
+    """Aggiunge un frame (array KJI) con la sua geometria e gli attributi MRML"""
+    array = np.ascontiguousarray(array)
+    slabs = [slice(start, min(start + self.chunkSlices, array.shape[0]))
+             for start in range(0, array.shape[0], self.chunkSlices)]
+    futures = [self._executor.submit(_compress, array[slab].tobytes(), self.compression, self.level)
+               for slab in slabs]
+
+    chunks = []
+    for slab, future in zip(slabs, futures):
+      data = future.result()
+      chunks.append({"offset": self._file.tell(), "length": len(data), "start": slab.start, "stop": slab.stop})
+      self._file.write(data)
+
+    self.frames.append({
+      "indexValue": str(indexValue),
+      "name": name,
+      "shape": list(array.shape),
+      "dtype": array.dtype.str,
+      "ijkToRAS": [float(v) for v in np.ravel(ijkToRAS if ijkToRAS is not None else np.eye(4))],
+      "attributes": dict(attributes or {}),
+      "chunks": chunks,
+    })
+
+  def close(self):
+    """Scrive indice e trailer e chiude il file"""
+    if self._file is None:
+      return
+    self._executor.shutdown()
+    index = json.dumps({
+      "version": FORMAT_VERSION,
+      "compression": self.compression,
+      "sequence": self.sequenceInfo,
+      "frames": self.frames,
+    }).encode("utf-8")
+    indexOffset = self._file.tell()
+    self._file.write(index)
+    self._file.write(TRAILER.pack(MAGIC, indexOffset, len(index)))
+    self._file.close()
+    self._file = None
+
+  def abort(self):
+    """Interrompe la scrittura ed elimina il file incompleto (senza indice né trailer)"""
+    if self._file is None:
+      return
+    self._executor.shutdown(cancel_futures=True)
+    self._file.close()
+    self._file = None
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    # Un'eccezione durante la scrittura non deve produrre un file che sembra valido
+    if excType is not None:
+      self.abort()
+    else:
+      self.close()
+
+
+class StoreReader:
+  """Accesso casuale ai frame di un file .ct4d"""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as f:
+      f.seek(-TRAILER.size, os.SEEK_END)
+      magic, indexOffset, indexLength = TRAILER.unpack(f.read(TRAILER.size))
+      if magic != MAGIC:
+        raise ValueError(f"{path} non è un file CT4D valido")
+      f.seek(indexOffset)
+      index = json.loads(f.read(indexLength).decode("utf-8"))
+
+    self.compression = index["compression"]
+    self.sequenceInfo = index.get("sequence", {})
+    self.frames = index["frames"]
+
+  @property
+  def frameCount(self):
+    return len(self.frames)
+
+  def frameInfo(self, frameIndex):
+    """Metadati del frame: forma, dtype, geometria, attributi e blocchi"""
+    return self.frames[frameIndex]
+
+  def frameShape(self, frameIndex):
+    return tuple(self.frames[frameIndex]["shape"])
+
+  def frameDtype(self, frameIndex):
+    return np.dtype(self.frames[frameIndex]["dtype"])
+
+  def readSlab(self, frameIndex, start, stop, out=None):
+    """Legge le fette K [start, stop) di un frame, decomprimendo solo i blocchi coinvolti"""
+    info = self.frames[frameIndex]
+    shape = tuple(info["shape"])
+    dtype = np.dtype(info["dtype"])
+    stop = min(stop, shape[0])
+    if out is None:
+      out = np.empty((stop - start,) + shape[1:], dtype=dtype)
+
+    with open(self.path, "rb") as f:
+      for chunk in info["chunks"]:
+        if chunk["stop"] <= start or chunk["start"] >= stop:
+          continue
+        f.seek(chunk["offset"])
+        data = _decompress(f.read(chunk["length"]), self.compression)
+        chunkArray = np.frombuffer(data, dtype=dtype).reshape((chunk["stop"] - chunk["start"],) + shape[1:])
+        first = max(start, chunk["start"])
+        last = min(stop, chunk["stop"])
+        out[first - start:last - start] = chunkArray[first - chunk["start"]:last - chunk["start"]]
+    return out
+
+  def readFrame(self, frameIndex, out=None):
+    """Legge un frame completo (in out se fornito)"""
+    return self.readSlab(frameIndex, 0, self.frames[frameIndex]["shape"][0], out=out)
+
+  def memmapFrame(self, frameIndex):
+    """
+    Vista np.memmap in sola lettura di un frame non compresso (nessuna copia in memoria)
+
+    I blocchi di un frame sono contigui nel file perché scritti in sequenza.
+    """
+    if self.compression != "none":
+      raise ValueError("memmap disponibile solo per file non compressi")
+    info = self.frames[frameIndex]
+    return np.memmap(self.path, dtype=np.dtype(info["dtype"]), mode="r",
+                     offset=info["chunks"][0]["offset"], shape=tuple(info["shape"]))
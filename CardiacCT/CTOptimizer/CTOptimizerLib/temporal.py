@@ -0,0 +1,158 @@
+"""
+Codifica temporale delle sequenze 4D: frame di riferimento + residui.
+
+Ogni frame è salvato come differenza dei codici quantizzati rispetto al frame
+di riferimento, quindi ogni frame si ricostruisce in modo indipendente
+(riferimento + residuo) senza dipendere dai frame precedenti.
+I residui sono salvati in forma sparsa (indici uint32 + valori) dove sono
+quasi tutti nulli, altrimenti in forma densa, con i valori nel tipo con segno
+più stretto che li contiene. Un frame il cui residuo non è più piccolo dei
+codici è salvato invariato.
+"""
+import numpy as np
+
+FORMAT_SPARSE = "sparse"
+FORMAT_DENSE = "dense"
+
+
+def residualDtype(bitDepth):
+  """Dtype con segno sufficiente per la differenza di due codici qualsiasi"""
+  return np.dtype(np.int16) if bitDepth <= 15 else np.dtype(np.int32)
+
+
+def narrowResidualDtype(residual, bitDepth):
+  """Dtype con segno più stretto che contiene i valori del residuo (al più residualDtype)"""
+  if residual.size:
+    low, high = int(residual.min()), int(residual.max())
+    for dtype in (np.int8, np.int16):
+      info = np.iinfo(dtype)
+      if info.min <= low and high <= info.max:
+        return np.dtype(dtype)
+  else:
+    return np.dtype(np.int8)
+  return residualDtype(bitDepth)
+
+
+def encodeResidual(codes, reference, bitDepth, tolerance=0):
+  """
+  Codifica codes come residuo rispetto a reference
+
+  I residui con modulo <= tolerance (in codici) sono azzerati: con tolerance=0
+  la codifica è senza perdita rispetto ai codici quantizzati.
+  Restituisce (payload uint8 monodimensionale, informazioni sul residuo).
+  """
+  residual = np.subtract(codes, reference, dtype=np.int32)
+  if tolerance > 0:
+    residual[np.abs(residual) <= tolerance] = 0
+  valueDtype = narrowResidualDtype(residual, bitDepth)
+
+  flat = residual.reshape(-1)
+  nonzero = np.flatnonzero(flat)
+  sparseBytes = nonzero.size * (4 + valueDtype.itemsize)
+  denseBytes = flat.size * valueDtype.itemsize
+
+  if sparseBytes < denseBytes:
+    payload = np.concatenate([
+      nonzero.astype(np.uint32).view(np.uint8),
+      flat[nonzero].astype(valueDtype).view(np.uint8),
+    ])
+    residualFormat = FORMAT_SPARSE
+  else:
+    payload = flat.astype(valueDtype).view(np.uint8)
+    residualFormat = FORMAT_DENSE
+
+  info = {
+    "format": residualFormat,
+    "count": int(nonzero.size),
+    "valueType": valueDtype.name,
+  }
+  return payload, info
+
+
+def decodeResidual(reference, payload, info, out=None):
+  """Ricostruisce i codici di un frame da riferimento e residuo (in out se fornito)"""
+  if out is None:
+    out = np.empty_like(reference)
+  np.copyto(out, reference)
+
+  valueDtype = np.dtype(info["valueType"])
+  payload = np.ravel(payload)
+  flat = out.reshape(-1)
+
+  if info["format"] == FORMAT_SPARSE:
+    count = int(info["count"])
+    indices = payload[:count * 4].view(np.uint32)
+    values = payload[count * 4:count * (4 + valueDtype.itemsize)].view(valueDtype)
+    flat[indices] = (flat[indices].astype(np.int32) + values).astype(out.dtype)
+  else:
+    residual = payload[:flat.size * valueDtype.itemsize].view(valueDtype)
+    np.add(flat, residual, out=flat, casting="unsafe")
+  return out
+
+
+FRAME_REFERENCE = "reference"
+FRAME_DELTA = "delta"
+
+
+def residualAttributes(info, shape, dtype, referenceIndexValue):
+  """Attributi MRML di un frame salvato come residuo"""
+  return {
+    "CTOptimizer_Temporal": FRAME_DELTA,
+    "CTOptimizer_ReferenceIndexValue": str(referenceIndexValue),
+    "CTOptimizer_FrameShape": ",".join(str(n) for n in shape),
+    "CTOptimizer_FrameDtype": np.dtype(dtype).name,
+    "CTOptimizer_DeltaFormat": info["format"],
+    "CTOptimizer_DeltaCount": str(info["count"]),
+    "CTOptimizer_DeltaValueType": info["valueType"],
+  }
+
+
+def parseResidualAttributes(attributes):
+  """
+  Legge gli attributi di un frame residuo (dizionario nome -> valore)
+
+  Restituisce (info, forma KJI, dtype, valore di indice del riferimento),
+  None se il frame non è un residuo.
+  """
+  if attributes.get("CTOptimizer_Temporal") != FRAME_DELTA:
+    return None
+  info = {
+    "format": attributes["CTOptimizer_DeltaFormat"],
+    "count": int(attributes["CTOptimizer_DeltaCount"]),
+    "valueType": attributes["CTOptimizer_DeltaValueType"],
+  }
+  shape = tuple(int(n) for n in attributes["CTOptimizer_FrameShape"].split(","))
+  return info, shape, np.dtype(attributes["CTOptimizer_FrameDtype"]), attributes["CTOptimizer_ReferenceIndexValue"]
+
+
+class SequenceEncoder:
+  """
+  Codifica in ordine i frame di una sequenza.
+
+  Il primo frame diventa il riferimento ed è salvato invariato; i frame
+  successivi con la stessa forma e dtype sono salvati come residuo in un array
+  uint8 di forma (1, 1, n) se questo è più piccolo dei codici. I frame
+  incompatibili o con residuo non conveniente restano invariati.
+  """
+
+  def __init__(self, bitDepth, tolerance=0):
+    self.bitDepth = bitDepth
+    self.tolerance = tolerance
+    self.reference = None
+    self.referenceIndexValue = None
+
+  def encode(self, codes, indexValue):
+    """Restituisce (array da salvare, attributi aggiuntivi del frame)"""
+    if self.reference is None:
+      self.reference = codes
+      self.referenceIndexValue = indexValue
+      return codes, {"CTOptimizer_Temporal": FRAME_REFERENCE}
+
+    if codes.shape != self.reference.shape or codes.dtype != self.reference.dtype:
+      return codes, {}
+
+    payload, info = encodeResidual(codes, self.reference, self.bitDepth, self.tolerance)
+    if payload.nbytes >= codes.nbytes:
+      return codes, {}
+    attributes = residualAttributes(info, codes.shape, codes.dtype, self.referenceIndexValue)
+    return payload.reshape(1, 1, -1), attributes
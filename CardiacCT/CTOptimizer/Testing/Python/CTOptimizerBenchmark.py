@@ -0,0 +1,296 @@
+"""
+Benchmark di throughput e memoria di picco delle fasi di CTOptimizer.
+
+Genera sequenze 4D sintetiche e misura per ogni fase (copia, ricampionamento,
+riduzione a blocchi, quantizzazione per intervallo e su finestra fissa, inserimento in sequenza) tempo, MB/s di
+input e picco di RSS. I risultati sono salvati in JSON e possono essere
+confrontati con quelli di un'esecuzione precedente.
+
+Le fasi NumPy girano con un normale interprete Python (anche su server senza
+GPU né display):
+
+  python CTOptimizerBenchmark.py --output risultati.json
+
+L'inserimento in sequenza richiede le librerie MRML ed è misurato solo dentro
+Slicer, ad esempio:
+
+  Slicer --no-main-window --python-script CTOptimizerBenchmark.py --output risultati.json
+
+Con --smoke il benchmark gira su un dataset minimo, in una cartella temporanea,
+e verifica solo che tutte le fasi producano risultati validi (test CTest).
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from CTOptimizerLib import memory, quantization  # noqa: E402
+from CTOptimizerLib.resampling import createResampler  # noqa: E402
+
+# Dimensioni IJK e numero di frame
+DEFAULT_DATASETS = ("256x256x256x10", "512x512x300x20")
+SMOKE_DATASET = "48x40x32x2"
+DEFAULT_SPACING = (0.4, 0.4, 0.5)
+STAGES = ("copy", "resample", "blockReduce", "quantize", "quantizeWindow", "insertion")
+
+
+class RSSSampler:
+  """Picco di RSS durante un blocco with, campionato da un thread in background"""
+
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.baseline = None
+    self.peak = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def sample(self):
+    rss = memory.currentRSS()
+    if rss is not None and (self.peak is None or rss > self.peak):
+      self.peak = rss
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      self.sample()
+
+  def __enter__(self):
+    self.baseline = memory.currentRSS()
+    self.peak = self.baseline
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self._stop.set()
+    self._thread.join()
+    self.sample()
+
+
+def parseDataset(text):
+  """'IxJxKxT' -> (dimensioni IJK, numero di frame)"""
+  values = [int(v) for v in text.lower().split("x")]
+  if len(values) != 4:
+    raise argparse.ArgumentTypeError(f"Dataset non valido: {text} (atteso IxJxKxT)")
+  return tuple(values[:3]), values[3]
+
+
+def phantomFrame(shape, frameIndex, frameCount):
+  """
+  Frame sintetico int16 (KJI) con aria, corpo, pool ematico pulsante e rumore
+
+  I valori HU sono realistici così che quantizzazione e compressione lavorino
+  su dati con una distribuzione simile a quella di una CT cardiaca.
+  """
+  k, j, i = np.ogrid[:shape[0], :shape[1], :shape[2]]
+  cz, cy, cx = (n / 2.0 for n in shape)
+  body = ((j - cy) / (0.45 * shape[1])) ** 2 + ((i - cx) / (0.45 * shape[2])) ** 2 <= 1.0
+  phase = 1.0 + 0.15 * np.sin(2.0 * np.pi * frameIndex / max(1, frameCount))
+  radius = 0.15 * min(shape) * phase
+  heart = (k - cz) ** 2 + (j - cy) ** 2 + (i - cx) ** 2 <= radius ** 2
+
+  frame = np.full(shape, -1000, dtype=np.int16)
+  np.copyto(frame, np.int16(40), where=np.broadcast_to(body, shape))
+  np.copyto(frame, np.int16(350), where=heart)
+  rng = np.random.default_rng(frameIndex)
+  frame += rng.integers(-20, 21, size=shape[2], dtype=np.int16)[np.newaxis, np.newaxis, :]
+  return frame
+
+
+def slicerLogic():
+  """CTOptimizerLogic se il benchmark gira dentro Slicer, altrimenti None"""
+  try:
+    import slicer
+    if not hasattr(slicer, "vtkMRMLSequenceNode"):
+      return None
+    from CTOptimizer import CTOptimizerLogic
+    return CTOptimizerLogic()
+  except ImportError:
+    return None
+
+
+def measureStage(function, frames):
+  """Applica function a ogni frame; restituisce secondi totali e picco di RSS"""
+  seconds = 0.0
+  inputBytes = 0
+  with RSSSampler() as sampler:
+    for frameIndex, frame in frames:
+      startTime = time.perf_counter()
+      result = function(frameIndex, frame)
+      seconds += time.perf_counter() - startTime
+      inputBytes += frame.nbytes
+      del result
+  megabytes = inputBytes / (1024 * 1024)
+  return {
+    "seconds": seconds,
+    "megabytesPerSecond": megabytes / seconds if seconds > 0 else None,
+    "inputBytes": inputBytes,
+    "peakRSSBytes": sampler.peak,
+    "peakRSSDeltaBytes": sampler.peak - sampler.baseline if sampler.peak is not None and sampler.baseline is not None else None,
+  }
+
+
+def benchmarkDataset(size, frameCount, spacing, scaleFactor, bitDepth, logic=None):
+  """Misura tutte le fasi su una sequenza sintetica di frameCount frame di dimensioni size (IJK)"""
+  shape = tuple(size[::-1])
+
+  def frames():
+    # I frame sono generati fuori dal tempo misurato e rilasciati uno alla volta
+    for frameIndex in range(frameCount):
+      yield frameIndex, phantomFrame(shape, frameIndex, frameCount)
+
+  outputSpacing = [s / scaleFactor for s in spacing]
+  resampler = createResampler(shape, spacing, outputSpacing, "linear")
+  blockReducer = createResampler(shape, spacing, outputSpacing, "linear", "mean")
+
+  stages = {
+    "copy": measureStage(lambda index, frame: frame.copy(), frames()),
+    "resample": measureStage(lambda index, frame: resampler.resample(frame), frames()),
+    "blockReduce": measureStage(lambda index, frame: blockReducer.resample(frame), frames()),
+    "quantize": measureStage(lambda index, frame: quantization.quantize(frame, bitDepth), frames()),
+    "quantizeWindow": measureStage(lambda index, frame: quantization.quantizeWindow(frame, bitDepth), frames()),
+  }
+
+  if logic is not None:
+    import slicer
+    sequenceNode = slicer.vtkMRMLSequenceNode()
+    referenceVolume = slicer.vtkMRMLScalarVolumeNode()
+    referenceVolume.SetSpacing(spacing)
+
+    def insert(frameIndex, frame):
+      return logic.addFrameToSequence(sequenceNode, referenceVolume, str(frameIndex), frame, spacing, {})
+
+    stages["insertion"] = measureStage(insert, frames())
+    sequenceNode.RemoveAllDataNodes()
+  else:
+    stages["insertion"] = {"skipped": "richiede Slicer (librerie MRML)"}
+
+  return {
+    "name": "x".join(str(n) for n in size) + f"x{frameCount}",
+    "size": list(size),
+    "frames": frameCount,
+    "spacing": list(spacing),
+    "frameBytes": int(np.prod(shape)) * 2,
+    "stages": stages,
+  }
+
+
+def environmentInfo(logic):
+  info = {
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "cpuCount": os.cpu_count(),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "slicer": None,
+  }
+  if logic is not None:
+    import slicer
+    info["slicer"] = slicer.app.applicationVersion
+  return info
+
+
+def compareResults(current, previous):
+  """Righe di confronto del throughput per dataset e fase (rapporto > 1 = più veloce)"""
+  previousDatasets = {dataset["name"]: dataset for dataset in previous.get("datasets", [])}
+  lines = []
+  for dataset in current["datasets"]:
+    before = previousDatasets.get(dataset["name"])
+    if before is None:
+      continue
+    for stage, result in dataset["stages"].items():
+      old = before["stages"].get(stage, {})
+      if result.get("megabytesPerSecond") and old.get("megabytesPerSecond"):
+        ratio = result["megabytesPerSecond"] / old["megabytesPerSecond"]
+        lines.append(f"{dataset['name']} {stage}: {old['megabytesPerSecond']:.0f} -> "
+                     f"{result['megabytesPerSecond']:.0f} MB/s ({ratio:.2f}x)")
+  return lines
+
+
+def validateResults(results):
+  """Errori dei risultati (lista vuota se ogni fase misurata ha tempi e throughput validi)"""
+  errors = []
+  for dataset in results["datasets"]:
+    for stage in STAGES:
+      result = dataset["stages"].get(stage)
+      if result is None:
+        errors.append(f"{dataset['name']} {stage}: fase mancante")
+      elif "skipped" not in result and not (result["seconds"] > 0 and result["inputBytes"] > 0):
+        errors.append(f"{dataset['name']} {stage}: risultato non valido {result}")
+  return errors
+
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description="Benchmark delle fasi di CTOptimizer")
+  parser.add_argument("--dataset", action="append", type=parseDataset,
+                      help=f"dimensioni IxJxKxT (ripetibile, predefiniti: {', '.join(DEFAULT_DATASETS)})")
+  parser.add_argument("--spacing", type=float, nargs=3, default=DEFAULT_SPACING, metavar=("I", "J", "K"))
+  parser.add_argument("--scale", type=float, default=0.5, help="fattore di scala del ricampionamento")
+  parser.add_argument("--bit-depth", type=int, default=12, choices=(8, 12))
+  parser.add_argument("--output", default="ctoptimizer_benchmark.json", help="file JSON dei risultati")
+  parser.add_argument("--compare", help="file JSON di un'esecuzione precedente da confrontare")
+  parser.add_argument("--smoke", action="store_true",
+                      help=f"esecuzione di verifica su {SMOKE_DATASET} con risultati in una cartella temporanea")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parseArguments(sys.argv[1:] if argv is None else argv)
+  if args.smoke:
+    with tempfile.TemporaryDirectory() as directory:
+      return run(args, [parseDataset(SMOKE_DATASET)], os.path.join(directory, "smoke.json"))
+  return run(args, args.dataset or [parseDataset(text) for text in DEFAULT_DATASETS], args.output)
+
+
+def run(args, datasets, outputPath):
+  logic = slicerLogic()
+
+  results = {"environment": environmentInfo(logic), "datasets": []}
+  for size, frameCount in datasets:
+    print(f"Benchmark {'x'.join(str(n) for n in size)}x{frameCount}...")
+    dataset = benchmarkDataset(size, frameCount, tuple(args.spacing), args.scale, args.bit_depth, logic)
+    results["datasets"].append(dataset)
+    for stage in STAGES:
+      result = dataset["stages"][stage]
+      if "skipped" in result:
+        print(f"  {stage}: saltato ({result['skipped']})")
+      else:
+        peak = result["peakRSSBytes"] / (1024 * 1024) if result["peakRSSBytes"] is not None else float("nan")
+        print(f"  {stage}: {result['seconds']:.2f} s, {result['megabytesPerSecond']:.0f} MB/s, picco RSS {peak:.0f} MB")
+
+  with open(outputPath, "w", encoding="utf-8") as f:
+    json.dump(results, f, indent=2)
+  print(f"Risultati salvati in {outputPath}")
+
+  if args.smoke:
+    with open(outputPath, "r", encoding="utf-8") as f:
+      errors = validateResults(json.load(f))
+    for error in errors:
+      print(f"ERRORE {error}")
+    return 1 if errors else 0
+
+  if args.compare:
+    with open(args.compare, "r", encoding="utf-8") as f:
+      previous = json.load(f)
+    for line in compareResults(results, previous):
+      print(line)
+  return 0
+
+
+if __name__ == "__main__":
+  exitCode = main()
+  try:
+    import slicer
+    if hasattr(slicer, "app"):
+      slicer.util.exit(exitCode)
+  except ImportError:
+    pass
+  sys.exit(exitCode)
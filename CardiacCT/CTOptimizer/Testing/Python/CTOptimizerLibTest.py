@@ -0,0 +1,764 @@
+"""
+Test unitari dei kernel NumPy di CTOptimizerLib.
+
+Non richiedono Slicer: possono essere eseguiti con un normale interprete Python
+
+  python -m unittest CTOptimizerLibTest
+
+oppure come test del modulo dentro Slicer.
+"""
+import gzip
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from CTOptimizerLib import (batch, cache, cropping, decoding, nifti, packing, phases, pipeline,  # noqa: E402
+                            pyramid, quantization, resampling, store, temporal)
+
+
+class SeparableResamplerTest(unittest.TestCase):
+
+  shape = (20, 33, 47)
+  spacing = (0.7, 0.7, 1.25)
+
+  def ramp(self, dtype=np.float32):
+    """Valori lineari negli indici: 3 i + 5 j + 7 k"""
+    k, j, i = np.indices(self.shape)
+    return (3 * i + 5 * j + 7 * k).astype(dtype)
+
+  def samplePositions(self, resampler):
+    """Posizioni (in voxel di input, ordine KJI) dei voxel di output lungo ogni asse"""
+    steps = [o / s for o, s in zip(resampler.outputSpacing[::-1], self.spacing[::-1])]
+    return [np.arange(n) * step for n, step in zip(resampler.outputShape, steps)]
+
+  def test_outputGridMatchesCLI(self):
+    for outputSpacing in ((1.0, 1.3, 2.0), (0.5, 0.7, 2.5), (0.7, 0.7, 1.25)):
+      with self.subTest(outputSpacing=outputSpacing):
+        resampler = resampling.createResampler(self.shape, self.spacing, outputSpacing)
+        # Dimensioni come ResampleScalarVolume: int(n * spacing / nuovo spacing), almeno 1
+        expected = tuple(max(1, int(n * s / o)) for n, s, o in zip(self.shape[::-1], self.spacing, outputSpacing))
+        self.assertEqual(resampler.outputShape, expected[::-1])
+        self.assertEqual(resampler.outputSpacing, outputSpacing)
+        # Il primo voxel di output coincide con il primo voxel di input (stessa origine)
+        self.assertEqual(resampler.voxelOffset, (0.0, 0.0, 0.0))
+        self.assertTrue(resampler.matches(self.shape, self.spacing, outputSpacing))
+        self.assertFalse(resampler.matches(self.shape, self.spacing, (2.0, 2.0, 2.0)))
+
+  def test_linearSamplesOutputVoxelPositions(self):
+    array = self.ramp()
+    for outputSpacing in ((1.0, 1.3, 2.0), (0.5, 0.45, 2.5)):
+      with self.subTest(outputSpacing=outputSpacing):
+        resampler = resampling.createResampler(self.shape, self.spacing, outputSpacing, "linear")
+        k, j, i = np.meshgrid(*[np.minimum(positions, n - 1) for positions, n in
+                                zip(self.samplePositions(resampler), self.shape)], indexing="ij")
+        # Oltre l'ultimo voxel il bordo è replicato
+        np.testing.assert_allclose(resampler.resample(array), 3 * i + 5 * j + 7 * k, atol=1e-3)
+
+  def test_nearestAndCubic(self):
+    array = self.ramp()
+    outputSpacing = (1.0, 1.3, 2.0)
+    nearest = resampling.createResampler(self.shape, self.spacing, outputSpacing, "nearest")
+    indices = [np.clip(np.rint(positions), 0, n - 1).astype(int)
+               for positions, n in zip(self.samplePositions(nearest), self.shape)]
+    np.testing.assert_array_equal(nearest.resample(array), array[np.ix_(*indices)])
+    # Il kernel cubico conserva i valori costanti
+    cubic = resampling.createResampler(self.shape, self.spacing, outputSpacing, "cubic")
+    constant = np.full(self.shape, 250.0, dtype=np.float32)
+    np.testing.assert_allclose(cubic.resample(constant), 250.0, rtol=1e-6)
+
+  def test_integerOutputRoundedAndSaturated(self):
+    array = self.ramp(np.int16)
+    array[0, 0, 0] = 32767
+    resampler = resampling.createResampler(self.shape, self.spacing, (1.0, 1.3, 2.0), "cubic")
+    result = resampler.resample(array)
+    self.assertEqual(result.dtype, np.int16)
+    reference = resampler.resample(array.astype(np.float32))
+    np.testing.assert_array_equal(result, np.clip(np.rint(reference), -32768, 32767).astype(np.int16))
+    self.assertLessEqual(resampler.peakWorkingBytes(2), 12 * array.size)
+
+  def test_identityAndErrors(self):
+    array = self.ramp(np.int16)
+    identity = resampling.createResampler(self.shape, self.spacing, self.spacing)
+    result = identity.resample(array)
+    self.assertIsNot(result, array)
+    np.testing.assert_array_equal(result, array)
+    with self.assertRaises(ValueError):
+      identity.resample(array[1:])
+    with self.assertRaises(ValueError):
+      resampling.createResampler(self.shape, self.spacing, self.spacing, "lanczos")
+
+
+class BlockReducerTest(unittest.TestCase):
+
+  spacing = (0.5, 0.5, 1.0)
+
+  def setUp(self):
+    rng = np.random.default_rng(7)
+    self.values = rng.integers(-1024, 3000, size=(13, 22, 31)).astype(np.int16)
+
+  def blocks(self, array, factors):
+    """Vista (nk, fk, nj, fj, ni, fi) dei blocchi completi, fattori IJK"""
+    fi, fj, fk = factors
+    nk, nj, ni = array.shape[0] // fk, array.shape[1] // fj, array.shape[2] // fi
+    return array[:nk * fk, :nj * fj, :ni * fi].reshape(nk, fk, nj, fj, ni, fi)
+
+  def test_meanAndMax(self):
+    for factors in ((2, 2, 1), (3, 2, 2), (4, 1, 3)):
+      with self.subTest(factors=factors):
+        blocks = self.blocks(self.values, factors)
+        mean = resampling.BlockReducer(self.values.shape, self.spacing, factors, "mean")
+        result = mean.resample(self.values)
+        self.assertEqual(result.dtype, np.int16)
+        # Voxel in eccesso sul bordo finale scartati
+        self.assertEqual(result.shape, blocks.shape[::2])
+        expected = blocks.astype(np.float64).mean(axis=(1, 3, 5))
+        self.assertLessEqual(np.abs(result - expected).max(), 0.5 + 1e-3)
+        maximum = resampling.BlockReducer(self.values.shape, self.spacing, factors, "max")
+        np.testing.assert_array_equal(maximum.resample(self.values), blocks.max(axis=(1, 3, 5)))
+        self.assertEqual(mean.outputSpacing, tuple(s * f for s, f in zip(self.spacing, factors)))
+        # Primo voxel di output al centro del primo blocco
+        self.assertEqual(mean.voxelOffset, tuple((f - 1) / 2 for f in factors))
+
+  def test_integerFactors(self):
+    self.assertEqual(resampling.integerFactors(self.spacing, (1.0, 1.0005, 2.5)), (2, 2, None))
+    self.assertEqual(resampling.integerFactors(self.spacing, (0.5, 0.25, 3.0)), (1, None, 3))
+
+  def test_createResampler(self):
+    shape = self.values.shape
+    self.assertIsInstance(resampling.createResampler(shape, self.spacing, (1.0, 1.0, 2.0), reduction="mean"),
+                          resampling.BlockReducer)
+    self.assertIsInstance(resampling.createResampler(shape, self.spacing, (1.0, 1.0, 2.0)),
+                          resampling.SeparableResampler)
+    self.assertIsInstance(resampling.createResampler(shape, self.spacing, (0.7, 0.7, 1.3), reduction="mean"),
+                          resampling.SeparableResampler)
+    # Assi interi ridotti a blocchi, poi interpolazione sugli altri
+    chain = resampling.createResampler(shape, self.spacing, (1.0, 1.0, 2.5), reduction="max")
+    self.assertIsInstance(chain, resampling.ResamplerChain)
+    self.assertEqual([type(stage) for stage in chain.stages],
+                     [resampling.BlockReducer, resampling.SeparableResampler])
+    self.assertEqual(chain.outputSpacing, (1.0, 1.0, 2.5))
+    self.assertEqual(chain.outputShape, (5, 11, 15))
+    self.assertEqual(chain.voxelOffset, (0.5, 0.5, 0.0))
+    self.assertEqual(chain.resample(self.values).shape, chain.outputShape)
+    with self.assertRaises(ValueError):
+      resampling.BlockReducer(shape, self.spacing, (2, 2, 2), "median")
+
+  def test_reconstructionError(self):
+    constant = np.full((12, 16, 20), 100, dtype=np.int16)
+    reducer = resampling.createResampler(constant.shape, self.spacing, (1.0, 1.0, 2.0), reduction="mean")
+    error = resampling.reconstructionError(constant, reducer.resample(constant), self.spacing,
+                                           reducer.outputSpacing, reducer.voxelOffset)
+    self.assertEqual(error, {"rmse": 0.0, "meanAbsError": 0.0, "maxAbsError": 0.0, "meanBias": 0.0})
+    # Rampa lineare: l'offset del primo voxel riduce l'errore (esatto lontano dai bordi)
+    k, j, i = np.indices(constant.shape)
+    ramp = (4.0 * i + 6.0 * j + 10.0 * k).astype(np.float32)
+    reduced = reducer.resample(ramp)
+    withOffset = resampling.reconstructionError(ramp, reduced, self.spacing, reducer.outputSpacing, reducer.voxelOffset)
+    withoutOffset = resampling.reconstructionError(ramp, reduced, self.spacing, reducer.outputSpacing)
+    self.assertLess(withOffset["rmse"], 0.5 * withoutOffset["rmse"])
+    self.assertAlmostEqual(withOffset["meanBias"], 0.0, places=3)
+
+
+class PyramidTest(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(9)
+    self.values = rng.integers(-1024, 3000, size=(18, 37, 42)).astype(np.int16)
+
+  def reduced(self, array, factor):
+    factors = pyramid.levelFactors(array.shape, factor)
+    return resampling.BlockReducer(array.shape, (1.0, 1.0, 1.0), factors, "mean").resample(array)
+
+  def test_levelsFromPreviousLevel(self):
+    array = self.values.astype(np.float32)
+    levels = pyramid.buildPyramid(array)
+    self.assertEqual([factor for factor, _ in levels], list(pyramid.DEFAULT_LEVELS))
+    self.assertEqual([level.shape for _, level in levels], [(9, 18, 21), (4, 9, 10)])
+    # Il livello 4 calcolato dal livello 2 coincide con la media diretta su blocchi 4x4x4
+    np.testing.assert_allclose(levels[0][1], self.reduced(array, 2), rtol=1e-6)
+    np.testing.assert_allclose(levels[1][1], self.reduced(array, 4), rtol=1e-5, atol=1e-3)
+    # Codici interi: stesso dtype, differenza entro l'arrotondamento del livello intermedio
+    integerLevels = pyramid.buildPyramid(self.values)
+    self.assertEqual(integerLevels[1][1].dtype, np.int16)
+    self.assertLessEqual(np.abs(integerLevels[1][1].astype(int) - self.reduced(self.values, 4)).max(), 1)
+
+  def test_factorsAndBytes(self):
+    # Fattori limitati dalle dimensioni dei singoli assi
+    shape = (3, 40, 40)
+    factors = pyramid.pyramidFactors(shape)
+    self.assertEqual(factors, {2: (2, 2, 2), 4: (4, 4, 2)})
+    levels = pyramid.buildPyramid(np.zeros(shape, dtype=np.uint16))
+    self.assertEqual([level.shape for _, level in levels], [(1, 20, 20), (1, 10, 10)])
+    self.assertEqual(pyramid.pyramidBytes(shape, 2), sum(level.nbytes for _, level in levels))
+    # Un livello non multiplo del precedente è calcolato dal frame; i fattori <= 1 sono ignorati
+    levels = pyramid.buildPyramid(self.values, (1, 3, 2))
+    self.assertEqual([factor for factor, _ in levels], [2, 3])
+    np.testing.assert_array_equal(levels[1][1], self.reduced(self.values, 3))
+    self.assertEqual(pyramid.pyramidBytes(self.values.shape, 2, (1, 3, 2)), sum(level.nbytes for _, level in levels))
+
+  def test_levelsString(self):
+    self.assertEqual(pyramid.levelsToString(pyramid.DEFAULT_LEVELS), "2,4")
+    self.assertEqual(pyramid.levelsFromString("2,4"), pyramid.DEFAULT_LEVELS)
+    self.assertEqual(pyramid.levelsFromString(""), ())
+    self.assertEqual(pyramid.levelsFromString(pyramid.levelsToString((2, 8))), (2, 8))
+
+
+class QuantizationTest(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(3)
+    self.values = rng.integers(-1024, 3000, size=(21, 16, 18)).astype(np.int16)
+
+  def test_storageDtype(self):
+    self.assertEqual([quantization.storageDtype(bitDepth) for bitDepth in (4, 8, 10, 12, 16)],
+                     [np.uint8, np.uint8, np.uint16, np.uint16, np.uint16])
+    with self.assertRaises(ValueError):
+      quantization.storageDtype(24)
+
+  def test_quantize(self):
+    for bitDepth in (8, 12, 16):
+      with self.subTest(bitDepth=bitDepth):
+        codes, parameters = quantization.quantize(self.values, bitDepth)
+        levels = (1 << bitDepth) - 1
+        self.assertEqual(codes.dtype, quantization.storageDtype(bitDepth))
+        self.assertEqual((int(codes.min()), int(codes.max())), (0, levels))
+        self.assertEqual((parameters["min"], parameters["max"]), (self.values.min(), self.values.max()))
+        self.assertAlmostEqual(parameters["scale"], (int(self.values.max()) - int(self.values.min())) / levels)
+        self.assertEqual(parameters["mode"], quantization.MODE_RANGE)
+        # Codici arrotondati al livello più vicino: errore entro mezzo passo
+        decoded = codes * parameters["scale"] + parameters["offset"]
+        self.assertLessEqual(np.abs(decoded - self.values).max(), parameters["scale"] / 2 + 1e-3)
+        # Il risultato non dipende dalla dimensione dei blocchi
+        chunked, _ = quantization.quantize(self.values, bitDepth, chunkVoxels=1000)
+        np.testing.assert_array_equal(chunked, codes)
+
+  def test_quantizeFixedRangeAndConstant(self):
+    codes, parameters = quantization.quantize(self.values, 8, -200, 800)
+    self.assertEqual(codes[self.values <= -200].max(), 0)
+    self.assertEqual(codes[self.values >= 800].min(), 255)
+    self.assertEqual(parameters["offset"], -200.0)
+    constant = np.full((4, 5, 6), 40, dtype=np.int16)
+    codes, parameters = quantization.quantize(constant, 12)
+    self.assertEqual(parameters["scale"], 1.0)
+    np.testing.assert_array_equal(codes * parameters["scale"] + parameters["offset"], constant)
+
+  def test_quantizeWindowExactlyReversible(self):
+    values = self.values.copy()
+    values[0, 0, :4] = (-3000, -1025, 3072, 5000)
+    lower, upper = quantization.CLINICAL_WINDOW_HU
+    for chunkVoxels in (quantization.DEFAULT_CHUNK_VOXELS, 500):
+      codes, parameters = quantization.quantizeWindow(values, chunkVoxels=chunkVoxels)
+      self.assertEqual(codes.dtype, np.uint16)
+      self.assertEqual((parameters["scale"], parameters["offset"]), (1.0, float(lower)))
+      self.assertEqual(parameters["mode"], quantization.MODE_WINDOW)
+      # Codice = HU - inizio finestra: decodifica esatta dentro la finestra, saturazione fuori
+      np.testing.assert_array_equal(codes * parameters["scale"] + parameters["offset"], np.clip(values, lower, upper))
+      # Stessi codici del percorso generico con la finestra come intervallo fisso
+      generic, _ = quantization.quantize(values, 12, lower, upper)
+      np.testing.assert_array_equal(codes, generic)
+    # Input senza segno: il dtype di lavoro contiene anche i valori negativi della finestra
+    unsigned = np.array([[[0, 1000, 3071, 4000, 65535]]], dtype=np.uint16)
+    codes, _ = quantization.quantizeWindow(unsigned)
+    np.testing.assert_array_equal(codes, [[[1024, 2024, 4095, 4095, 4095]]])
+
+  def test_quantizeWindowGenericPath(self):
+    # Finestra più ampia dei livelli o input float: stesso risultato di quantize sulla finestra
+    for array, bitDepth, window in ((self.values, 8, quantization.CLINICAL_WINDOW_HU),
+                                    (self.values, 12, (-200, 800)),
+                                    (self.values.astype(np.float32) + 0.25, 12, quantization.CLINICAL_WINDOW_HU)):
+      with self.subTest(dtype=array.dtype.name, bitDepth=bitDepth, window=window):
+        codes, parameters = quantization.quantizeWindow(array, bitDepth, window)
+        expected, expectedParameters = quantization.quantize(array, bitDepth, *window)
+        np.testing.assert_array_equal(codes, expected)
+        self.assertEqual(parameters["scale"], expectedParameters["scale"])
+        self.assertEqual(parameters["mode"], quantization.MODE_WINDOW)
+
+  def test_frameAttributes(self):
+    _, parameters = quantization.quantize(self.values, 12)
+    attributes = quantization.frameAttributes(parameters)
+    self.assertEqual(attributes["CTOptimizer_BitDepth"], "12")
+    # Scala e offset scritti senza perdita di precisione
+    self.assertEqual(float(attributes["CTOptimizer_DecodeScale"]), parameters["scale"])
+    self.assertEqual(float(attributes["CTOptimizer_DecodeOffset"]), parameters["offset"])
+
+
+class StoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, "sequenza.ct4d")
+    rng = np.random.default_rng(0)
+    self.frames = [rng.integers(-1024, 3000, size=(37, 20, 24)).astype(np.int16) for _ in range(3)]
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def writeFrames(self, compression):
+    with store.StoreWriter(self.path, compression, chunkSlices=8, workers=2, sequenceInfo={"name": "test"}) as writer:
+      for index, frame in enumerate(self.frames):
+        writer.addFrame(frame, indexValue=index * 10, name=f"frame{index}", ijkToRAS=np.diag([-1, -1, 1, 1]),
+                        attributes={"CTOptimizer_BitDepth": "12"})
+
+  def test_roundTrip(self):
+    for compression in store.COMPRESSIONS:
+      with self.subTest(compression=compression):
+        self.writeFrames(compression)
+        reader = store.StoreReader(self.path)
+        self.assertEqual(reader.frameCount, len(self.frames))
+        self.assertEqual(reader.sequenceInfo, {"name": "test"})
+        for index, frame in enumerate(self.frames):
+          np.testing.assert_array_equal(reader.readFrame(index), frame)
+          np.testing.assert_array_equal(reader.readSlab(index, 5, 19), frame[5:19])
+          info = reader.frameInfo(index)
+          self.assertEqual(info["indexValue"], str(index * 10))
+          self.assertEqual(info["attributes"], {"CTOptimizer_BitDepth": "12"})
+          self.assertEqual(info["ijkToRAS"][0], -1.0)
+        if compression == "none":
+          np.testing.assert_array_equal(reader.memmapFrame(1), self.frames[1])
+
+  def test_exceptionRemovesIncompleteFile(self):
+    with self.assertRaises(RuntimeError):
+      with store.StoreWriter(self.path, "zlib") as writer:
+        writer.addFrame(self.frames[0])
+        raise RuntimeError("interrotto")
+    self.assertFalse(os.path.exists(self.path))
+
+
+class CacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.frame = np.random.default_rng(4).integers(-1024, 3000, size=(12, 10, 8)).astype(np.int16)
+
+  def test_frameKeyWithFrameValueRange(self):
+    # Range calcolato come in sequenceValueRange: scalari NumPy int16
+    valueRange = (self.frame.min(), self.frame.max())
+    options = pipeline.frameOptions(valueRange=valueRange, cropBox=((np.int64(1), np.int64(11)), (0, 10), (0, 8)),
+                                    window=(np.int16(-100), np.int16(600)))
+    key = cache.frameKey(self.frame, (0.5, 0.5, 0.6), options)
+    self.assertEqual(key, cache.frameKey(self.frame, (0.5, 0.5, 0.6), pipeline.frameOptions(
+      valueRange=[float(v) for v in valueRange], cropBox=((1, 11), (0, 10), (0, 8)), window=(-100.0, 600.0))))
+
+  def test_frameKeyOfStridedView(self):
+    # Frame come vista non contigua di un array 4D (componenti di un MultiVolume)
+    multiVolume = np.stack([self.frame, self.frame + 1, self.frame + 2], axis=-1)
+    view = multiVolume[..., 1]
+    self.assertFalse(view.flags.c_contiguous)
+    options = pipeline.frameOptions()
+    self.assertEqual(cache.frameKey(view, (1, 1, 1), options),
+                     cache.frameKey(np.ascontiguousarray(view), (1, 1, 1), options))
+    self.assertNotEqual(cache.frameKey(view, (1, 1, 1), options), cache.frameKey(self.frame, (1, 1, 1), options))
+
+
+class PackingTest(unittest.TestCase):
+
+  def test_roundTrip(self):
+    rng = np.random.default_rng(1)
+    for shape in ((4, 6, 8), (3, 5, 7)):
+      with self.subTest(shape=shape):
+        codes = rng.integers(0, 4096, size=shape).astype(np.uint16)
+        codes.flat[0] = 0
+        codes.flat[-1] = 4095
+        packed = packing.pack12(codes)
+        self.assertEqual(packed.dtype, np.uint8)
+        self.assertEqual(packed.size, packing.packedSize(codes.size))
+        np.testing.assert_array_equal(packing.unpack12(packed, shape), codes)
+
+  def test_unpackIntoBuffer(self):
+    codes = np.arange(4096, dtype=np.uint16).reshape(16, 16, 16)
+    out = np.empty(codes.shape, dtype=np.uint16)
+    self.assertIs(packing.unpack12(packing.pack12(codes), codes.shape, out=out), out)
+    np.testing.assert_array_equal(out, codes)
+
+
+class CroppingTest(unittest.TestCase):
+
+  def test_heartBoundingBoxContainsBlock(self):
+    # Blocco di pool ematico con estremi non allineati alla griglia sottocampionata
+    for offset in range(4):
+      with self.subTest(offset=offset):
+        array = np.full((64, 72, 80), -1000, dtype=np.int16)
+        block = ((10 + offset, 30 + offset), (9 + offset, 45), (7, 50 + offset))
+        array[tuple(slice(start, stop) for start, stop in block)] = 300
+        box = cropping.heartBoundingBox(array, downsample=4)
+        for (start, stop), (blockStart, blockStop) in zip(box, block):
+          self.assertLessEqual(start, blockStart)
+          self.assertGreaterEqual(stop, blockStop)
+          # Non più di un passo di sottocampionamento in eccesso per lato
+          self.assertGreater(start, blockStart - 4)
+          self.assertLess(stop, blockStop + 4)
+
+  def test_heartBoundingBoxEmpty(self):
+    self.assertIsNone(cropping.heartBoundingBox(np.full((16, 16, 16), -1000, dtype=np.int16)))
+
+
+class PhasesTest(unittest.TestCase):
+
+  # Ciclo di 8 frame: ED in 0, eiezione rapida fino a ES in 4, riempimento più lento
+  volumes = [100.0, 60.0, 55.0, 52.0, 50.0, 70.0, 90.0, 95.0]
+
+  def test_bloodPoolVolume(self):
+    array = np.full((32, 32, 32), -1000, dtype=np.int16)
+    array[8:24, 4:20, 12:28] = 300
+    spacing = (0.5, 0.5, 1.0)
+    exact = 16 ** 3 * 0.25 / 1000.0
+    for downsample in (1, 2, 4):
+      with self.subTest(downsample=downsample):
+        self.assertAlmostEqual(phases.bloodPoolVolume(array, spacing, downsample=downsample), exact)
+    # Solo i voxel nel box (limitato alla forma del frame)
+    self.assertAlmostEqual(phases.bloodPoolVolume(array, spacing, ((16, 40), (0, 32), (0, 32)), downsample=1),
+                           exact / 2)
+    self.assertEqual(phases.bloodPoolVolume(array, spacing, ((0, 8), (0, 32), (0, 32))), 0.0)
+
+  def test_selectEveryK(self):
+    self.assertEqual(phases.endPhases(self.volumes), (0, 4))
+    self.assertEqual(phases.selectEveryK(self.volumes, 3), [0, 3, 4, 6])
+    # ED non al primo frame: il passo parte da ED e il ciclo si chiude
+    rotated = self.volumes[5:] + self.volumes[:5]
+    self.assertEqual(phases.endPhases(rotated), (3, 7))
+    self.assertEqual(phases.selectEveryK(rotated, 3), [1, 3, 6, 7])
+    self.assertEqual(phases.selectEveryK(self.volumes, 0), list(range(8)))
+
+  def test_selectByVolume(self):
+    # Variazione cumulativa 0, 40, 45, 48, 50, 70, 90, 95 (totale 100): fasi a 0, 25, 50, 75
+    self.assertEqual(phases.selectByVolume(self.volumes, 4), [0, 1, 4, 5])
+    self.assertEqual(phases.selectByVolume(self.volumes, 0), [0, 4])
+    # Curva piatta: ED e ES coincidono
+    self.assertEqual(phases.selectByVolume([10.0] * 6, 3), [0])
+
+  def test_selectPhases(self):
+    self.assertEqual(phases.selectPhases([], phases.SELECTION_VOLUME), [])
+    self.assertEqual(phases.selectPhases(self.volumes, phases.SELECTION_STEP, step=3), [0, 3, 4, 6])
+    self.assertEqual(phases.selectPhases(self.volumes, phases.SELECTION_VOLUME, phaseCount=4), [0, 1, 4, 5])
+    with self.assertRaises(ValueError):
+      phases.selectPhases(self.volumes, "random")
+
+  def test_phaseAttributes(self):
+    frameIndices = list(range(10, 18))
+    indexValues = [str(10 * n) for n in range(8)]
+    attributes = phases.phaseAttributes(phases.SELECTION_VOLUME, frameIndices, indexValues, self.volumes,
+                                        [0, 1, 4, 5])
+    self.assertEqual(attributes["CTOptimizer_PhaseFrames"], "10,11,14,15")
+    self.assertEqual(attributes["CTOptimizer_PhaseIndexValues"], "0,10,40,50")
+    self.assertEqual((attributes["CTOptimizer_EDIndexValue"], attributes["CTOptimizer_ESIndexValue"]), ("0", "40"))
+    self.assertEqual(attributes["CTOptimizer_BloodPoolCurve"].split(",")[:2], ["100.00", "60.00"])
+
+
+class DecodingTest(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(4)
+    self.values = rng.integers(-1024, 3000, size=(13, 9, 10)).astype(np.int16)
+
+  def quantizedFrame(self, bitDepth):
+    codes, parameters = quantization.quantize(self.values, bitDepth)
+    return codes, quantization.frameAttributes(parameters)
+
+  def test_fromAttributes(self):
+    codes, attributes = self.quantizedFrame(12)
+    frame = decoding.DecodedFrame.fromAttributes(codes, attributes)
+    self.assertEqual((frame.scale, frame.offset, frame.bitDepth),
+                     (float(attributes["CTOptimizer_DecodeScale"]), float(attributes["CTOptimizer_DecodeOffset"]), 12))
+    # Senza scala/offset espliciti si ricavano da OriginalMin/OriginalMax
+    legacy = {name: value for name, value in attributes.items()
+              if name not in ("CTOptimizer_DecodeScale", "CTOptimizer_DecodeOffset")}
+    legacyFrame = decoding.DecodedFrame.fromAttributes(codes, legacy)
+    self.assertAlmostEqual(legacyFrame.scale, frame.scale)
+    self.assertAlmostEqual(legacyFrame.offset, frame.offset)
+    # Codici impacchettati a 12 bit
+    packed = dict(attributes, CTOptimizer_Packing=packing.PACKING_12BIT,
+                  CTOptimizer_PackedShape=",".join(str(n) for n in codes.shape))
+    packedFrame = decoding.DecodedFrame.fromAttributes(packing.pack12(codes), packed)
+    np.testing.assert_array_equal(packedFrame.codes, codes)
+    # Frame non quantizzati o attributi incompleti
+    self.assertIsNone(decoding.DecodedFrame.fromAttributes(self.values, {}))
+    self.assertIsNone(decoding.DecodedFrame.fromAttributes(codes, {"CTOptimizer_BitDepth": "12"}))
+
+  def test_toArray(self):
+    for bitDepth in (8, 12):
+      with self.subTest(bitDepth=bitDepth):
+        codes, attributes = self.quantizedFrame(bitDepth)
+        frame = decoding.DecodedFrame.fromAttributes(codes, attributes)
+        expected = (codes * np.float32(frame.scale) + np.float32(frame.offset)).astype(np.float32)
+        np.testing.assert_array_equal(frame.toArray(), expected)
+        out = np.empty(codes.shape, dtype=np.float32)
+        self.assertIs(frame.toArray(out=out, chunkVoxels=100), out)
+        np.testing.assert_array_equal(out, expected)
+        np.testing.assert_array_equal(frame[3:5, :, 2], expected[3:5, :, 2])
+        for slab, values in frame.slabs(chunkVoxels=200):
+          np.testing.assert_array_equal(values, expected[slab])
+        # Errore di ricostruzione entro mezzo passo di quantizzazione
+        self.assertLessEqual(np.abs(expected - self.values).max(), frame.scale / 2 + 1e-3)
+
+  def test_maskMatchesHUThresholds(self):
+    for bitDepth in (8, 12):
+      codes, attributes = self.quantizedFrame(bitDepth)
+      frame = decoding.DecodedFrame.fromAttributes(codes, attributes, dtype=np.float64)
+      values = frame.toArray()
+      # Soglie sui valori decodificati stessi: i confini cadono esattamente su un codice
+      step = frame.scale
+      for lower, upper in ((150, 500), (200, 400), (values[0, 0, 0], values[0, 0, 0]),
+                           (values[1, 2, 3] - step / 2, values[4, 5, 6]), (-5000, 5000), (400, 200)):
+        with self.subTest(bitDepth=bitDepth, lower=lower, upper=upper):
+          np.testing.assert_array_equal(frame.mask(lower, upper), (values >= lower) & (values <= upper))
+
+  def test_codeRange(self):
+    scale, offset = quantization.decodeParameters(-1024.0, 3071.0, 12)
+
+    def value(code):
+      return code * scale + offset
+
+    self.assertEqual(decoding.codeRange(value(10), value(20), scale, offset, 12), (10, 20))
+    first, last = decoding.codeRange(value(10) + 1e-6, value(20) - 1e-6, scale, offset, 12)
+    self.assertEqual((first, last), (11, 19))
+    self.assertEqual(decoding.codeRange(-5000, 5000, scale, offset, 12), (0, 4095))
+    # Intervallo tra due codici consecutivi: nessun codice
+    first, last = decoding.codeRange(value(10) + 0.1 * scale, value(10) + 0.9 * scale, scale, offset, 12)
+    self.assertGreater(first, last)
+    first, last = decoding.codeRange(4000, 5000, *quantization.decodeParameters(-1024.0, 255.0, 8), 8)
+    self.assertGreater(first, last)
+
+
+class TemporalTest(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(2)
+    self.reference = rng.integers(0, 4096, size=(10, 12, 14)).astype(np.uint16)
+
+  def test_sparseResidual(self):
+    codes = self.reference.copy()
+    codes[2, 3, 4] += 7
+    codes[9, 11, 13] -= 5
+    payload, info = temporal.encodeResidual(codes, self.reference, 12)
+    self.assertEqual(info["format"], temporal.FORMAT_SPARSE)
+    self.assertEqual(info["count"], 2)
+    np.testing.assert_array_equal(temporal.decodeResidual(self.reference, payload, info), codes)
+
+  def test_denseResidual(self):
+    codes = np.clip(self.reference.astype(np.int32) + np.random.default_rng(3).integers(-50, 50, self.reference.shape),
+                    0, 4095).astype(np.uint16)
+    payload, info = temporal.encodeResidual(codes, self.reference, 12)
+    self.assertEqual(info["format"], temporal.FORMAT_DENSE)
+    np.testing.assert_array_equal(temporal.decodeResidual(self.reference, payload, info), codes)
+
+  def test_tolerance(self):
+    codes = self.reference.astype(np.int32)
+    codes[0, 0, 0] += 1
+    codes[1, 1, 1] += 3
+    codes = codes.astype(np.uint16)
+    payload, info = temporal.encodeResidual(codes, self.reference, 12, tolerance=1)
+    decoded = temporal.decodeResidual(self.reference, payload, info)
+    self.assertEqual(decoded[0, 0, 0], self.reference[0, 0, 0])
+    self.assertEqual(decoded[1, 1, 1], codes[1, 1, 1])
+
+  def test_sequenceEncoder(self):
+    encoder = temporal.SequenceEncoder(bitDepth=12)
+    frames = [self.reference, self.reference + 1, self.reference.copy()]
+    frames[2][5, 5, 5] = 0
+    encoded = [encoder.encode(frame, index) for index, frame in enumerate(frames)]
+    self.assertEqual(encoded[0][1]["CTOptimizer_Temporal"], temporal.FRAME_REFERENCE)
+    for frame, (array, attributes) in zip(frames[1:], encoded[1:]):
+      info, shape, dtype, referenceIndexValue = temporal.parseResidualAttributes(attributes)
+      self.assertEqual((shape, dtype, referenceIndexValue), (frame.shape, frame.dtype, "0"))
+      np.testing.assert_array_equal(temporal.decodeResidual(self.reference, array, info), frame)
+
+  def encodedSequence(self, bitDepth):
+    """Frame di codici con poche variazioni, variazioni piccole diffuse e variazioni grandi sul 30% dei voxel"""
+    rng = np.random.default_rng(bitDepth)
+    dtype = np.uint8 if bitDepth <= 8 else np.uint16
+    top = (1 << bitDepth) - 1
+    reference = rng.integers(0, top + 1, size=(16, 18, 20)).astype(dtype)
+    sparse = reference.copy()
+    sparse[3, 4, 5] = top - sparse[3, 4, 5]
+    small = np.clip(reference.astype(np.int64) + rng.integers(-3, 4, reference.shape), 0, top).astype(dtype)
+    moving = reference.copy()
+    changed = rng.random(reference.shape) < 0.3
+    moving[changed] = rng.integers(0, top + 1, size=int(changed.sum())).astype(dtype)
+    return [reference, sparse, small, moving]
+
+  def test_sequenceEncoderRoundTrip(self):
+    for bitDepth in (8, 12, 16):
+      with self.subTest(bitDepth=bitDepth):
+        frames = self.encodedSequence(bitDepth)
+        encoder = temporal.SequenceEncoder(bitDepth)
+        for index, frame in enumerate(frames):
+          array, attributes = encoder.encode(frame, str(index))
+          self.assertLessEqual(array.nbytes, frame.nbytes)
+          # Decodifica come in CTOptimizerLogic.createFrameDecoder
+          residual = temporal.parseResidualAttributes(attributes)
+          if residual is None:
+            decoded = array
+          else:
+            info, shape, dtype, referenceIndexValue = residual
+            self.assertEqual(referenceIndexValue, "0")
+            decoded = temporal.decodeResidual(frames[0], array, info, out=np.empty(shape, dtype=dtype))
+          np.testing.assert_array_equal(decoded, frame)
+        # A 8 e 16 bit il residuo dei voxel in movimento non è conveniente: frame salvato invariato
+        if bitDepth != 12:
+          self.assertIs(encoder.encode(frames[3], "3")[0], frames[3])
+
+
+class NiftiTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    # Direzioni oblique con determinante negativo (fette dalla testa ai piedi) e spacing anisotropo
+    angle = np.radians(20.0)
+    rotation = np.array([[-np.cos(angle), np.sin(angle), 0.0],
+                         [-np.sin(angle), -np.cos(angle), 0.0],
+                         [0.0, 0.0, -1.0]])
+    self.ijkToRAS = np.eye(4)
+    self.ijkToRAS[:3, :3] = rotation @ np.diag([0.7, 0.6, 1.25])
+    self.ijkToRAS[:3, 3] = (120.5, -33.0, 410.0)
+    rng = np.random.default_rng(6)
+    self.values = rng.integers(-1024, 3000, size=(19, 12, 14)).astype(np.int16)
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def qformMatrix(self, fields):
+    """Matrice IJK -> RAS ricostruita dal quaternione e da pixdim (metodo 2 di NIfTI-1)"""
+    b, c, d = fields[46:49]
+    a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                         [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                         [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+    qfac, spacing = fields[22], np.array(fields[23:26])
+    rotation[:, 2] *= qfac
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation * spacing
+    matrix[:3, 3] = fields[49:52]
+    return matrix
+
+  def test_roundTrip(self):
+    codes, parameters = quantization.quantize(self.values, 12)
+    cases = {
+      "codici.nii.gz": (codes, parameters["scale"], parameters["offset"]),
+      "valori.nii": (self.values, 1.0, 0.0),
+      "bigEndian.nii": (self.values.astype(">i2"), 1.0, 0.0),
+      "float.nii.gz": (self.values.astype(np.float32) / 7, 1.0, 0.0),
+    }
+    for name, (array, scale, offset) in cases.items():
+      with self.subTest(file=name):
+        path = os.path.join(self.directory.name, name)
+        size = nifti.writeNifti(path, array, self.ijkToRAS, scale, offset, description="frame=3")
+        self.assertEqual(size, os.path.getsize(path))
+        readArray, affine, readScale, readOffset = nifti.readNifti(path)
+        np.testing.assert_array_equal(readArray, array)
+        self.assertEqual(readArray.dtype.newbyteorder("="), array.dtype.newbyteorder("="))
+        np.testing.assert_allclose(affine, self.ijkToRAS, atol=1e-4)
+        # scl_slope/scl_inter float32: valori HU ricostruiti entro la precisione dell'intestazione
+        self.assertAlmostEqual(readScale, scale, places=5)
+        self.assertAlmostEqual(readOffset, offset, places=3)
+        if array is codes:
+          decoded = readArray * readScale + readOffset
+          self.assertLessEqual(np.abs(decoded - self.values).max(), parameters["scale"] / 2 + 1e-2)
+
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "rb") as f:
+          data = f.read()
+        fields = nifti.HEADER.unpack_from(data)
+        self.assertEqual(fields[0], 348)
+        self.assertEqual(fields[65], b"n+1\0")
+        self.assertEqual(fields[7:11], (3, 14, 12, 19))
+        self.assertEqual((fields[19], fields[20]), (nifti.DATATYPES[array.dtype.newbyteorder("=")],
+                                                   array.dtype.itemsize * 8))
+        self.assertEqual(fields[30], nifti.VOX_OFFSET)
+        self.assertEqual(len(data), nifti.VOX_OFFSET + array.nbytes)
+        self.assertEqual(fields[35], nifti.NIFTI_UNITS_MM)
+        self.assertEqual(fields[44:46], (nifti.NIFTI_XFORM_SCANNER_ANAT, nifti.NIFTI_XFORM_SCANNER_ANAT))
+        self.assertEqual(fields[42].rstrip(b"\0"), b"frame=3")
+        np.testing.assert_allclose(fields[23:26], (0.7, 0.6, 1.25), rtol=1e-6)
+        self.assertEqual(fields[22], -1.0)
+        # qform e sform descrivono la stessa geometria
+        np.testing.assert_allclose(self.qformMatrix(fields), self.ijkToRAS, atol=1e-4)
+
+  def test_unsupportedDtype(self):
+    with self.assertRaises(ValueError):
+      nifti.niftiHeader((2, 2, 2), np.complex64, self.ijkToRAS)
+
+  def test_exportFramesManifest(self):
+    frames = [{"indexValue": index * 10, "file": nifti.frameFileName("seq", index, 3),
+               "array": self.values + index, "ijkToRAS": self.ijkToRAS} for index in range(3)]
+    entries = nifti.exportFrames(iter(frames), self.directory.name, level=1, workers=2)
+    self.assertEqual([entry["file"] for entry in entries], ["seq_000.nii.gz", "seq_001.nii.gz", "seq_002.nii.gz"])
+    self.assertEqual(entries[1]["shape"], [14, 12, 19])
+    for frame, entry in zip(frames, entries):
+      np.testing.assert_array_equal(nifti.readNifti(os.path.join(self.directory.name, entry["file"]))[0],
+                                    frame["array"])
+    manifestPath = os.path.join(self.directory.name, nifti.MANIFEST_NAME)
+    nifti.writeManifest(manifestPath, entries, {"sequence": "seq"})
+    with open(manifestPath, encoding="utf-8") as f:
+      self.assertEqual(json.load(f), {"sequence": "seq", "frames": entries})
+
+
+class BatchManifestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, batch.MANIFEST_NAME)
+    self.parameters = {"scaleFactor": 0.5, "bitDepth": 12, "targetSpacing": (0.8, 0.8, 1.0),
+                       "window": None, "outputFormat": "ct4d", "compression": "zlib"}
+    self.output = os.path.join(self.directory.name, "studio1.ct4d")
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def completeStudy(self, study):
+    manifest = batch.BatchManifest(self.path, self.parameters)
+    manifest.start(study)
+    with open(self.output, "wb") as f:
+      f.write(b"ct4d")
+    manifest.finish(study, output=self.output, frames=3)
+    manifest.start("/studi/studio2")
+    manifest.fail("/studi/studio2", RuntimeError("lettura non riuscita"))
+
+  def test_resumeSkipsCompletedStudies(self):
+    self.completeStudy("/studi/studio1")
+    manifest = batch.BatchManifest(self.path, dict(self.parameters))
+    self.assertTrue(manifest.isDone("/studi/studio1"))
+    self.assertFalse(manifest.isDone("/studi/studio2"))
+    self.assertEqual(manifest.entry("/studi/studio2")["error"], "lettura non riuscita")
+    self.assertEqual(manifest.summary(), {batch.STATUS_DONE: 1, batch.STATUS_FAILED: 1})
+
+  def test_missingOutputIsRedone(self):
+    self.completeStudy("/studi/studio1")
+    os.remove(self.output)
+    self.assertFalse(batch.BatchManifest(self.path, self.parameters).isDone("/studi/studio1"))
+
+  def test_noResumeStartsOver(self):
+    self.completeStudy("/studi/studio1")
+    manifest = batch.BatchManifest(self.path, dict(self.parameters, bitDepth=8), resume=False)
+    self.assertIsNone(manifest.entry("/studi/studio1"))
+    self.assertEqual(manifest.data["parameters"]["bitDepth"], 8)
+
+  def test_resumeWithDifferentParametersIsRefused(self):
+    self.completeStudy("/studi/studio1")
+    with self.assertRaises(ValueError) as context:
+      batch.BatchManifest(self.path, dict(self.parameters, bitDepth=8))
+    self.assertIn("bitDepth", str(context.exception))
+    # Il manifest esistente resta invariato
+    with open(self.path, "r", encoding="utf-8") as f:
+      self.assertEqual(json.load(f)["parameters"]["bitDepth"], 12)
+
+  def test_invalidCompressionRejectedUpFront(self):
+    with self.assertRaises(SystemExit):
+      batch.parseArguments(["/studi", "--output", "/out", "--compression", "zlip"])
+    self.assertEqual(batch.parseArguments(["/studi", "--output", "/out", "--compression", "lzma"]).compression, "lzma")
+
+
+class BenchmarkSmokeTest(unittest.TestCase):
+
+  def test_smoke(self):
+    import CTOptimizerBenchmark
+    self.assertEqual(CTOptimizerBenchmark.main(["--smoke"]), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
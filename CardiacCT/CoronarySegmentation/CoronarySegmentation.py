@@ -1,9 +1,10 @@
+import collections
 import os
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import numpy as np
-import heapq
+from CoronarySegmentationLib import costs, segments
 
 #
 # CoronarySegmentation
@@ -17,7 +18,7 @@ class CoronarySegmentation(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "Coronary Segmentation"
     self.parent.categories = ["Cardiac"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ["CTOptimizer"]
     self.parent.contributors = ["Your Name"]
     self.parent.helpText = """
     This module provides semi-automatic segmentation of coronary arteries using path finding algorithms.
@@ -34,6 +35,8 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
+    # Logica persistente: conserva i volumi dei costi tra un'esecuzione e l'altra
+    self.logic = CoronarySegmentationLogic()
 
     # Layout
     self.layout = self.parent.layout()
@@ -134,6 +137,27 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
     self.usePathFindingCheckBox.setToolTip("Usa algoritmo avanzato di path finding per creare una centerline accurata")
     pathFindingFormLayout.addRow("Usa Path Finding avanzato: ", self.usePathFindingCheckBox)
     
+    # Ricerca bidirezionale
+    self.bidirectionalCheckBox = qt.QCheckBox()
+    self.bidirectionalCheckBox.checked = False
+    self.bidirectionalCheckBox.setToolTip("Ricerca A* da entrambi i punti con criterio di arresto esatto: percorso di costo minimo, "
+                                          "con meno nodi espansi della ricerca esatta quando la ricerca esce dal vaso")
+    pathFindingFormLayout.addRow("Ricerca bidirezionale: ", self.bidirectionalCheckBox)
+    
+    # Ricerca esatta
+    self.exactSearchCheckBox = qt.QCheckBox()
+    self.exactSearchCheckBox.checked = False
+    self.exactSearchCheckBox.setToolTip("Ricerca unidirezionale con euristica ammissibile: percorso di costo minimo come la "
+                                        "bidirezionale ma più nodi espansi. Senza, l'euristica è più forte (meno nodi) "
+                                        "ma il percorso non è garantito di costo minimo")
+    pathFindingFormLayout.addRow("Ricerca esatta: ", self.exactSearchCheckBox)
+    
+    # Segmenti in parallelo
+    self.parallelSegmentsCheckBox = qt.QCheckBox()
+    self.parallelSegmentsCheckBox.checked = False
+    self.parallelSegmentsCheckBox.setToolTip("Cerca i percorsi tra tutte le coppie di punti contemporaneamente in processi separati")
+    pathFindingFormLayout.addRow("Segmenti in parallelo: ", self.parallelSegmentsCheckBox)
+    
     # Peso di vascolarità
     self.vascularitySlider = ctk.ctkSliderWidget()
     self.vascularitySlider.singleStep = 0.1
@@ -215,6 +239,9 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
     usePathFinding = self.usePathFindingCheckBox.checked
     vascularityWeight = self.vascularitySlider.value
     smoothingFactor = self.smoothingFactorSlider.value
+    bidirectional = self.bidirectionalCheckBox.checked
+    exactSearch = self.exactSearchCheckBox.checked
+    parallelSegments = self.parallelSegmentsCheckBox.checked
     
     # Verifica se abbiamo abbastanza punti
     if fiducialNode.GetNumberOfControlPoints() < 2:
@@ -222,7 +249,7 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
       return
     
     # Esegui l'algoritmo
-    logic = CoronarySegmentationLogic()
+    logic = self.logic
     try:
       # Passaggio 1: Crea centerline
       self.statusLabel.text = "Stato: Creazione centerline..."
@@ -230,7 +257,8 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
       
       if usePathFinding:
         centerlineNode = logic.createCoronaryPathWithPathFinding(
-          volumeNode, fiducialNode, vascularityWeight, smoothingFactor)
+          volumeNode, fiducialNode, vascularityWeight, smoothingFactor, bidirectional, parallelSegments,
+          exactSearch=exactSearch)
       else:
         centerlineNode = logic.createCoronaryPath(volumeNode, fiducialNode)
       
@@ -256,6 +284,8 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
       logic.setupViews(volumeNode, segmentationNode, centerlineNode)
       
       self.statusLabel.text = "Stato: Completato"
+      if usePathFinding:
+        self.statusLabel.text += f" (nodi espansi: {logic.lastPathStats['expandedNodes']})"
     except Exception as e:
       self.statusLabel.text = f"Stato: Errore - {str(e)}"
       import traceback
@@ -266,41 +296,87 @@ class CoronarySegmentationWidget(ScriptedLoadableModuleWidget):
 class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
   """Implementa la logica per la segmentazione delle coronarie e generazione di centerline"""
 
-  def preprocessVolumeForPathFinding(self, volumeNode):
-    """Preelabora il volume per evidenziare le strutture vascolari"""
-    # Crea un volume temporaneo per il preprocessamento
-    tempVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "VasiMigliorati")
-    
-    # Copia matrice di trasformazione
-    ijkToRas = vtk.vtkMatrix4x4()
-    volumeNode.GetIJKToRASMatrix(ijkToRas)
-    tempVolume.SetIJKToRASMatrix(ijkToRas)
-    
-    # Ottieni array numpy dal volume
-    volumeArray = slicer.util.arrayFromVolume(volumeNode)
-    
-    # Crea maschera per valori HU tipici dei vasi con contrasto
-    vesselMask = (volumeArray >= 150) & (volumeArray <= 500)
-    
-    # Applica filtro che esalta i vasi
-    enhancedArray = np.zeros_like(volumeArray)
-    enhancedArray[vesselMask] = volumeArray[vesselMask]
-    
-    # Applica un leggero smoothing gaussiano (se scipy è disponibile)
+  # Volumi dei costi conservati (i meno usati di recente sono eliminati)
+  COST_CACHE_SIZE = 4
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    # (ID nodo, MTime dei voxel, peso di vascolarità, box KJI) -> volume dei costi float32
+    self.costVolumeCache = collections.OrderedDict()
+    self.costCacheHits = 0
+    self.lastPathStats = {}
+
+  def decodedFrame(self, volumeNode):
+    """
+    Vista HU di un frame di una sequenza ottimizzata con CTOptimizer (codici quantizzati),
+    None se il volume contiene già valori HU
+
+    Solleva un'eccezione se i codici non possono essere riportati in HU (modulo
+    CTOptimizer non disponibile, residuo temporale): le soglie HU dei vasi
+    applicate ai codici darebbero risultati errati senza alcun errore.
+    """
+    if volumeNode.GetAttribute("CTOptimizer_BitDepth") is None:
+      return None
     try:
-      from scipy import ndimage
-      enhancedArray = ndimage.gaussian_filter(enhancedArray, sigma=0.5)
-    except ImportError:
-      pass
-    
-    # Normalizza i valori per enfatizzare le strutture vascolari
-    enhancedArray[~vesselMask] = -1000  # Imposta background a valore molto basso
-    
-    # Aggiorna il volume temporaneo
-    slicer.util.updateVolumeFromArray(tempVolume, enhancedArray)
-    tempVolume.SetSpacing(volumeNode.GetSpacing())
-    
-    return tempVolume
+      from CTOptimizerLib import decoding, temporal
+    except ImportError as e:
+      raise RuntimeError(f"Il volume {volumeNode.GetName()} è quantizzato da CTOptimizer: "
+                         "installare il modulo CTOptimizer per decodificarlo in HU") from e
+    attributes = {name: volumeNode.GetAttribute(name) for name in volumeNode.GetAttributeNames()}
+    if attributes.get("CTOptimizer_Temporal") == temporal.FRAME_DELTA:
+      raise ValueError(f"Il volume {volumeNode.GetName()} è un residuo temporale: "
+                       "selezionare il volume decodificato della sequenza")
+    decodedFrame = decoding.DecodedFrame.fromAttributes(slicer.util.arrayFromVolume(volumeNode), attributes)
+    if decodedFrame is None:
+      raise ValueError(f"Il volume {volumeNode.GetName()} non contiene i parametri di decodifica HU")
+    return decodedFrame
+
+  def enhancedVesselArray(self, volumeNode, box=None):
+    """
+    Valori HU con le sole strutture vascolari (vedi costs.enhanceVessels),
+    ritagliati al box KJI se indicato
+    """
+    decodedFrame = self.decodedFrame(volumeNode)
+    source = decodedFrame if decodedFrame is not None else slicer.util.arrayFromVolume(volumeNode)
+    if box is None:
+      box = tuple((0, n) for n in source.shape)
+    # Margine per lo smoothing gaussiano, rimosso dopo il filtro
+    paddedBox = costs.padBox(box, costs.SMOOTHING_MARGIN, source.shape)
+    slices = costs.cropSlices(paddedBox)
+    
+    if decodedFrame is not None:
+      # Frame quantizzato da CTOptimizer: soglie HU confrontate direttamente con i codici
+      croppedFrame = type(decodedFrame)(decodedFrame.codes[slices], decodedFrame.scale,
+                                        decodedFrame.offset, decodedFrame.bitDepth)
+      enhancedArray = costs.enhanceVessels(croppedFrame.toArray(), croppedFrame.mask(*costs.VESSEL_HU))
+    else:
+      enhancedArray = costs.enhanceVessels(source[slices])
+    
+    return enhancedArray[costs.cropSlices(box, costs.boxOrigin(paddedBox))]
+
+  def pathCostVolume(self, volumeNode, box, vascularityWeight):
+    """
+    Volume dei costi (penalità float32 dei voxel migliorati) che copre il box KJI
+
+    Restituisce (costi, box coperto). Un volume in cache dello stesso nodo, non
+    modificato e con lo stesso peso viene riusato se il suo box contiene quello
+    richiesto: nuovi fiduciali nella stessa regione non ricalcolano i costi.
+    """
+    key = (volumeNode.GetID(), volumeNode.GetImageData().GetMTime(), float(vascularityWeight))
+    for cachedKey, costVolume in self.costVolumeCache.items():
+      if cachedKey[:3] == key and costs.boxContains(cachedKey[3], box):
+        self.costVolumeCache.move_to_end(cachedKey)
+        self.costCacheHits += 1
+        return costVolume, cachedKey[3]
+    
+    costVolume = costs.penaltyVolume(self.enhancedVesselArray(volumeNode, box), vascularityWeight)
+    self.costVolumeCache[key + (box,)] = costVolume
+    while len(self.costVolumeCache) > self.COST_CACHE_SIZE:
+      self.costVolumeCache.popitem(last=False)
+    return costVolume, box
+
+  def clearCostVolumeCache(self):
+    self.costVolumeCache.clear()
 
   def createCoronaryPath(self, volumeNode, fiducialNode):
     """Crea una centerline semplice interpolando tra i punti fiduciali"""
@@ -333,8 +409,20 @@ class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
     
     return curveNode
 
-  def createCoronaryPathWithPathFinding(self, volumeNode, fiducialNode, vascularityWeight=2.0, smoothingFactor=0.5):
-    """Crea una centerline usando path finding avanzato tra i punti fiduciali"""
+  def createCoronaryPathWithPathFinding(self, volumeNode, fiducialNode, vascularityWeight=2.0, smoothingFactor=0.5,
+                                        bidirectional=False, parallelSegments=False, workers=None, exactSearch=False):
+    """
+    Crea una centerline usando path finding avanzato tra i punti fiduciali
+
+    Con bidirectional ogni segmento è cercato con A* bidirezionale (percorso di
+    costo minimo esatto). La ricerca unidirezionale usa di default un'euristica
+    non ammissibile (peso 1): espande pochi nodi ma il percorso non è garantito
+    di costo minimo. Con exactSearch usa la stessa euristica ammissibile della
+    bidirezionale, che a parità di risultato espande più nodi: è il termine di
+    confronto corretto per i nodi espansi. Con parallelSegments i segmenti tra coppie di punti
+    consecutivi sono risolti insieme in un pool di workers processi e uniti in
+    ordine. I nodi espansi (totali e per segmento) sono in lastPathStats.
+    """
     
     # Verifica input
     if not volumeNode or not fiducialNode:
@@ -347,12 +435,34 @@ class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
       logging.error("Servono almeno 2 punti fiduciali")
       return None
     
-    # Preelabora volume per migliorare il riconoscimento dei vasi
-    enhancedVolume = self.preprocessVolumeForPathFinding(volumeNode)
+    # Estrai posizioni dei fiduciali
+    fiducialPositions = []
+    for i in range(numPoints):
+      pos = [0, 0, 0]
+      fiducialNode.GetNthControlPointPositionWorld(i, pos)
+      fiducialPositions.append(pos)
+    
+    # Costi dei voxel migliorati nella regione che contiene tutte le ROI di ricerca
+    # (unione dei box delle capsule dei segmenti, vedi segments.capsuleBox)
+    volumeIJKToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(volumeIJKToRAS)
+    ijkToRAS = slicer.util.arrayFromVTKMatrix(volumeIJKToRAS)
+    fiducialsIJK = [self.worldToIJK(volumeNode, list(pos)) for pos in fiducialPositions]
+    shape = slicer.util.arrayFromVolume(volumeNode).shape
+    box = segments.segmentsBox([segments.segmentParameters(ijkToRAS, startIJK, endIJK)
+                                for startIJK, endIJK in zip(fiducialsIJK, fiducialsIJK[1:])],
+                               tuple((0, n) for n in shape))
+    if box is None:
+      logging.error("Punti fiduciali fuori dal volume")
+      return None
+    costVolume, costBox = self.pathCostVolume(volumeNode, box, vascularityWeight)
     
-    # Crea path finder con volume migliorato
-    pathFinder = VascularPathFinder(enhancedVolume)
-    pathFinder.vascularityWeight = vascularityWeight
+    # Crea path finder sul volume dei costi
+    pathFinder = VascularPathFinder(volumeNode, costVolume, costBox)
+    pathFinder.bidirectional = bidirectional
+    pathFinder.exact = exactSearch
+    self.lastPathStats = {"bidirectional": bidirectional, "exact": bidirectional or exactSearch,
+                          "heuristicWeight": pathFinder.heuristicWeight(), "expandedNodes": 0, "segments": []}
     
     # Crea curva
     curveNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsCurveNode", "CenterlineCoronaria")
@@ -366,21 +476,29 @@ class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
     # Trova percorso tra ogni coppia di punti consecutivi
     allPathPoints = []
     
-    # Estrai posizioni dei fiduciali
-    fiducialPositions = []
-    for i in range(numPoints):
-      pos = [0, 0, 0]
-      fiducialNode.GetNthControlPointPositionWorld(i, pos)
-      fiducialPositions.append(pos)
-    
     # Trova percorso tra punti
-    for i in range(numPoints - 1):
+    executor = self.createProcessPool(workers, numPoints - 1) if parallelSegments and numPoints > 2 else None
+    if executor is not None:
+      # Segmenti indipendenti: risolti insieme nei processi worker
+      with executor:
+        paths = pathFinder.findPaths(fiducialPositions, executor)
+      segmentStats = pathFinder.segmentStats
+    else:
+      paths = []
+      segmentStats = []
+      for i in range(numPoints - 1):
+        paths.append(pathFinder.findPath(fiducialPositions[i], fiducialPositions[i+1]))
+        segmentStats.append(pathFinder.lastSearchStats)
+    
+    for stats in segmentStats:
+      self.lastPathStats["segments"].append(stats.get("expandedNodes", 0))
+      self.lastPathStats["expandedNodes"] += stats.get("expandedNodes", 0)
+    
+    # Unisci i percorsi nell'ordine dei fiduciali
+    for i, path in enumerate(paths):
       startPoint = fiducialPositions[i]
       endPoint = fiducialPositions[i+1]
       
-      # Trova percorso
-      path = pathFinder.findPath(startPoint, endPoint)
-      
       if path:
         if i == 0:
           # Per il primo segmento, includi il primo punto
@@ -403,8 +521,9 @@ class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
     for point in allPathPoints:
       curveNode.AddControlPoint(point)
     
-    # Pulisci nodi temporanei
-    slicer.mrmlScene.RemoveNode(enhancedVolume)
+    logging.info(f"Path finding {'bidirezionale' if bidirectional else 'unidirezionale'} "
+                 f"{'esatto' if self.lastPathStats['exact'] else 'con euristica non ammissibile'}: "
+                 f"{self.lastPathStats['expandedNodes']} nodi espansi (per segmento: {self.lastPathStats['segments']})")
     
     return curveNode
 
@@ -518,6 +637,15 @@ class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
     threeDView.resetFocalPoint()
     threeDView.resetCamera()
 
+  def createProcessPool(self, workers, taskCount):
+    """
+    Pool di processi worker condiviso con CTOptimizer (CTOptimizerLib.parallel), con al più
+    taskCount processi (il modulo CTOptimizer è una dipendenza dichiarata)
+    """
+    from CTOptimizerLib import parallel
+    workers = min(workers or parallel.defaultWorkerCount(), taskCount)
+    return parallel.createProcessPool(workers, parallel.workerExecutable(slicer.app.slicerHome))
+
   def worldToIJK(self, volumeNode, worldPoint):
     """Converte coordinate RAS in coordinate IJK"""
     rasToIJK = vtk.vtkMatrix4x4()
@@ -536,80 +664,88 @@ class CoronarySegmentationLogic(ScriptedLoadableModuleLogic):
 # VascularPathFinder
 #
 class VascularPathFinder:
-  """Classe per trovare percorsi ottimali attraverso strutture vascolari usando l'algoritmo A*"""
+  """
+  Classe per trovare percorsi ottimali attraverso strutture vascolari usando l'algoritmo A*
+  (vedi CoronarySegmentationLib/pathfinding.py: indici lineari dei voxel, tabella dei 26 vicini,
+  g-score e predecessori in array preallocati)
   
-  def __init__(self, volumeNode):
+  La ricerca avviene sul volume dei costi precalcolato (vedi costs.penaltyVolume),
+  che copre il box KJI costBox del volume: gli indici sono locali al box. Con
+  bidirectional la ricerca cresce da entrambi gli estremi (pathfinding.findBidirectionalPath).
+  Entrambe le modalità terminano esattamente sul punto finale. La ricerca bidirezionale,
+  e quella unidirezionale con exact, usano l'euristica ammissibile (peso pari alla
+  penalità minima) e trovano il percorso di costo minimo; la unidirezionale senza exact
+  usa il peso 1, più veloce ma approssimata (vedi heuristicWeight). Ogni segmento è
+  risolto da segments.solveSegment, anche nei processi worker (findPaths): la ROI
+  di ricerca è una maschera calcolata una volta sul sotto-volume che la contiene.
+  """
+  
+  def __init__(self, volumeNode, costVolume=None, costBox=None, vascularityWeight=1.0):
     self.volumeNode = volumeNode
     self.imageData = volumeNode.GetImageData()
     self.dimensions = self.imageData.GetDimensions()
     self.spacing = volumeNode.GetSpacing()
-    self.vascularityWeight = 1.0
-    
-  def findPath(self, startPoint, endPoint):
-    """Trova percorso ottimale tra punto iniziale e finale usando algoritmo A*"""
+    if costVolume is None:
+      # Costi dei valori del volume così come sono, sull'intera griglia
+      costVolume = costs.penaltyVolume(slicer.util.arrayFromVolume(volumeNode), vascularityWeight)
+      costBox = tuple((0, n) for n in costVolume.shape)
+    self.costVolume = costVolume
+    self.costBox = costBox
+    self.bidirectional = False
+    self.exact = False
+    # Peso dell'euristica ammissibile delle ricerche esatte
+    self.minimumPenalty = float(costVolume.min()) if costVolume.size else 0.0
+    self.lastSearchStats = {}
+    self.segmentStats = []
+    # Parametri della ROI dell'ultimo segmento (vedi segment)
+    self.roi = None
+    
+  def heuristicWeight(self):
+    """Peso dell'euristica della modalità corrente: ammissibile se esatta, 1 altrimenti"""
+    if self.bidirectional or self.exact:
+      return self.minimumPenalty
+    return 1.0
+  
+  def segment(self, startPoint, endPoint):
+    """Parametri del segmento tra due punti RAS per segments.solveSegment (estremi KJI, ROI di ricerca)"""
     
     # Converti punti mondo in IJK
     start_ijk = self._worldToIJK(startPoint)
     end_ijk = self._worldToIJK(endPoint)
     
-    # Memorizza per uso successivo
-    self.start_ijk = start_ijk
-    self.end_ijk = end_ijk
-    
-    # Crea cilindro ROI per ottimizzazione
-    self.cylinder_radius = 20  # mm
-    
-    # Inizializza strutture A*
-    open_set = []
-    closed_set = set()
-    came_from = {}
-    
-    # Costo dal punto iniziale a ciascun nodo
-    g_score = {self._pointToKey(start_ijk): 0}
-    
-    # Costo stimato totale dal punto iniziale alla destinazione passando per ciascun nodo
-    f_score = {self._pointToKey(start_ijk): self._heuristic(start_ijk, end_ijk)}
+    # Raggio del cilindro ROI in base alla distanza diretta (più grande per percorsi più lunghi)
+    volumeIJKToRAS = vtk.vtkMatrix4x4()
+    self.volumeNode.GetIJKToRASMatrix(volumeIJKToRAS)
     
-    # Aggiungi punto iniziale all'open set
-    heapq.heappush(open_set, (f_score[self._pointToKey(start_ijk)], self._pointToKey(start_ijk)))
+    self.roi = segments.segmentParameters(slicer.util.arrayFromVTKMatrix(volumeIJKToRAS), start_ijk, end_ijk)
+    return self.roi
+  
+  def findPath(self, startPoint, endPoint):
+    """Trova percorso ottimale tra punto iniziale e finale usando algoritmo A*"""
+    path_kji, self.lastSearchStats = segments.solveSegment(
+      self.costVolume, self.spacing, costs.boxOrigin(self.costBox), self.segment(startPoint, endPoint),
+      self.bidirectional, self.heuristicWeight())
+    return self._pathToWorld(path_kji)
+  
+  def findPaths(self, points, executor):
+    """
+    Percorsi tra tutte le coppie di punti RAS consecutivi, risolti in parallelo nel pool
+    di processi executor (vedi segments.solveSegments), None per i segmenti senza percorso
+    """
+    results = segments.solveSegments(
+      executor, self.costVolume, self.spacing, costs.boxOrigin(self.costBox),
+      [self.segment(startPoint, endPoint) for startPoint, endPoint in zip(points, points[1:])],
+      self.bidirectional, self.heuristicWeight())
+    self.segmentStats = [stats for _, stats in results]
+    return [self._pathToWorld(path_kji) for path_kji, _ in results]
+  
+  def _pathToWorld(self, path_kji):
+    if path_kji is None:
+      logging.warning("Nessun percorso trovato tra i punti specificati")
+      return None
     
-    # Loop principale A*
-    while open_set:
-      # Ottieni nodo con f_score più basso
-      current_key = heapq.heappop(open_set)[1]
-      current = self._keyToPoint(current_key)
-      
-      # Verifica se abbiamo raggiunto la destinazione
-      if self._isPointClose(current, end_ijk, threshold=3):
-        return self._reconstructPath(came_from, current)
-      
-      closed_set.add(current_key)
-      
-      # Esplora vicini
-      for neighbor in self._getNeighbors(current):
-        neighbor_key = self._pointToKey(neighbor)
-        
-        # Salta se già valutato
-        if neighbor_key in closed_set:
-          continue
-        
-        # Calcola costo per raggiungere questo vicino
-        tentative_g_score = g_score[self._pointToKey(current)] + self._costFunction(current, neighbor)
-        
-        # Se abbiamo trovato percorso migliore o nodo nuovo
-        if neighbor_key not in g_score or tentative_g_score < g_score[neighbor_key]:
-          # Aggiorna info percorso
-          came_from[neighbor_key] = current_key
-          g_score[neighbor_key] = tentative_g_score
-          f_score[neighbor_key] = g_score[neighbor_key] + self._heuristic(neighbor, end_ijk)
-          
-          # Aggiungi all'open set se non è già presente
-          if not any(neighbor_key == item[1] for item in open_set):
-            heapq.heappush(open_set, (f_score[neighbor_key], neighbor_key))
-    
-    # Se nessun percorso trovato
-    logging.warning("Nessun percorso trovato tra i punti specificati")
-    return None
+    # Converti coordinate IJK in RAS
+    return [self._IJKToWorld([i, j, k]) for k, j, i in path_kji]
   
   def _worldToIJK(self, worldPoint):
     """Converte coordinate RAS in coordinate IJK"""
@@ -622,172 +758,20 @@ class VascularPathFinder:
     rasPoint = worldPoint + [1]  # Aggiungi coordinata omogenea
     
     rasToIJK.MultiplyPoint(rasPoint, ijkPoint)
-   
+    
     return [int(round(ijkPoint[0])), int(round(ijkPoint[1])), int(round(ijkPoint[2]))]
- 
+  
   def _IJKToWorld(self, ijkPoint):
-   """Converte coordinate IJK in coordinate RAS"""
-   ijkPointHomogeneous = ijkPoint + [1]  # Aggiungi coordinata omogenea
-   
-   volumeIJKToRAS = vtk.vtkMatrix4x4()
-   self.volumeNode.GetIJKToRASMatrix(volumeIJKToRAS)
-   
-   rasPoint = [0, 0, 0, 1]
-   volumeIJKToRAS.MultiplyPoint(ijkPointHomogeneous, rasPoint)
-   
-   return rasPoint[:3]  # Rimuovi coordinata omogenea
- 
-  def _pointToKey(self, point):
-   """Converte punto in chiave hashable per dizionari e set"""
-   return (int(point[0]), int(point[1]), int(point[2]))
- 
-  def _keyToPoint(self, key):
-   """Converte chiave in punto"""
-   return list(key)
- 
-  def _isPointClose(self, point1, point2, threshold=1):
-   """Verifica se due punti sono entro una distanza soglia"""
-   dist = ((point1[0] - point2[0])**2 + 
-           (point1[1] - point2[1])**2 + 
-           (point1[2] - point2[2])**2)**0.5
-   return dist <= threshold
- 
-  def _heuristic(self, point, goal):
-   """Funzione euristica (distanza euclidea)"""
-   return ((point[0] - goal[0])**2 * self.spacing[0]**2 + 
-           (point[1] - goal[1])**2 * self.spacing[1]**2 + 
-           (point[2] - goal[2])**2 * self.spacing[2]**2)**0.5
- 
-  def _getNeighbors(self, point):
-   """Ottiene vicini validi di un punto"""
-   neighbors = []
-   
-   # Crea una ROI per efficienza se non già fatto
-   if not hasattr(self, 'roi'):
-     # Calcola distanza diretta tra endpoint
-     start_ras = self._IJKToWorld(self.start_ijk)
-     end_ras = self._IJKToWorld(self.end_ijk)
-     direct_distance = sum([(a-b)**2 for a, b in zip(start_ras, end_ras)])**0.5
-     
-     # Imposta dimensione ROI in base alla distanza (più grande per percorsi più lunghi)
-     self.cylinder_radius = max(10, min(30, direct_distance / 3))
-   
-   # 26-connettività (tutte le celle adiacenti in 3D)
-   for dx in [-1, 0, 1]:
-     for dy in [-1, 0, 1]:
-       for dz in [-1, 0, 1]:
-         if dx == 0 and dy == 0 and dz == 0:
-           continue  # Salta il punto stesso
-         
-         nx, ny, nz = point[0] + dx, point[1] + dy, point[2] + dz
-         
-         # Verifica se dentro i limiti dell'immagine
-         if (0 <= nx < self.dimensions[0] and 
-             0 <= ny < self.dimensions[1] and 
-             0 <= nz < self.dimensions[2]):
-           
-           # Includi solo punti che sono all'interno della nostra ROI di ricerca
-           if self._isPointInSearchROI([nx, ny, nz]):
-             neighbors.append([nx, ny, nz])
-   
-   return neighbors
- 
-  def _isPointInSearchROI(self, point_ijk):
-   """Verifica se il punto è all'interno della ROI di ricerca (cilindro approssimativo tra endpoint)"""
-   # Converti in RAS per calcolo più facile
-   point_ras = self._IJKToWorld(point_ijk)
-   start_ras = self._IJKToWorld(self.start_ijk)
-   end_ras = self._IJKToWorld(self.end_ijk)
-   
-   # Vettore da inizio a fine
-   line_vec = [end_ras[i] - start_ras[i] for i in range(3)]
-   line_length = sum([x**2 for x in line_vec])**0.5
-   
-   if line_length == 0:
-     return True
-   
-   # Normalizza
-   line_vec = [x/line_length for x in line_vec]
-   
-   # Vettore da inizio a punto
-   point_vec = [point_ras[i] - start_ras[i] for i in range(3)]
-   
-   # Proiezione del vettore punto sul vettore linea
-   projection = sum([point_vec[i] * line_vec[i] for i in range(3)])
-   
-   # Verifica se la proiezione è all'interno del segmento di linea
-   if projection < -self.cylinder_radius or projection > line_length + self.cylinder_radius:
-     return False
-   
-   # Calcola punto più vicino sulla linea
-   closest_point = [start_ras[i] + projection * line_vec[i] for i in range(3)]
-   
-   # Calcola distanza dal punto alla linea
-   distance = sum([(point_ras[i] - closest_point[i])**2 for i in range(3)])**0.5
-   
-   # Verifica se entro raggio del cilindro
-   return distance <= self.cylinder_radius
- 
-  def _getVoxelValue(self, point):
-   """Ottiene valore HU alle coordinate voxel specificate"""
-   point_ijk = tuple(map(int, point))
-   try:
-     return self.imageData.GetScalarComponentAsDouble(point_ijk[0], point_ijk[1], point_ijk[2], 0)
-   except:
-     return -1000  # Valore di default per aria
- 
-  def _costFunction(self, current, neighbor):
-   """
-   Funzione di costo personalizzata che favorisce percorsi vascolari
-   
-   Combina:
-   1. Distanza euclidea
-   2. Penalità basata su valori HU (favorisce vasi con contrasto)
-   """
-   # Calcola distanza euclidea
-   distance = ((current[0] - neighbor[0])**2 * self.spacing[0]**2 + 
-               (current[1] - neighbor[1])**2 * self.spacing[1]**2 + 
-               (current[2] - neighbor[2])**2 * self.spacing[2]**2)**0.5
-   
-   # Ottieni valore HU
-   voxel_value = self._getVoxelValue(neighbor)
-   
-   # Range ideale per vasi con contrasto (tipicamente 200-400 HU)
-   optimal_min = 200
-   optimal_max = 400
-   
-   # Penalità molto bassa per valori nel range ottimale
-   if optimal_min <= voxel_value <= optimal_max:
-     hu_penalty = 0.05  # Costo molto basso per vasi con contrasto
-   # Penalità moderata per valori ancora accettabili (150-500 HU)
-   elif 150 <= voxel_value <= 500:
-     hu_penalty = 0.2
-   else:
-     # Alta penalità per valori fuori dal range dei vasi
-     lower_dist = max(0, 150 - voxel_value)
-     upper_dist = max(0, voxel_value - 500)
-     hu_penalty = 1.0 + min(lower_dist, upper_dist) / 50.0
-   
-   # Applica peso di vascolarità per controllare importanza dei valori HU
-   return distance * (hu_penalty ** (2.0 * self.vascularityWeight))
- 
-  def _reconstructPath(self, came_from, current):
-   """Ricostruisce percorso dal punto finale al punto iniziale"""
-   path_ijk = [current]
-   current_key = self._pointToKey(current)
-   
-   while current_key in came_from:
-     current_key = came_from[current_key]
-     current = self._keyToPoint(current_key)
-     path_ijk.append(current)
-   
-   # Inverti percorso per ottenere inizio -> fine
-   path_ijk.reverse()
-   
-   # Converti coordinate IJK in RAS
-   path_ras = [self._IJKToWorld(point) for point in path_ijk]
-   
-   return path_ras
+    """Converte coordinate IJK in coordinate RAS"""
+    ijkPointHomogeneous = ijkPoint + [1]  # Aggiungi coordinata omogenea
+    
+    volumeIJKToRAS = vtk.vtkMatrix4x4()
+    self.volumeNode.GetIJKToRASMatrix(volumeIJKToRAS)
+    
+    rasPoint = [0, 0, 0, 1]
+    volumeIJKToRAS.MultiplyPoint(ijkPointHomogeneous, rasPoint)
+    
+    return rasPoint[:3]  # Rimuovi coordinata omogenea
 
 #
 # CoronarySegmentationTest
@@ -807,6 +791,8 @@ class CoronarySegmentationTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_CoronarySegmentation1()
+    self.setUp()
+    self.test_PathCostVolumeCache()
 
   def test_CoronarySegmentation1(self):
     """ Test base per verificare la funzionalità del modulo.
@@ -814,4 +800,45 @@ class CoronarySegmentationTest(ScriptedLoadableModuleTest):
     self.delayDisplay("Avvio del test")
     
     # Creazione dati di test - non implementata in questo esempio base
-    self.delayDisplay('Test superato!')
\ No newline at end of file
+    self.delayDisplay('Test superato!')
+
+  def test_PathCostVolumeCache(self):
+    """Volume dei costi riusato per box contenuti, ricalcolato se cambiano i voxel o il peso"""
+    rng = np.random.default_rng(0)
+    values = rng.integers(-200, 600, size=(30, 40, 50)).astype(np.int16)
+    volumeNode = slicer.util.addVolumeFromArray(values, name="CostiCache")
+    logic = CoronarySegmentationLogic()
+    
+    box = ((5, 25), (10, 35), (10, 45))
+    costVolume, costBox = logic.pathCostVolume(volumeNode, box, 2.0)
+    self.assertEqual((costBox, logic.costCacheHits), (box, 0))
+    expected = costs.penaltyVolume(logic.enhancedVesselArray(volumeNode, box), 2.0)
+    np.testing.assert_array_equal(costVolume, expected)
+    
+    # Box contenuto: stesso volume dei costi, nessun ricalcolo
+    cachedVolume, cachedBox = logic.pathCostVolume(volumeNode, ((8, 20), (10, 30), (12, 40)), 2.0)
+    self.assertIs(cachedVolume, costVolume)
+    self.assertEqual((cachedBox, logic.costCacheHits), (box, 1))
+    
+    # Box non contenuto, peso diverso o voxel modificati: volume ricalcolato
+    _, largerBox = logic.pathCostVolume(volumeNode, ((0, 25), (10, 35), (10, 45)), 2.0)
+    self.assertEqual(largerBox, ((0, 25), (10, 35), (10, 45)))
+    weightVolume, _ = logic.pathCostVolume(volumeNode, box, 1.0)
+    self.assertIsNot(weightVolume, costVolume)
+    self.assertEqual(logic.costCacheHits, 1)
+    np.testing.assert_array_equal(weightVolume,
+                                  costs.penaltyVolume(logic.enhancedVesselArray(volumeNode, box), 1.0))
+    
+    values[10:20, 15:30, 20:40] = 300
+    slicer.util.updateVolumeFromArray(volumeNode, values)
+    modifiedVolume, _ = logic.pathCostVolume(volumeNode, box, 2.0)
+    self.assertIsNot(modifiedVolume, costVolume)
+    self.assertEqual(logic.costCacheHits, 1)
+    np.testing.assert_array_equal(modifiedVolume,
+                                  costs.penaltyVolume(logic.enhancedVesselArray(volumeNode, box), 2.0))
+    
+    # Cache limitata ai volumi usati più di recente
+    self.assertLessEqual(len(logic.costVolumeCache), logic.COST_CACHE_SIZE)
+    logic.clearCostVolumeCache()
+    self.assertEqual(len(logic.costVolumeCache), 0)
+    self.delayDisplay("Cache dei volumi dei costi verificata")
\ No newline at end of file
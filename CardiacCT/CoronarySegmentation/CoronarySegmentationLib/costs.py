@@ -0,0 +1,106 @@
+"""
+Volume dei costi per il path finding delle coronarie.
+
+La penalità di ogni voxel (bassa nel range HU dei vasi con contrasto) è
+calcolata una sola volta per tutta la regione di ricerca, in un unico passaggio
+vettoriale a blocchi di fette, invece che a ogni rilassamento di un vicino.
+I box sono in ordine KJI, come tuple (inizio, fine) per asse.
+"""
+import numpy as np
+
+VESSEL_HU = (150, 500)
+OPTIMAL_HU = (200, 400)
+BACKGROUND_HU = -1000
+
+# Penalità del range ottimale e di quello accettabile, prima del peso di vascolarità
+OPTIMAL_PENALTY = 0.05
+VESSEL_PENALTY = 0.2
+
+# Voxel di margine per lo smoothing gaussiano (sigma 0.5, troncato a 4 sigma)
+SMOOTHING_SIGMA = 0.5
+SMOOTHING_MARGIN = 2
+
+DEFAULT_CHUNK_VOXELS = 4 * 1024 * 1024
+
+
+def _slabs(shape, chunkVoxels):
+  sliceVoxels = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+  step = max(1, chunkVoxels // max(1, sliceVoxels))
+  for start in range(0, shape[0], step):
+    yield slice(start, min(start + step, shape[0]))
+
+
+def _penalty(values, vascularityWeight, out):
+  """Penalità di un blocco di valori (in out, float32)"""
+  exponent = 2.0 * vascularityWeight
+  values = values.astype(np.float32, copy=False)
+  # Fuori dal range dei vasi: 1 + distanza dal range / 50 HU
+  np.minimum(np.maximum(VESSEL_HU[0] - values, 0), np.maximum(values - VESSEL_HU[1], 0), out=out)
+  out /= 50.0
+  out += 1.0
+  np.power(out, exponent, out=out)
+  out[(values >= VESSEL_HU[0]) & (values <= VESSEL_HU[1])] = VESSEL_PENALTY ** exponent
+  out[(values >= OPTIMAL_HU[0]) & (values <= OPTIMAL_HU[1])] = OPTIMAL_PENALTY ** exponent
+  return out
+
+
+def penaltyVolume(values, vascularityWeight, out=None, chunkVoxels=DEFAULT_CHUNK_VOXELS):
+  """
+  Penalità float32 di ogni voxel di un array KJI di valori HU (in out se fornito)
+
+  Per array interi fino a 16 bit la penalità è letta da una tabella indicizzata
+  per valore; altrimenti è calcolata a blocchi di fette.
+  """
+  if out is None:
+    out = np.empty(values.shape, dtype=np.float32)
+  if values.dtype.kind in "iu" and values.dtype.itemsize <= 2:
+    info = np.iinfo(values.dtype)
+    table = _penalty(np.arange(info.min, info.max + 1, dtype=np.int32), vascularityWeight,
+                     np.empty(info.max - info.min + 1, dtype=np.float32))
+    for slab in _slabs(values.shape, chunkVoxels):
+      codes = values[slab].astype(np.int32)
+      if info.min:
+        codes -= info.min
+      np.take(table, codes, out=out[slab])
+    return out
+  for slab in _slabs(values.shape, chunkVoxels):
+    _penalty(values[slab], vascularityWeight, out[slab])
+  return out
+
+
+def enhanceVessels(values, vesselMask=None):
+  """
+  Valori con le sole strutture vascolari: voxel fuori da VESSEL_HU a BACKGROUND_HU,
+  con un leggero smoothing gaussiano se scipy è disponibile (stesso dtype dell'input)
+  """
+  if vesselMask is None:
+    vesselMask = (values >= VESSEL_HU[0]) & (values <= VESSEL_HU[1])
+  enhanced = np.zeros_like(values)
+  enhanced[vesselMask] = values[vesselMask]
+  try:
+    from scipy import ndimage
+    enhanced = ndimage.gaussian_filter(enhanced, sigma=SMOOTHING_SIGMA)
+  except ImportError:
+    pass
+  enhanced[~vesselMask] = BACKGROUND_HU
+  return enhanced
+
+
+def padBox(box, margin, shape):
+  """Allarga il box di margin voxel per lato limitandolo alla forma KJI"""
+  return tuple((max(0, start - margin), min(n, stop + margin)) for (start, stop), n in zip(box, shape))
+
+
+def boxContains(outer, inner):
+  """Verifica se il box inner è interamente contenuto in outer"""
+  return all(o0 <= i0 and i1 <= o1 for (o0, o1), (i0, i1) in zip(outer, inner))
+
+
+def cropSlices(box, origin=None):
+  """Slice della regione box, relative all'origine KJI indicata (se fornita)"""
+  origin = origin or (0, 0, 0)
+  return tuple(slice(start - o, stop - o) for (start, stop), o in zip(box, origin))
+
+
+def boxOrigin(box):
+  return tuple(start for start, _ in box)
@@ -0,0 +1,301 @@
+"""
+Ricerca A* del percorso di costo minimo su una griglia di voxel.
+
+I nodi sono indici lineari dei voxel di un array KJI: i 26 vicini si ottengono
+da una tabella di offset lineari precalcolata, con la lunghezza in mm di ogni
+passo. g-score (float32) e predecessori (int32) sono array preallocati con la
+forma della griglia, allocati azzerati (np.zeros) così che solo le pagine dei
+voxel visitati occupino memoria. La coda di priorità usa la cancellazione
+pigra: un nodo migliorato è reinserito e le voci obsolete sono scartate quando
+vengono estratte, senza cercarle nella coda.
+
+findBidirectionalPath fa crescere due frontiere, da start e da goal, e termina
+con un criterio esatto quando nessun percorso migliore di quello trovato può
+ancora passare per le frontiere.
+"""
+import heapq
+import math
+
+import numpy as np
+
+# Stato dei voxel valutati su richiesta (penalità o ROI fornite come funzioni)
+UNKNOWN = 0
+ALLOWED = 1
+BLOCKED = 2
+
+
+def neighborTable(shape, spacing):
+  """
+  Tabella dei 26 vicini di una griglia KJI con lo spacing IJK (mm)
+
+  Restituisce (offset KJI (26, 3), offset lineari (26,), lunghezze dei passi in mm (26,)).
+  """
+  _, rows, columns = shape
+  offsets = np.array([(dk, dj, di) for dk in (-1, 0, 1) for dj in (-1, 0, 1) for di in (-1, 0, 1)
+                      if (dk, dj, di) != (0, 0, 0)], dtype=np.int64)
+  linear = offsets[:, 0] * rows * columns + offsets[:, 1] * columns + offsets[:, 2]
+  lengths = np.sqrt(((offsets * np.asarray(spacing[::-1], dtype=np.float64)) ** 2).sum(axis=1))
+  return offsets, linear, lengths
+
+
+def linearIndex(shape, point):
+  """Indice lineare del voxel KJI point, None se fuori dalla griglia"""
+  if not all(0 <= int(p) < n for p, n in zip(point, shape)):
+    return None
+  return (int(point[0]) * shape[1] + int(point[1])) * shape[2] + int(point[2])
+
+
+def gridPoint(shape, index):
+  """Coordinate KJI dell'indice lineare index"""
+  k, remainder = divmod(int(index), shape[1] * shape[2])
+  j, i = divmod(remainder, shape[2])
+  return k, j, i
+
+
+def findPath(shape, spacing, start, goal, penalty, allowed=None, goalTolerance=0.0, heuristicWeight=1.0):
+  """
+  Percorso di costo minimo tra i voxel start e goal (coordinate KJI)
+
+  Il costo di un passo è la sua lunghezza in mm per la penalità del voxel di
+  arrivo; l'euristica è la distanza euclidea in mm da goal per heuristicWeight.
+  penalty (penalità per voxel) e allowed (voxel percorribili, None = tutti) sono
+  array della forma della griglia oppure funzioni dell'indice lineare, valutate
+  una sola volta per voxel. La ricerca termina quando viene estratto un voxel a
+  distanza <= goalTolerance voxel da goal.
+
+  Restituisce (lista di coordinate KJI da start al voxel raggiunto, statistiche),
+  con percorso None se goal non è raggiungibile.
+  """
+  size = int(np.prod(shape))
+  if size >= np.iinfo(np.int32).max:
+    raise ValueError("Griglia troppo grande per indici int32: ritagliare la regione di ricerca")
+  stats = {"expandedNodes": 0, "pushedNodes": 0}
+  startIndex = linearIndex(shape, start)
+  if startIndex is None or linearIndex(shape, goal) is None:
+    return None, stats
+
+  depth, rows, columns = shape
+  offsets, linear, lengths = neighborTable(shape, spacing)
+  neighbors = list(zip(linear.tolist(), lengths.tolist(), offsets.tolist()))
+  sk, sj, si = (float(s) * heuristicWeight for s in spacing[::-1])
+  gk, gj, gi = (int(p) for p in goal)
+  toleranceSquared = float(goalTolerance) ** 2
+
+  lazyPenalty = callable(penalty)
+  lazyAllowed = callable(allowed)
+  penaltyAt = np.empty(size, dtype=np.float32) if lazyPenalty else np.asarray(penalty, dtype=np.float32).reshape(-1)
+  allowedAt = None if allowed is None or lazyAllowed else np.asarray(allowed, dtype=bool).reshape(-1)
+  state = np.zeros(size, dtype=np.int8) if lazyPenalty or lazyAllowed else None
+
+  gScore = np.empty(size, dtype=np.float32)
+  # Predecessore + 1: 0 indica un voxel mai raggiunto
+  parent = np.zeros(size, dtype=np.int32)
+  closed = np.zeros(size, dtype=bool)
+
+  def heuristic(k, j, i):
+    return math.sqrt(((k - gk) * sk) ** 2 + ((j - gj) * sj) ** 2 + ((i - gi) * si) ** 2)
+
+  gScore[startIndex] = 0.0
+  parent[startIndex] = startIndex + 1
+  k, j, i = (int(p) for p in start)
+  openSet = [(heuristic(k, j, i), startIndex)]
+  reached = None
+
+  while openSet:
+    _, index = heapq.heappop(openSet)
+    if closed[index]:
+      continue
+    closed[index] = True
+    stats["expandedNodes"] += 1
+
+    k, remainder = divmod(index, rows * columns)
+    j, i = divmod(remainder, columns)
+    if (k - gk) ** 2 + (j - gj) ** 2 + (i - gi) ** 2 <= toleranceSquared:
+      reached = index
+      break
+
+    g = float(gScore[index])
+    interior = 0 < k < depth - 1 and 0 < j < rows - 1 and 0 < i < columns - 1
+    for offset, length, (dk, dj, di) in neighbors:
+      if not interior and not (0 <= k + dk < depth and 0 <= j + dj < rows and 0 <= i + di < columns):
+        continue
+      neighbor = index + offset
+      if closed[neighbor]:
+        continue
+
+      if state is not None and state[neighbor] == UNKNOWN:
+        inside = allowed(neighbor) if lazyAllowed else (allowedAt is None or allowedAt[neighbor])
+        state[neighbor] = ALLOWED if inside else BLOCKED
+        if inside and lazyPenalty:
+          penaltyAt[neighbor] = penalty(neighbor)
+      if state is not None:
+        if state[neighbor] == BLOCKED:
+          continue
+      elif allowedAt is not None and not allowedAt[neighbor]:
+        continue
+
+      tentative = g + length * float(penaltyAt[neighbor])
+      if parent[neighbor] == 0 or tentative < gScore[neighbor]:
+        gScore[neighbor] = tentative
+        parent[neighbor] = index + 1
+        heapq.heappush(openSet, (tentative + heuristic(k + dk, j + dj, i + di), neighbor))
+        stats["pushedNodes"] += 1
+
+  if reached is None:
+    return None, stats
+
+  path = [reached]
+  while path[-1] != startIndex:
+    path.append(int(parent[path[-1]]) - 1)
+  path.reverse()
+  stats["cost"] = float(gScore[reached])
+  return [gridPoint(shape, index) for index in path], stats
+
+
+def _lowerBoundWeight(penalty):
+  """Peso dell'euristica ammissibile: penalità minima (0 se le penalità sono valutate su richiesta)"""
+  if callable(penalty):
+    return 0.0
+  return max(0.0, float(np.min(penalty)))
+
+
+def findBidirectionalPath(shape, spacing, start, goal, penalty, allowed=None, heuristicWeight=None):
+  """
+  Percorso di costo minimo esatto tra i voxel start e goal (coordinate KJI) con A* bidirezionale
+
+  Costi, penalty e allowed come in findPath. Le due ricerche usano i potenziali
+  medi p(v) = (h_goal(v) - h_start(v)) / 2 - l * penalty(v) / 2, con h la distanza
+  euclidea in mm per heuristicWeight (default: la penalità minima, così
+  l'euristica è ammissibile e consistente) e l il passo più corto in mm: le
+  chiavi sono g + p in avanti e g - p all'indietro, e la ricerca termina quando
+  la somma delle chiavi minime delle due code raggiunge il costo del miglior
+  percorso che unisce le frontiere. Il termine sulla penalità è il costo minimo
+  per entrare nel voxel, che la ricerca all'indietro non ha ancora pagato: senza,
+  i voxel di sfondo attorno a un vaso avrebbero chiavi all'indietro basse e
+  verrebbero espansi. Il percorso termina esattamente in goal.
+
+  Con la stessa euristica ammissibile di findPath(heuristicWeight=penalità
+  minima) il percorso ha lo stesso costo minimo e i nodi espansi sono di norma
+  molto meno; findPath con il peso 1 predefinito ne espande ancora meno ma non
+  garantisce il costo minimo.
+
+  Restituisce (lista di coordinate KJI da start a goal, statistiche), con
+  percorso None se goal non è raggiungibile; le statistiche riportano anche i
+  nodi espansi da ciascuna direzione.
+  """
+  size = int(np.prod(shape))
+  if size >= np.iinfo(np.int32).max:
+    raise ValueError("Griglia troppo grande per indici int32: ritagliare la regione di ricerca")
+  stats = {"expandedNodes": 0, "pushedNodes": 0, "forwardExpandedNodes": 0, "backwardExpandedNodes": 0}
+  startIndex = linearIndex(shape, start)
+  goalIndex = linearIndex(shape, goal)
+  if startIndex is None or goalIndex is None:
+    return None, stats
+
+  depth, rows, columns = shape
+  offsets, linear, lengths = neighborTable(shape, spacing)
+  neighbors = list(zip(linear.tolist(), lengths.tolist(), offsets.tolist()))
+  if heuristicWeight is None:
+    heuristicWeight = _lowerBoundWeight(penalty)
+  sk, sj, si = (float(s) * heuristicWeight for s in spacing[::-1])
+  ak, aj, ai = (int(p) for p in start)
+  bk, bj, bi = (int(p) for p in goal)
+
+  lazyPenalty = callable(penalty)
+  lazyAllowed = callable(allowed)
+  penaltyAt = np.empty(size, dtype=np.float32) if lazyPenalty else np.asarray(penalty, dtype=np.float32).reshape(-1)
+  allowedAt = None if allowed is None or lazyAllowed else np.asarray(allowed, dtype=bool).reshape(-1)
+  state = np.zeros(size, dtype=np.int8) if lazyPenalty or lazyAllowed else None
+
+  def passable(index):
+    if state is None:
+      return allowedAt is None or bool(allowedAt[index])
+    if state[index] == UNKNOWN:
+      inside = allowed(index) if lazyAllowed else (allowedAt is None or allowedAt[index])
+      state[index] = ALLOWED if inside else BLOCKED
+      if inside and lazyPenalty:
+        penaltyAt[index] = penalty(index)
+    return state[index] == ALLOWED
+
+  # Metà del passo più corto: peso del costo minimo di ingresso nel voxel
+  entryLength = 0.5 * float(lengths.min())
+
+  def potential(k, j, i, index):
+    toGoal = math.sqrt(((k - bk) * sk) ** 2 + ((j - bj) * sj) ** 2 + ((i - bi) * si) ** 2)
+    toStart = math.sqrt(((k - ak) * sk) ** 2 + ((j - aj) * sj) ** 2 + ((i - ai) * si) ** 2)
+    return 0.5 * (toGoal - toStart) - entryLength * float(penaltyAt[index])
+
+  # Come in findPath goal deve essere percorribile (start no)
+  if startIndex != goalIndex and not passable(goalIndex):
+    return None, stats
+  if lazyPenalty:
+    # Penalità degli estremi per i potenziali (start può essere fuori dalla ROI)
+    penaltyAt[startIndex] = penalty(startIndex)
+    penaltyAt[goalIndex] = penalty(goalIndex)
+
+  # Indice 0: ricerca da start (avanti), 1: ricerca da goal (indietro)
+  gScores = (np.empty(size, dtype=np.float32), np.empty(size, dtype=np.float32))
+  parents = (np.zeros(size, dtype=np.int32), np.zeros(size, dtype=np.int32))
+  closed = (np.zeros(size, dtype=bool), np.zeros(size, dtype=bool))
+  openSets = ([], [])
+  signs = (1.0, -1.0)
+  for side, (index, (k, j, i)) in enumerate(((startIndex, (ak, aj, ai)), (goalIndex, (bk, bj, bi)))):
+    gScores[side][index] = 0.0
+    parents[side][index] = index + 1
+    openSets[side].append((signs[side] * potential(k, j, i, index), index))
+
+  best = math.inf
+  meeting = startIndex if startIndex == goalIndex else None
+  if meeting is not None:
+    best = 0.0
+
+  while openSets[0] and openSets[1]:
+    if openSets[0][0][0] + openSets[1][0][0] >= best:
+      break
+    # Espande la frontiera con la chiave minima più bassa
+    side = 0 if openSets[0][0][0] <= openSets[1][0][0] else 1
+    other = 1 - side
+    _, index = heapq.heappop(openSets[side])
+    if closed[side][index]:
+      continue
+    closed[side][index] = True
+    stats["expandedNodes"] += 1
+    stats["backwardExpandedNodes" if side else "forwardExpandedNodes"] += 1
+
+    gScore, parent, sign = gScores[side], parents[side], signs[side]
+    otherScore, otherParent = gScores[other], parents[other]
+    k, remainder = divmod(index, rows * columns)
+    j, i = divmod(remainder, columns)
+    g = float(gScore[index])
+    # All'indietro il passo verso il vicino costa quanto il passo in avanti dal vicino a index
+    backwardPenalty = float(penaltyAt[index]) if side else 0.0
+    interior = 0 < k < depth - 1 and 0 < j < rows - 1 and 0 < i < columns - 1
+    for offset, length, (dk, dj, di) in neighbors:
+      if not interior and not (0 <= k + dk < depth and 0 <= j + dj < rows and 0 <= i + di < columns):
+        continue
+      neighbor = index + offset
+      if closed[side][neighbor] or not passable(neighbor):
+        continue
+
+      tentative = g + length * (backwardPenalty if side else float(penaltyAt[neighbor]))
+      if parent[neighbor] == 0 or tentative < gScore[neighbor]:
+        gScore[neighbor] = tentative
+        parent[neighbor] = index + 1
+        heapq.heappush(openSets[side], (tentative + sign * potential(k + dk, j + dj, i + di, neighbor), neighbor))
+        stats["pushedNodes"] += 1
+        # Percorso completo attraverso il vicino se già raggiunto dall'altra ricerca
+        if otherParent[neighbor] != 0 and tentative + float(otherScore[neighbor]) < best:
+          best = tentative + float(otherScore[neighbor])
+          meeting = neighbor
+
+  if meeting is None:
+    return None, stats
+
+  path = [meeting]
+  while path[-1] != startIndex:
+    path.append(int(parents[0][path[-1]]) - 1)
+  path.reverse()
+  while path[-1] != goalIndex:
+    path.append(int(parents[1][path[-1]]) - 1)
+  stats["cost"] = best
+  return [gridPoint(shape, index) for index in path], stats
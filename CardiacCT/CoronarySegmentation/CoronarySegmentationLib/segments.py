@@ -0,0 +1,215 @@
+"""
+Percorsi tra coppie di fiduciali consecutivi, anche in parallelo.
+
+Ogni segmento è descritto da parametri semplici (estremi KJI, estremi RAS e
+raggio della ROI di ricerca, matrice IJK -> RAS): i segmenti sono indipendenti
+e possono essere risolti da un pool di processi worker senza accesso alla
+scena MRML (il pool è creato dal chiamante, vedi CTOptimizerLib.parallel).
+La ROI di ricerca (una capsula attorno al segmento) è calcolata una sola volta
+come maschera booleana sul box che la contiene, e la ricerca avviene solo in
+quel sotto-volume con indici locali. Il volume dei costi è copiato una sola
+volta in un blocco di memoria condivisa (multiprocessing.shared_memory) che i
+worker mappano senza copie, invece di essere serializzato per ogni segmento.
+"""
+import math
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import costs, pathfinding
+
+# Raggio minimo e massimo (mm) del cilindro di ricerca attorno al segmento tra due fiduciali
+MIN_SEARCH_RADIUS_MM = 10.0
+MAX_SEARCH_RADIUS_MM = 30.0
+
+
+def searchRadius(startRAS, endRAS):
+  """Raggio (mm) della ROI di ricerca: più grande per segmenti più lunghi, tra 10 e 30 mm"""
+  return max(MIN_SEARCH_RADIUS_MM, min(MAX_SEARCH_RADIUS_MM, math.dist(startRAS, endRAS) / 3))
+
+
+def segmentParameters(ijkToRAS, startIJK, endIJK):
+  """
+  Parametri di un segmento per solveSegment tra due voxel IJK
+
+  Gli estremi RAS sono i centri dei voxel; il raggio della ROI dipende dalla loro distanza.
+  """
+  matrix = np.asarray(ijkToRAS, dtype=np.float64).reshape(4, 4)
+  startRAS = (matrix @ [*startIJK, 1.0])[:3].tolist()
+  endRAS = (matrix @ [*endIJK, 1.0])[:3].tolist()
+  return {
+    "start": [int(n) for n in startIJK[::-1]],
+    "goal": [int(n) for n in endIJK[::-1]],
+    "startRAS": startRAS,
+    "endRAS": endRAS,
+    "radius": searchRadius(startRAS, endRAS),
+    "ijkToRAS": matrix.tolist(),
+  }
+
+
+def capsuleBox(ijkToRAS, startRAS, endRAS, radius, bounds):
+  """
+  Box KJI che contiene la ROI di ricerca, limitato al box bounds; None se vuoto
+
+  La ROI è il cilindro di raggio radius attorno al segmento tra gli estremi RAS,
+  esteso di radius oltre ciascun estremo lungo l'asse: è contenuta nel
+  parallelepipedo RAS degli estremi estesi allargato di radius, i cui vertici
+  sono riportati in IJK.
+  """
+  matrix = np.asarray(ijkToRAS, dtype=np.float64).reshape(4, 4)
+  start = np.asarray(startRAS, dtype=np.float64)
+  end = np.asarray(endRAS, dtype=np.float64)
+  length = np.linalg.norm(end - start)
+  if length > 0:
+    axis = (end - start) / length
+    start, end = start - radius * axis, end + radius * axis
+  low = np.minimum(start, end) - radius
+  high = np.maximum(start, end) + radius
+  corners = np.array([(x, y, z, 1.0) for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+  kji = (corners @ np.linalg.inv(matrix).T)[:, 2::-1]
+  box = tuple((max(b0, int(np.floor(lo))), min(b1, int(np.ceil(hi)) + 1))
+              for lo, hi, (b0, b1) in zip(kji.min(axis=0), kji.max(axis=0), bounds))
+  if any(stop <= start for start, stop in box):
+    return None
+  return box
+
+
+def segmentsBox(segments, bounds):
+  """Box KJI che contiene le ROI di ricerca di tutti i segmenti, limitato a bounds; None se vuoto"""
+  boxes = [capsuleBox(segment["ijkToRAS"], segment["startRAS"], segment["endRAS"], segment["radius"], bounds)
+           for segment in segments]
+  boxes = [box for box in boxes if box is not None]
+  if not boxes:
+    return None
+  return tuple((min(box[axis][0] for box in boxes), max(box[axis][1] for box in boxes)) for axis in range(3))
+
+
+def capsuleMask(ijkToRAS, startRAS, endRAS, radius, box):
+  """
+  Maschera booleana (forma del box KJI) dei voxel nella ROI di ricerca
+
+  Calcolata fetta per fetta: i voxel sono portati in RAS con la matrice IJK -> RAS,
+  proiettati sull'asse del segmento e confrontati con il raggio.
+  """
+  mask = np.empty(tuple(stop - start for start, stop in box), dtype=bool)
+  start = np.asarray(startRAS, dtype=np.float64)
+  line = np.asarray(endRAS, dtype=np.float64) - start
+  length = np.linalg.norm(line)
+  if length == 0:
+    mask[...] = True
+    return mask
+  axis = line / length
+
+  matrix = np.asarray(ijkToRAS, dtype=np.float64).reshape(4, 4)
+  (k0, k1), (j0, j1), (i0, i1) = box
+  j = np.arange(j0, j1, dtype=np.float64)[:, None]
+  i = np.arange(i0, i1, dtype=np.float64)[None, :]
+  # Coordinate RAS relative a startRAS della fetta k = 0, e incremento per fetta
+  base = [matrix[c, 0] * i + matrix[c, 1] * j + (matrix[c, 3] - start[c]) for c in range(3)]
+  baseProjection = sum(base[c] * axis[c] for c in range(3))
+  baseSquared = sum(base[c] ** 2 for c in range(3))
+  for k in range(k0, k1):
+    step = matrix[:3, 2] * k
+    projection = baseProjection + float(step @ axis)
+    # |p|^2 = |base + step|^2; distanza dall'asse al quadrato = |p|^2 - proiezione^2
+    squared = baseSquared + 2.0 * sum(base[c] * step[c] for c in range(3)) + float(step @ step)
+    inside = mask[k - k0]
+    np.less_equal(squared - projection ** 2, radius * radius, out=inside)
+    inside &= projection >= -radius
+    inside &= projection <= length + radius
+  return mask
+
+
+def solveSegment(costVolume, spacing, origin, segment, bidirectional=False, heuristicWeight=None):
+  """
+  Percorso di un segmento sul volume dei costi che copre il box con origine KJI origin
+
+  segment è un dizionario con start e goal (KJI del volume), startRAS, endRAS,
+  radius e ijkToRAS (4x4). La ricerca avviene solo nel sotto-volume che contiene
+  la ROI, con la maschera della ROI come voxel percorribili. heuristicWeight è
+  usato da entrambe le modalità (None: default di findPath e findBidirectionalPath).
+  Restituisce (lista di coordinate KJI del volume o None, statistiche della
+  ricerca, con il box della ROI).
+  """
+  bounds = tuple((o, o + n) for o, n in zip(origin, costVolume.shape))
+  box = capsuleBox(segment["ijkToRAS"], segment["startRAS"], segment["endRAS"], segment["radius"], bounds)
+  if box is None:
+    return None, {"expandedNodes": 0, "pushedNodes": 0}
+  allowed = capsuleMask(segment["ijkToRAS"], segment["startRAS"], segment["endRAS"], segment["radius"], box)
+  penalty = np.ascontiguousarray(costVolume[costs.cropSlices(box, origin)])
+
+  ok, oj, oi = costs.boxOrigin(box)
+  start = [p - o for p, o in zip(segment["start"], (ok, oj, oi))]
+  goal = [p - o for p, o in zip(segment["goal"], (ok, oj, oi))]
+  if bidirectional:
+    path, stats = pathfinding.findBidirectionalPath(penalty.shape, spacing, start, goal, penalty, allowed,
+                                                    heuristicWeight=heuristicWeight)
+  else:
+    path, stats = pathfinding.findPath(penalty.shape, spacing, start, goal, penalty, allowed,
+                                       heuristicWeight=1.0 if heuristicWeight is None else heuristicWeight)
+  stats["roiBox"] = box
+  if path is None:
+    return None, stats
+  return [(k + ok, j + oj, i + oi) for k, j, i in path], stats
+
+
+class SharedArray:
+  """
+  Copia di un array in un blocco di memoria condivisa, eliminato all'uscita dal contesto
+
+  descriptor (nome, forma, dtype) è sufficiente a un altro processo per mappare
+  il blocco con attach().
+  """
+
+  def __init__(self, array):
+    array = np.asarray(array)
+    self._memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self._memory.buf)
+    self.array[...] = array
+    self.descriptor = (self._memory.name, array.shape, array.dtype.str)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.array = None
+    self._memory.close()
+    self._memory.unlink()
+
+  @staticmethod
+  def attach(descriptor):
+    """(blocco di memoria condivisa, vista NumPy) del blocco descritto da descriptor"""
+    name, shape, dtype = descriptor
+    try:
+      # Python >= 3.13: il blocco resta di proprietà del processo che lo ha creato
+      memory = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+      memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=np.dtype(dtype), buffer=memory.buf)
+
+
+def _solveSharedSegment(descriptor, spacing, origin, segment, bidirectional, heuristicWeight):
+  memory, costVolume = SharedArray.attach(descriptor)
+  try:
+    return solveSegment(costVolume, spacing, origin, segment, bidirectional, heuristicWeight)
+  finally:
+    del costVolume
+    memory.close()
+
+
+def solveSegments(executor, costVolume, spacing, origin, segments, bidirectional=False, heuristicWeight=None):
+  """
+  Risolve tutti i segmenti nel pool di processi executor, con il volume dei costi in memoria condivisa
+
+  Restituisce i risultati di solveSegment nell'ordine dei segmenti.
+  """
+  segments = list(segments)
+  if not segments:
+    return []
+  with SharedArray(costVolume) as shared:
+    futures = [executor.submit(_solveSharedSegment, shared.descriptor, tuple(spacing), tuple(origin), segment,
+                               bidirectional, heuristicWeight) for segment in segments]
+    return [future.result() for future in futures]
@@ -0,0 +1,312 @@
+"""
+Test unitari dei kernel NumPy di CoronarySegmentationLib.
+
+Non richiedono Slicer: possono essere eseguiti con un normale interprete Python
+
+  python -m unittest CoronarySegmentationLibTest
+
+oppure come test del modulo dentro Slicer.
+"""
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from CoronarySegmentationLib import costs, pathfinding, segments  # noqa: E402
+
+
+def referencePenalty(value, vascularityWeight):
+  """Penalità di un voxel come nella funzione di costo per voxel originale (_costFunction, passo di 1 mm)"""
+  if 200 <= value <= 400:
+    penalty = 0.05
+  elif 150 <= value <= 500:
+    penalty = 0.2
+  else:
+    lowerDistance = max(0, 150 - value)
+    upperDistance = max(0, value - 500)
+    penalty = 1.0 + min(lowerDistance, upperDistance) / 50.0
+  return penalty ** (2.0 * vascularityWeight)
+
+
+class PenaltyVolumeTest(unittest.TestCase):
+
+  weights = (0.0, 0.5, 1.0, 2.0, 3.3)
+
+  def assertMatchesReference(self, values, vascularityWeight, penalty):
+    expected = np.array([referencePenalty(float(value), vascularityWeight) for value in values.reshape(-1)])
+    self.assertEqual(penalty.dtype, np.float32)
+    np.testing.assert_allclose(penalty.reshape(-1), expected, rtol=1e-5)
+
+  def test_lookupTable(self):
+    rng = np.random.default_rng(0)
+    # Tutti i confini dei range più valori casuali
+    boundaries = [149, 150, 151, 199, 200, 201, 399, 400, 401, 499, 500, 501]
+    for dtype, low, high in ((np.int16, -1024, 3072), (np.uint8, 0, 256)):
+      values = np.concatenate([[v for v in boundaries if low <= v < high],
+                               rng.integers(low, high, size=2000)]).astype(dtype)
+      values = values[:len(values) // 10 * 10].reshape(2, 5, -1)
+      for vascularityWeight in self.weights:
+        with self.subTest(dtype=np.dtype(dtype).name, vascularityWeight=vascularityWeight):
+          self.assertMatchesReference(values, vascularityWeight,
+                                      costs.penaltyVolume(values, vascularityWeight, chunkVoxels=100))
+
+  def test_floatSlabs(self):
+    rng = np.random.default_rng(1)
+    values = np.concatenate([[149.5, 150.0, 199.99, 200.0, 400.0, 400.01, 500.0, 500.5],
+                             rng.uniform(-1024, 3000, size=1992)]).astype(np.float32).reshape(4, 10, 50)
+    for vascularityWeight in self.weights:
+      with self.subTest(vascularityWeight=vascularityWeight):
+        out = np.empty(values.shape, dtype=np.float32)
+        penalty = costs.penaltyVolume(values, vascularityWeight, out=out, chunkVoxels=120)
+        self.assertIs(penalty, out)
+        self.assertMatchesReference(values, vascularityWeight, penalty)
+    # Valori interi a 32 bit: nessuna tabella, stesso risultato
+    integers = values.astype(np.int32)
+    self.assertMatchesReference(integers, 2.0, costs.penaltyVolume(integers, 2.0))
+
+
+class SegmentsTest(unittest.TestCase):
+
+  def setUp(self):
+    # Griglia obliqua con spacing anisotropo, come un volume CT reale
+    angle = np.radians(25.0)
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0.0],
+                         [np.sin(angle), np.cos(angle), 0.0],
+                         [0.0, 0.0, 1.0]])
+    self.ijkToRAS = np.eye(4)
+    self.ijkToRAS[:3, :3] = rotation @ np.diag([0.8, 0.8, 1.5])
+    self.ijkToRAS[:3, 3] = (-40.0, 12.0, 7.0)
+    self.shape = (60, 120, 110)
+    self.bounds = tuple((0, n) for n in self.shape)
+
+  def test_segmentsBoxContainsCapsules(self):
+    fiducialsIJK = [(20, 30, 10), (60, 50, 30), (90, 95, 45)]
+    segmentList = [segments.segmentParameters(self.ijkToRAS, startIJK, endIJK)
+                   for startIJK, endIJK in zip(fiducialsIJK, fiducialsIJK[1:])]
+    box = segments.segmentsBox(segmentList, self.bounds)
+    grid = np.indices(self.shape).reshape(3, -1).T
+    ras = np.c_[grid[:, ::-1], np.ones(len(grid))] @ self.ijkToRAS[:3].T
+    for segment in segmentList:
+      # Tutti i voxel della capsula (test scalare sull'intero volume) sono nel box dei costi
+      start = np.asarray(segment["startRAS"])
+      line = np.asarray(segment["endRAS"]) - start
+      projection = (ras - start) @ line / np.linalg.norm(line)
+      distance = np.sqrt(np.maximum(((ras - start) ** 2).sum(axis=1) - projection ** 2, 0))
+      inside = ((distance <= segment["radius"]) & (projection >= -segment["radius"]) &
+                (projection <= np.linalg.norm(line) + segment["radius"]))
+      points = grid[inside]
+      self.assertTrue(len(points))
+      self.assertTrue(costs.boxContains(box, tuple((int(lo), int(hi) + 1)
+                                                   for lo, hi in zip(points.min(axis=0), points.max(axis=0)))))
+
+  def test_capsuleMaskMatchesScalarRule(self):
+    box = ((5, 45), (10, 70), (20, 90))
+    k, j, i = (axis.reshape(-1) for axis in np.indices(tuple(stop - start for start, stop in box)))
+    ijk = np.c_[i + box[2][0], j + box[1][0], k + box[0][0]]
+    for startIJK, endIJK in (((30, 20, 10), (60, 50, 30)), ((80, 30, 40), (35, 55, 12)), ((50, 40, 25), (51, 40, 25))):
+      with self.subTest(start=startIJK, end=endIJK):
+        segment = segments.segmentParameters(self.ijkToRAS, startIJK, endIJK)
+        start = np.asarray(segment["startRAS"])
+        line = np.asarray(segment["endRAS"]) - start
+        length = np.linalg.norm(line)
+        # Segmento corto: raggio ridotto (non multiplo dello spacing, nessun voxel esattamente sul bordo)
+        radius = 4.1 if length < 5 else segment["radius"]
+        mask = segments.capsuleMask(self.ijkToRAS, segment["startRAS"], segment["endRAS"], radius, box)
+        # Regola scalare voxel per voxel: distanza dall'asse e proiezione sull'asse
+        offsets = np.c_[ijk, np.ones(len(ijk))] @ self.ijkToRAS[:3].T - start
+        projection = offsets @ line / length
+        distance = np.sqrt(np.maximum((offsets ** 2).sum(axis=1) - projection ** 2, 0))
+        expected = (distance <= radius) & (projection >= -radius) & (projection <= length + radius)
+        self.assertTrue(expected.any() and not expected.all())
+        np.testing.assert_array_equal(mask.reshape(-1), expected)
+
+  def test_capsuleMaskZeroLength(self):
+    segment = segments.segmentParameters(self.ijkToRAS, (30, 20, 10), (30, 20, 10))
+    box = ((0, 4), (3, 9), (2, 7))
+    mask = segments.capsuleMask(self.ijkToRAS, segment["startRAS"], segment["endRAS"], segment["radius"], box)
+    self.assertEqual(mask.shape, (4, 6, 5))
+    self.assertTrue(mask.all())
+
+  def test_segmentsBoxOutsideVolume(self):
+    segment = segments.segmentParameters(self.ijkToRAS, (500, 500, 500), (520, 500, 500))
+    self.assertIsNone(segments.segmentsBox([segment], self.bounds))
+
+  def test_segmentParameters(self):
+    segment = segments.segmentParameters(self.ijkToRAS, (1, 2, 3), (4, 5, 6))
+    self.assertEqual((segment["start"], segment["goal"]), ([3, 2, 1], [6, 5, 4]))
+    np.testing.assert_allclose(segment["startRAS"], (self.ijkToRAS @ [1, 2, 3, 1])[:3])
+    self.assertEqual(segment["radius"], segments.MIN_SEARCH_RADIUS_MM)
+
+
+class SharedSegmentsTest(unittest.TestCase):
+
+  def setUp(self):
+    rng = np.random.default_rng(2)
+    self.costVolume = rng.uniform(0.05, 2.0, size=(40, 50, 50)).astype(np.float32)
+    self.spacing = (0.8, 0.8, 1.0)
+    self.origin = (0, 0, 0)
+    ijkToRAS = np.diag([0.8, 0.8, 1.0, 1.0])
+    # Segmenti di lunghezza diversa: i risultati non possono coincidere per caso
+    fiducialsIJK = [(5, 5, 5), (30, 20, 25), (45, 40, 35), (40, 42, 33)]
+    self.segments = [segments.segmentParameters(ijkToRAS, startIJK, endIJK)
+                     for startIJK, endIJK in zip(fiducialsIJK, fiducialsIJK[1:])]
+
+  def test_solveSegmentsInProcessPool(self):
+    expected = [segments.solveSegment(self.costVolume, self.spacing, self.origin, segment, True)
+                for segment in self.segments]
+    descriptors = []
+
+    class RecordingSharedArray(segments.SharedArray):
+      def __init__(self, array):
+        super().__init__(array)
+        descriptors.append(self.descriptor)
+
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+      with mock.patch.object(segments, "SharedArray", RecordingSharedArray):
+        results = segments.solveSegments(executor, self.costVolume, self.spacing, self.origin, self.segments, True)
+    # Risultati nell'ordine dei segmenti, identici alla risoluzione in sequenza
+    self.assertEqual(len(results), len(self.segments))
+    for (path, stats), (expectedPath, expectedStats) in zip(results, expected):
+      self.assertIsNotNone(path)
+      self.assertEqual(path, expectedPath)
+      self.assertEqual(stats["roiBox"], expectedStats["roiBox"])
+      self.assertAlmostEqual(stats["cost"], expectedStats["cost"], places=4)
+    # Il blocco di memoria condivisa è eliminato dopo la risoluzione
+    self.assertEqual(len(descriptors), 1)
+    with self.assertRaises(FileNotFoundError):
+      segments.SharedArray.attach(descriptors[0])
+
+  def test_sharedArrayUnlinkedOnError(self):
+    with self.assertRaises(RuntimeError):
+      with segments.SharedArray(self.costVolume) as shared:
+        memory, view = segments.SharedArray.attach(shared.descriptor)
+        np.testing.assert_array_equal(view, self.costVolume)
+        del view
+        memory.close()
+        raise RuntimeError
+    with self.assertRaises(FileNotFoundError):
+      segments.SharedArray.attach(shared.descriptor)
+
+
+class BidirectionalPathTest(unittest.TestCase):
+
+  spacing = (0.7, 0.6, 1.2)
+
+  def pathCost(self, path, penalty):
+    """Costo di un percorso ricalcolato passo per passo (lunghezza in mm per penalità del voxel di arrivo)"""
+    steps = np.diff(np.asarray(path), axis=0)
+    self.assertTrue(np.all(np.abs(steps) <= 1) and np.all(np.abs(steps).sum(axis=1) > 0))
+    lengths = np.sqrt(((steps * np.asarray(self.spacing[::-1])) ** 2).sum(axis=1))
+    return float(sum(length * penalty[tuple(point)] for length, point in zip(lengths, path[1:])))
+
+  def randomGrid(self, seed, shape=(9, 11, 13), enclosedGoal=False):
+    rng = np.random.default_rng(seed)
+    penalty = rng.uniform(0.05, 3.0, size=shape).astype(np.float32)
+    allowed = rng.random(shape) > 0.35
+    start = tuple(int(rng.integers(n)) for n in shape)
+    goal = tuple(int(rng.integers(n)) for n in shape)
+    if enclosedGoal:
+      # Vicini di goal non percorribili: goal non raggiungibile (se diverso da start)
+      allowed[tuple(slice(max(0, p - 1), p + 2) for p in goal)] = False
+    allowed[start] = allowed[goal] = True
+    return penalty, allowed, start, goal
+
+  def test_matchesDijkstra(self):
+    reachable = 0
+    for seed in range(20):
+      penalty, allowed, start, goal = self.randomGrid(seed, enclosedGoal=seed % 4 == 0)
+      flatPenalty, flatAllowed = penalty.reshape(-1), allowed.reshape(-1)
+      inputs = {
+        "array": (penalty, allowed),
+        "callable": (lambda index: float(flatPenalty[index]), lambda index: bool(flatAllowed[index])),
+      }
+      expected, expectedStats = pathfinding.findPath(penalty.shape, self.spacing, start, goal, penalty, allowed,
+                                                     heuristicWeight=0)
+      for name, (penaltyInput, allowedInput) in inputs.items():
+        with self.subTest(seed=seed, inputs=name):
+          path, stats = pathfinding.findBidirectionalPath(penalty.shape, self.spacing, start, goal,
+                                                          penaltyInput, allowedInput)
+          if expected is None:
+            self.assertIsNone(path)
+            continue
+          self.assertEqual((path[0], path[-1]), (start, goal))
+          self.assertTrue(all(allowed[point] for point in path[1:]))
+          self.assertAlmostEqual(stats["cost"], expectedStats["cost"], delta=1e-4 * max(1.0, expectedStats["cost"]))
+          self.assertAlmostEqual(self.pathCost(path, penalty), expectedStats["cost"],
+                                 delta=1e-4 * max(1.0, expectedStats["cost"]))
+      reachable += expected is not None
+    # Le griglie casuali devono contenere sia casi raggiungibili sia non raggiungibili
+    self.assertTrue(0 < reachable < 20)
+
+  def test_startEqualsGoal(self):
+    penalty, allowed, start, _ = self.randomGrid(0)
+    for penaltyInput in (penalty, lambda index: float(penalty.reshape(-1)[index])):
+      path, stats = pathfinding.findBidirectionalPath(penalty.shape, self.spacing, start, start, penaltyInput, allowed)
+      self.assertEqual(path, [start])
+      self.assertEqual(stats["cost"], 0.0)
+
+  def test_unreachableGoal(self):
+    penalty = np.ones((9, 9, 9), dtype=np.float32)
+    allowed = np.ones(penalty.shape, dtype=bool)
+    # Goal chiuso in un guscio di voxel non percorribili
+    allowed[3:6, 3:6, 3:6] = False
+    allowed[4, 4, 4] = True
+    for allowedInput in (allowed, lambda index: bool(allowed.reshape(-1)[index])):
+      path, stats = pathfinding.findBidirectionalPath(penalty.shape, self.spacing, (0, 0, 0), (4, 4, 4),
+                                                      penalty, allowedInput)
+      self.assertIsNone(path)
+      self.assertNotIn("cost", stats)
+    # Goal non percorribile o fuori dalla griglia
+    allowed[4, 4, 4] = False
+    self.assertIsNone(pathfinding.findBidirectionalPath(penalty.shape, self.spacing, (0, 0, 0), (4, 4, 4),
+                                                        penalty, allowed)[0])
+    self.assertIsNone(pathfinding.findBidirectionalPath(penalty.shape, self.spacing, (0, 0, 0), (9, 0, 0), penalty)[0])
+
+
+  def test_expandedNodesUnderSameHeuristic(self):
+    # Penalità casuali: euristica ammissibile debole, la ricerca si allarga in volume
+    rng = np.random.default_rng(5)
+    penalty = rng.uniform(0.05, 3.0, size=(28, 28, 28)).astype(np.float32)
+    start, goal = (3, 5, 4), (24, 22, 25)
+    weight = float(penalty.min())
+    exact, exactStats = pathfinding.findPath(penalty.shape, self.spacing, start, goal, penalty, heuristicWeight=weight)
+    path, stats = pathfinding.findBidirectionalPath(penalty.shape, self.spacing, start, goal, penalty)
+    greedy, greedyStats = pathfinding.findPath(penalty.shape, self.spacing, start, goal, penalty)
+    self.assertAlmostEqual(stats["cost"], exactStats["cost"], delta=1e-4 * exactStats["cost"])
+    # Due frontiere di raggio metà: molti meno nodi della ricerca esatta unidirezionale
+    self.assertLess(stats["expandedNodes"], 0.6 * exactStats["expandedNodes"])
+    # Il peso 1 espande meno nodi ma il percorso non è di costo minimo
+    self.assertLess(greedyStats["expandedNodes"], stats["expandedNodes"])
+    self.assertGreaterEqual(greedyStats["cost"], exactStats["cost"] * (1 - 1e-6))
+
+  def test_expandedNodesInTortuousVessel(self):
+    # Vaso tortuoso con penalità dei costi reali: la ricerca resta nel lume (quasi monodimensionale)
+    shape = (24, 32, 64)
+    k, j, i = np.indices(shape)
+    centerK = 12 + 6 * np.sin(i / shape[2] * 4 * np.pi)
+    centerJ = 16 + 8 * np.cos(i / shape[2] * 3 * np.pi)
+    values = np.where((k - centerK) ** 2 + (j - centerJ) ** 2 <= 4, 300, 40).astype(np.int16)
+    penalty = costs.penaltyVolume(values, 2.0)
+    def center(column):
+      return (int(round(12 + 6 * np.sin(column / shape[2] * 4 * np.pi))),
+              int(round(16 + 8 * np.cos(column / shape[2] * 3 * np.pi))), column)
+    start, goal = center(2), center(61)
+    exact, exactStats = pathfinding.findPath(shape, self.spacing, start, goal, penalty,
+                                             heuristicWeight=float(penalty.min()))
+    path, stats = pathfinding.findBidirectionalPath(shape, self.spacing, start, goal, penalty)
+    self.assertAlmostEqual(stats["cost"], exactStats["cost"], delta=1e-4 * exactStats["cost"])
+    # Le frontiere non escono dal vaso: circa gli stessi nodi della ricerca esatta unidirezionale
+    lumen = int((values == 300).sum())
+    self.assertLessEqual(stats["expandedNodes"], 1.2 * exactStats["expandedNodes"])
+    self.assertLessEqual(stats["expandedNodes"], 1.2 * lumen)
+
+
+if __name__ == "__main__":
+  unittest.main()